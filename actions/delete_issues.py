@@ -2,11 +2,10 @@ from lib.action import BitBucketAction
 
 
 class DeleteIssuesAction(BitBucketAction):
-    def run(self, repo, ids):
+    def run(self, repo, ids, concurrency, retries):
         """
-        Delete an issue
+        Delete issues, and return the result of each issue
         """
         bb = self._get_client(repo=repo)
-        for i in ids:
-            success, result = bb.issue.delete(issue_id=i)
-        return result
+        return self._run_bulk(bb, ids, lambda i: bb.issue.delete(issue_id=i),
+                              concurrency=concurrency, retries=retries)
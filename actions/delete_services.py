@@ -2,11 +2,10 @@ from lib.action import BitBucketAction
 
 
 class DeleteServicesAction(BitBucketAction):
-    def run(self, repo, ids):
+    def run(self, repo, ids, concurrency, retries):
         """
-        Delete a service
+        Delete services, and return the result of each service
         """
         bb = self._get_client(repo=repo)
-        for srv in ids:
-            success, result = bb.service.delete(service_id=srv)
-        return result
+        return self._run_bulk(bb, ids, lambda srv: bb.service.delete(service_id=srv),
+                              concurrency=concurrency, retries=retries)
@@ -1,17 +1,275 @@
+import functools
+import itertools
+import json
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests import Request
+from requests.exceptions import RequestException
+from urllib.parse import urlencode
 from st2common.runners.base_action import Action
 from bitbucket.bitbucket import Bitbucket
 
+from lib.cache import create_cache
+from lib.metrics import create_metrics
+from lib.session import create_session
+
+
+class PooledBitbucket(Bitbucket):
+    """
+    Bitbucket client which sends the requests through the shared session
+    instead of creating a new session every request. The successful responses
+    of GET requests are cached when the cache is given, and they are invalidated
+    by the successful requests which modify the resources. The requests and the cache
+    hits are recorded by the metrics when it's given.
+    """
+    def __init__(self, session, *args, **kwargs):
+        self._cache = kwargs.pop('cache', None)
+        self._metrics = kwargs.pop('metrics', None)
+        super(PooledBitbucket, self).__init__(*args, **kwargs)
+        self._session = session
+
+        # The last response of each thread, which is referred by the bulk operations
+        self._local = threading.local()
+
+        # The prefixes of the cached responses to invalidate at the end of the bulk operation
+        self._deferred_prefixes = None
+        self._deferred_lock = threading.Lock()
+
+    def get_last_response(self):
+        return getattr(self._local, 'response', None)
+
+    @contextmanager
+    def deferred_invalidation(self):
+        """
+        This invalidates the cached responses which are affected by the requests in this
+        context at once when it exits, instead of scanning the cache every request.
+        """
+        self._deferred_prefixes = set()
+        try:
+            yield
+        finally:
+            (prefixes, self._deferred_prefixes) = (self._deferred_prefixes, None)
+            if self._cache and prefixes:
+                self._cache.invalidate(sorted(prefixes))
+
+    def dispatch(self, method, url, auth=None, params=None, **kwargs):
+        path = url.replace(self.URLS['BASE'] % '', '', 1)
+        key = '%s?%s#%s' % (path, urlencode(sorted((params or {}).items())), self.username)
+        if self._cache and method == 'GET':
+            cached = self._cache.get(key)
+            if self._metrics:
+                self._metrics.inc('cache.miss' if cached is None else 'cache.hit')
+            if cached is not None:
+                self._local.response = None
+                return tuple(cached)
+
+        r = Request(
+            method=method,
+            url=url,
+            auth=auth,
+            params=params,
+            data=kwargs)
+        (started_at, status) = (time.time(), None)
+        try:
+            resp = self._session.send(r.prepare())
+            status = resp.status_code
+        finally:
+            if self._metrics:
+                self._metrics.record_request(path, time.time() - started_at, status)
+        self._local.response = resp
+
+        result = self._parse_response(resp)
+        if self._cache and result[0]:
+            if method == 'GET':
+                self._cache.set(key, list(result))
+            elif self._deferred_prefixes is not None:
+                with self._deferred_lock:
+                    self._deferred_prefixes.update(self._get_affected_prefixes(path))
+            else:
+                self._cache.invalidate(self._get_affected_prefixes(path))
+
+        return result
+
+    def _get_affected_prefixes(self, path):
+        """
+        This returns the key prefixes of the cached responses which are affected by
+        modifying the resource of the path. Modifying anything in a repository affects
+        all responses of the repository and the listings of the repositories.
+        """
+        parts = path.split('/')
+        if parts[0] == 'repositories' and len(parts) > 2 and parts[2]:
+            return ['repositories/%s/%s/' % (parts[1], parts[2]), 'users/']
+        elif parts[0] == 'repositories':
+            return ['repositories/', 'users/']
+        return [parts[0]]
+
+    def _parse_response(self, resp):
+        status = resp.status_code
+        text = resp.text
+        error = resp.reason
+        if status >= 200 and status < 300:
+            if text:
+                try:
+                    return (True, json.loads(text))
+                except (TypeError, ValueError):
+                    pass
+            return (True, text)
+        elif status >= 300 and status < 400:
+            return (False, 'Unauthorized access, please check your credentials.')
+        elif status == 429:
+            return (False, 'Rate limit exceeded.')
+        elif status >= 400 and status < 500:
+            return (False, 'Service not found.')
+        elif status >= 500 and status < 600:
+            return (False, 'Server error.')
+        else:
+            return (False, error)
+
 
 class BitBucketAction(Action):
-    def __init__(self, config):
-        super(BitBucketAction, self).__init__(config)
+    # The default number of the concurrent requests and the retries of the bulk operations
+    CONCURRENCY = 4
+    RETRIES = 3
+
+    # The base seconds of the exponential backoff when 'Retry-After' isn't specified
+    RETRY_INTERVAL = 1
+
+    def __init__(self, config, action_service=None):
+        super(BitBucketAction, self).__init__(config, action_service)
+        self._session = None
+        self._clients = {}
+
+        # The response cache is created at the first request because the action_service
+        # may be set after the action is instantiated.
+        self._cache = None
+        self._cache_created = False
+
+        # Every run is timed by the name of the action (e.g. 'list_issues')
+        self._metrics = create_metrics(self.config)
+        self.run = self._measure(self.run)
+
+    def _measure(self, run):
+        name = self.__class__.__module__.split('.')[-1]
+
+        @functools.wraps(run)
+        def wrapper(*args, **kwargs):
+            success = False
+            try:
+                with self._metrics.timer(name):
+                    result = run(*args, **kwargs)
+
+                # the action which returns (False, result) is failed
+                success = not (isinstance(result, tuple) and result and result[0] is False)
+                return result
+            finally:
+                self._metrics.inc('%s.%s' % (name, 'success' if success else 'failure'))
+
+        return wrapper
+
+    def _get_session(self):
+        # The session is shared by all clients in this action run
+        if not self._session:
+            self._session = create_session(self.config)
+        return self._session
+
+    def _get_cache(self):
+        # The response cache is enabled by the 'cache' config
+        if not self._cache_created:
+            self._cache = create_cache(self.config, self.action_service)
+            self._cache_created = True
+        return self._cache
 
     def _get_client(self, repo=None):
-        if repo:
-            bb = Bitbucket(username=self.config['username'],
-                           password=self.config['password'],
-                           repo_name_or_slug=repo)
-        else:
-            bb = Bitbucket(username=self.config['email'],
-                           password=self.config['password'])
-        return bb
+        if repo not in self._clients:
+            if repo:
+                bb = PooledBitbucket(self._get_session(),
+                                     username=self.config['username'],
+                                     password=self.config['password'],
+                                     repo_name_or_slug=repo,
+                                     cache=self._get_cache(),
+                                     metrics=self._metrics)
+            else:
+                bb = PooledBitbucket(self._get_session(),
+                                     username=self.config['email'],
+                                     password=self.config['password'],
+                                     cache=self._get_cache(),
+                                     metrics=self._metrics)
+            self._clients[repo] = bb
+        return self._clients[repo]
+
+    def _run_bulk(self, bb, ids, operation, concurrency=CONCURRENCY, retries=RETRIES):
+        """
+        This applies the operation to each id on the worker pool, and returns whether all of
+        them succeeded and the result (success, status, error) of each id. The request which
+        is rate-limited (429) or failed by the server error (5xx) is retried after the seconds
+        of the 'Retry-After' header, or the exponential backoff.
+        """
+        def run(item_id):
+            for attempt in range(retries + 1):
+                try:
+                    (success, result) = operation(item_id)
+                    response = bb.get_last_response()
+                    status = response.status_code if response is not None else None
+                except RequestException as e:
+                    (success, result, response, status) = (False, str(e), None, None)
+
+                if success or attempt >= retries or (status and status != 429 and status < 500):
+                    break
+
+                time.sleep(self._get_retry_interval(response, attempt))
+
+            return {'success': success, 'status': status, 'error': None if success else result}
+
+        with bb.deferred_invalidation():
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = dict(zip([str(x) for x in ids], executor.map(run, ids)))
+
+        return (all([x['success'] for x in results.values()]), results)
+
+    def _get_retry_interval(self, response, attempt):
+        try:
+            return float(response.headers['Retry-After'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return self.RETRY_INTERVAL * (2 ** attempt)
+
+    def _is_listing(self, limit=None, page=None, cursor=None, fields=None):
+        """
+        This returns whether any of the listing options is specified. The actions which
+        returned other than a list keep returning it when none of them is specified.
+        """
+        return any([x is not None for x in (limit, page, cursor, fields)])
+
+    def _get_offset(self, limit=None, page=None, cursor=None):
+        """
+        This returns the index of the first item from the cursor which is returned as
+        'next_cursor' of the previous page, or the page number (1-origin) of the limit.
+        """
+        if cursor:
+            return int(cursor)
+        if page and limit:
+            return (page - 1) * limit
+        return 0
+
+    def _list(self, items, offset=0, limit=None, fields=None):
+        """
+        This returns the items which are projected to the fields. The items are consumed as
+        a stream from the offset, so that only the items in the page are materialized.
+        When the limit is specified, this returns the page with the cursor of the next one.
+        """
+        if limit is None:
+            return [self._project(x, fields) for x in items]
+
+        # The extra item is read ahead to know whether the next page exists
+        page_items = [self._project(x, fields) for x in itertools.islice(items, limit + 1)]
+        return {
+            'items': page_items[:limit],
+            'next_cursor': str(offset + limit) if len(page_items) > limit else None,
+        }
+
+    def _project(self, item, fields):
+        if not fields or not isinstance(item, dict):
+            return item
+        return dict([(k, item[k]) for k in fields if k in item])
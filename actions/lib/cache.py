@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import time
+
+# The default seconds to keep the responses and the number of them in the cache
+TTL = 60
+SIZE = 1000
+
+# The default directory of the 'disk' cache
+PATH = '/tmp/stackstorm-bitbucket-cache'
+
+
+def get_slot(key, size):
+    """
+    This returns the slot of the key in the cache of the size. Each slot keeps only one
+    entry, then the number of the entries never exceeds the size without counting them.
+    """
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % size
+
+
+class DatastoreCache(object):
+    """
+    Response cache which is stored in the st2 datastore, so that it's shared over the
+    action runs. The keys aren't local to the action, then all actions share the cache.
+    The expired entries are removed by the TTL of the datastore.
+    """
+    KEY_PREFIX = 'bitbucket.cache.'
+
+    def __init__(self, action_service, ttl=TTL, size=SIZE):
+        self._action_service = action_service
+        self._ttl = ttl
+        self._size = size
+
+    def get(self, key):
+        value = self._action_service.get_value(name=self._name(key), local=False)
+        if not value:
+            return None
+
+        # the slot may be taken by another key
+        entry = json.loads(value)
+        if entry['key'] != key or entry['stored_at'] + self._ttl < time.time():
+            return None
+
+        return entry['value']
+
+    def set(self, key, value):
+        # the entry in the same slot is evicted
+        value = json.dumps({'key': key, 'stored_at': time.time(), 'value': value})
+        try:
+            self._action_service.set_value(name=self._name(key), value=value, ttl=self._ttl,
+                                           local=False)
+        except ValueError:
+            # The datastore which doesn't support the TTL (e.g. the one of st2tests) keeps
+            # the entry, which is expired by its stored time.
+            self._action_service.set_value(name=self._name(key), value=value, local=False)
+
+    def invalidate(self, prefixes):
+        for (name, entry) in self._list():
+            if any([entry['key'].startswith(x) for x in prefixes]):
+                self._action_service.delete_value(name=name, local=False)
+
+    def _list(self):
+        """
+        This returns the (name, entry) of all entries.
+        """
+        return [(x.name, json.loads(x.value))
+                for x in self._action_service.list_values(local=False,
+                                                          prefix=self.KEY_PREFIX) or []]
+
+    def _name(self, key):
+        return '%s%d' % (self.KEY_PREFIX, get_slot(key, self._size))
+
+
+class DiskCache(object):
+    """
+    Response cache which is stored in the local directory, one file per entry.
+    """
+    def __init__(self, path=PATH, ttl=TTL, size=SIZE):
+        self._path = path
+        self._ttl = ttl
+        self._size = size
+
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+    def get(self, key):
+        filepath = self._filepath(key)
+        try:
+            with open(filepath) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        # the slot may be taken by another key
+        if entry['key'] != key:
+            return None
+
+        if entry['stored_at'] + self._ttl < time.time():
+            self._remove(filepath)
+            return None
+
+        return entry['value']
+
+    def set(self, key, value):
+        # The entry is written to the temporary file and renamed, so that the concurrent
+        # action runs never read the partially written one.
+        filepath = self._filepath(key)
+        tmppath = '%s.%d.tmp' % (filepath, os.getpid())
+        with open(tmppath, 'w') as f:
+            json.dump({'key': key, 'stored_at': time.time(), 'value': value}, f)
+        # the entry in the same slot is evicted
+        os.rename(tmppath, filepath)
+
+    def invalidate(self, prefixes):
+        for (filepath, entry) in self._list():
+            if any([entry['key'].startswith(x) for x in prefixes]):
+                self._remove(filepath)
+
+    def _list(self):
+        """
+        This returns the (filepath, entry) of all entries.
+        """
+        entries = []
+        for filename in os.listdir(self._path):
+            if not filename.endswith('.json'):
+                continue
+
+            filepath = os.path.join(self._path, filename)
+            try:
+                with open(filepath) as f:
+                    entries.append((filepath, json.load(f)))
+            except (IOError, ValueError):
+                continue
+
+        return entries
+
+    def _filepath(self, key):
+        return os.path.join(self._path, '%d.json' % get_slot(key, self._size))
+
+    def _remove(self, filepath):
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+
+def create_cache(config, action_service):
+    """
+    This returns the response cache which is specified by 'cache.backend' ('datastore' or
+    'disk'), or None when the cache isn't enabled.
+    """
+    cache_config = config.get('cache') or {}
+    backend = cache_config.get('backend')
+
+    if backend == 'datastore':
+        return DatastoreCache(action_service,
+                              ttl=cache_config.get('ttl', TTL),
+                              size=cache_config.get('size', SIZE))
+    elif backend == 'disk':
+        return DiskCache(cache_config.get('path', PATH),
+                         ttl=cache_config.get('ttl', TTL),
+                         size=cache_config.get('size', SIZE))
+    elif backend:
+        raise ValueError('specified cache backend (%s) is not supported' % backend)
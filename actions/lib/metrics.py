@@ -0,0 +1,68 @@
+import time
+
+from contextlib import contextmanager
+
+try:
+    from st2common.metrics.base import get_driver
+except ImportError:
+    # the metrics driver is available since StackStorm v2.9
+    get_driver = None
+
+# The default prefix of the metric keys
+PREFIX = 'bitbucket'
+
+
+def get_endpoint(path):
+    """
+    This returns the kind of the API endpoint of the path which is relative to the API base
+    (e.g. 'repositories.issues' of 'repositories/<user>/<repo>/issues/1').
+    """
+    parts = [x for x in path.split('?')[0].split('/') if x]
+    if parts and parts[0] == 'repositories':
+        return '.'.join(['repositories'] + parts[3:4])
+    elif parts and parts[0] == 'users':
+        return '.'.join(['users'] + parts[2:3])
+    return parts[0] if parts else 'other'
+
+
+class Metrics(object):
+    """
+    This sends the metrics of the actions to the metrics driver of StackStorm, which is
+    configured in st2.conf (e.g. statsd). Nothing is sent when the driver isn't available.
+    """
+    def __init__(self, prefix=PREFIX):
+        self._prefix = prefix
+        self._driver = get_driver() if get_driver else None
+
+    def inc(self, key, amount=1):
+        if self._driver:
+            self._driver.inc_counter('%s.%s' % (self._prefix, key), amount)
+
+    def time(self, key, seconds):
+        if self._driver:
+            self._driver.time('%s.%s' % (self._prefix, key), seconds)
+
+    @contextmanager
+    def timer(self, key):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.time(key, time.time() - started_at)
+
+    def record_request(self, path, seconds, status=None):
+        """
+        This records the API call and its latency by the kind of the endpoint. The status is
+        None when the request is failed without the response.
+        """
+        endpoint = get_endpoint(path)
+        self.inc('api.%s' % endpoint)
+        self.time('api.%s' % endpoint, seconds)
+
+        if status is None or status >= 400:
+            self.inc('api.%s.error' % endpoint)
+
+
+def create_metrics(config):
+    metrics_config = config.get('metrics') or {}
+    return Metrics('%s.action' % metrics_config.get('prefix', PREFIX))
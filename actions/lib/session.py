@@ -0,0 +1,23 @@
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+# The default numbers of the hosts and the connections to each host kept alive in the pool
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+
+
+def create_session(config):
+    """
+    This returns the session which keeps the connections alive in the pool, so that
+    the requests of an action reuse them instead of paying TCP and TLS setup every time.
+    The number of connections to each host is limited by 'http.pool_maxsize'.
+    """
+    http_config = config.get('http') or {}
+    adapter = HTTPAdapter(pool_connections=http_config.get('pool_connections', POOL_CONNECTIONS),
+                          pool_maxsize=http_config.get('pool_maxsize', POOL_MAXSIZE),
+                          pool_block=True)
+
+    session = Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -1,11 +1,24 @@
+import itertools
+
 from lib.action import BitBucketAction
 
 
 class ListBrachesAction(BitBucketAction):
-    def run(self, repo):
+    def run(self, repo, limit=None, page=None, cursor=None, fields=None):
         """
         List Braches of Repository with relevant details
         """
         bb = self._get_client(repo=repo)
         success, result = bb.get_branches()
-        return result
+        if not success:
+            return (False, result)
+
+        # the branches are returned by name as before unless the listing options are specified
+        if not self._is_listing(limit, page, cursor, fields):
+            return result
+
+        # the branches are listed in order of the name
+        branches = (result[x] for x in sorted(result))
+
+        offset = self._get_offset(limit, page, cursor)
+        return self._list(itertools.islice(branches, offset, None), offset, limit, fields)
@@ -2,11 +2,48 @@ from lib.action import BitBucketAction
 
 
 class ListIssuesAction(BitBucketAction):
-    def run(self, repo):
+    # The maximum number of issues which BitBucket returns in a page
+    PAGE_SIZE = 50
+
+    def run(self, repo, status=None, limit=None, page=None, cursor=None, fields=None):
         """
         List Issues of Repository with title
         of the issue its status and reporter
         """
         bb = self._get_client(repo=repo)
-        success, result = bb.issue.all()
-        return result
+
+        # the first page of BitBucket (with the 'count') is returned as before unless
+        # the listing options are specified
+        if not self._is_listing(limit, page, cursor, fields):
+            success, result = bb.issue.all(params={'status': status} if status else None)
+            if not success:
+                return (False, result)
+            return result
+
+        def get_issues(start):
+            """
+            This generates the issues from the start index, which are filtered by
+            the status on BitBucket and requested page by page.
+            """
+            # only the issues of the page (and the one to know the next page) are requested
+            params = {'limit': min(limit + 1, self.PAGE_SIZE) if limit else self.PAGE_SIZE}
+            if status:
+                params['status'] = status
+
+            while True:
+                success, result = bb.issue.all(params=dict(params, start=start))
+                if not success:
+                    raise RuntimeError(result)
+
+                for issue in result['issues']:
+                    yield issue
+
+                start += len(result['issues'])
+                if not result['issues'] or start >= result['count']:
+                    return
+
+        offset = self._get_offset(limit, page, cursor)
+        try:
+            return self._list(get_issues(offset), offset, limit, fields)
+        except RuntimeError as e:
+            return (False, str(e))
@@ -1,8 +1,10 @@
+import itertools
+
 from lib.action import BitBucketAction
 
 
 class ListReposAction(BitBucketAction):
-    def run(self):
+    def run(self, name_prefix=None, limit=None, page=None, cursor=None, fields=None):
         """
         Listing repositories for a user.It assumes
         that you have already places the name and
@@ -12,4 +14,12 @@ class ListReposAction(BitBucketAction):
         """
         bb = self._get_client()
         success, repos = bb.repository.all()
-        return repos
+        if not success:
+            return (False, repos)
+
+        repos = iter(repos)
+        if name_prefix:
+            repos = (x for x in repos if x['name'].startswith(name_prefix))
+
+        offset = self._get_offset(limit, page, cursor)
+        return self._list(itertools.islice(repos, offset, None), offset, limit, fields)
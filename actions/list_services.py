@@ -1,11 +1,17 @@
+import itertools
+
 from lib.action import BitBucketAction
 
 
 class ListServicesAction(BitBucketAction):
-    def run(self, repo):
+    def run(self, repo, limit=None, page=None, cursor=None, fields=None):
         """
         List Services associated with Repository
         """
         bb = self._get_client(repo=repo)
         success, result = bb.service.all()
-        return result
+        if not success:
+            return (False, result)
+
+        offset = self._get_offset(limit, page, cursor)
+        return self._list(itertools.islice(result, offset, None), offset, limit, fields)
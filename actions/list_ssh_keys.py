@@ -1,11 +1,17 @@
+import itertools
+
 from lib.action import BitBucketAction
 
 
 class ListSshKeyAction(BitBucketAction):
-    def run(self):
+    def run(self, limit=None, page=None, cursor=None, fields=None):
         """
         List all the SSH keys in bitbucket account
         """
         bb = self._get_client()
         succ, result = bb.ssh.all()
-        return result
+        if not succ:
+            return (False, result)
+
+        offset = self._get_offset(limit, page, cursor)
+        return self._list(itertools.islice(result, offset, None), offset, limit, fields)
@@ -0,0 +1,343 @@
+import aiohttp
+import asyncio
+import time
+
+from commit_parser import get_cloud_updated_files
+from commit_parser import get_server_updated_files
+from commit_parser import parse_cloud_commit
+from commit_parser import parse_server_commit
+from urllib.parse import urlencode, urlsplit
+
+
+class AsyncEngine(object):
+    """
+    This checks the new commits of the targets by non-blocking HTTP requests on one event loop
+    instead of the worker pool of the RepositorySensor. The number of the concurrent requests
+    is bounded by the 'concurrency' parameter, and the results are passed to the same dispatch
+    stage as the worker pool.
+    """
+    PAGE_SIZE = 100
+
+    def __init__(self, sensor):
+        self._sensor = sensor
+        self._logger = sensor._logger
+        self._loop = asyncio.new_event_loop()
+
+        # These are created in the event loop at the first polling
+        self._session = None
+        self._semaphore = None
+
+        # The changed files of the commits which are being fetched
+        self._loading = {}
+
+        if sensor.service_type == 'server':
+            self._base_url = '%s/rest/api/1.0' % (
+                sensor._config['sensor'].get('bitbucket_server_url').rstrip('/'))
+            self._get_branch_tips = self._get_server_branch_tips
+            self._get_updated_commits = self._get_server_updated_commits
+        else:
+            self._base_url = '%s/2.0' % sensor.client.get_bitbucket_url()
+            self._get_branch_tips = self._get_cloud_branch_tips
+            self._get_updated_commits = self._get_cloud_updated_commits
+
+    def check_targets(self, targets, dispatched, updated_repositories):
+        return self._loop.run_until_complete(
+            self._check_targets(targets, dispatched, updated_repositories))
+
+    def close(self):
+        if self._session:
+            self._loop.run_until_complete(self._session.close())
+        self._loop.close()
+
+    async def _check_targets(self, targets, dispatched, updated_repositories):
+        if self._session is None:
+            # The connections are kept alive over the pollings
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self._sensor._config.get('username'),
+                                       self._sensor._config.get('password')),
+                timeout=aiohttp.ClientTimeout(total=self._sensor.TIMEOUT_SECONDS),
+                connector=aiohttp.TCPConnector(limit=self._sensor.CONCURRENCY))
+            self._semaphore = asyncio.Semaphore(self._sensor.CONCURRENCY)
+
+        tips_list = await asyncio.gather(*[self._get_branch_tips(x['repository'])
+                                           for x in targets], return_exceptions=True)
+
+        jobs = []
+        for (target, tips) in zip(targets, tips_list):
+            if isinstance(tips, Exception):
+                # this repository is checked again at the next polling
+                self._sensor._logger.warning('Failed to check the repository(%s) [%s]' %
+                                             (target['repository'], tips))
+                continue
+
+            for branch in self._sensor._select_branches(target, tips, dispatched,
+                                                        updated_repositories):
+                jobs.append(self._walk(target['repository'], branch))
+
+        return await asyncio.gather(*jobs)
+
+    async def _walk(self, repository, branch):
+        with self._sensor._metrics.walk_timer(repository):
+            try:
+                return await self._get_updated_commits(repository, branch)
+            except Exception as e:
+                return self._sensor._get_failed_result(repository, branch, e)
+
+    async def _request(self, url, params=None, headers=None):
+        """
+        This returns the status, the headers and the JSON body of the response. The body is
+        None when the response is '304 Not Modified'.
+        """
+        async with self._semaphore:
+            # every API call is recorded by the kind of the endpoint with its latency
+            (started_at, status) = (time.time(), None)
+            try:
+                async with self._session.get(url, params=params, headers=headers) as res:
+                    status = res.status
+                    if res.status == 304:
+                        return (res.status, res.headers, None)
+
+                    res.raise_for_status()
+                    return (res.status, res.headers, await res.json())
+            finally:
+                self._sensor._metrics.record_request(urlsplit(url).path,
+                                                     time.time() - started_at, status)
+
+    async def _get_or_load(self, commit_id, loader):
+        """
+        This returns the cached changed files of the commit, or the ones which are returned
+        by the loader. The loader is awaited only once even if the same commit is requested
+        by multiple branches concurrently.
+        """
+        files = self._sensor._changes_cache.get(commit_id)
+        if files is not None:
+            return files
+
+        if commit_id not in self._loading:
+            self._loading[commit_id] = asyncio.ensure_future(loader())
+        try:
+            files = await asyncio.shield(self._loading[commit_id])
+        finally:
+            self._loading.pop(commit_id, None)
+
+        self._sensor._changes_cache.set(commit_id, files)
+        return files
+
+    async def _get_server_pages(self, url, params=None, start=0):
+        """
+        This generates the values of all pages of the paged API on the BitBucket Server
+        from the specified index.
+        """
+        while True:
+            (_, _, data) = await self._request(url, params=dict(params or {}, start=start,
+                                                                limit=self.PAGE_SIZE))
+            for value in data['values']:
+                yield value
+
+            if data.get('isLastPage', True):
+                return
+            start = data['nextPageStart']
+
+    async def _get_cloud_pages(self, url, params=None):
+        """
+        This generates the values of all pages of the paged API on the BitBucket Cloud.
+        """
+        while url:
+            (_, _, data) = await self._request(url, params=params)
+            for value in data['values']:
+                yield value
+
+            # the parameters are contained in the URL of the next page
+            (url, params) = (data.get('next'), None)
+
+    async def _get_server_branch_tips(self, repository):
+        (proj, repo) = repository.split('/')
+        url = '%s/projects/%s/repos/%s/branches' % (self._base_url, proj, repo)
+        try:
+            return dict([(x['displayId'], x['latestCommit'])
+                         async for x in self._get_server_pages(url)])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._logger.warning('Failed to get branches of the repository(%s) [%s]' %
+                                 (repository, e))
+
+    async def _get_cloud_branch_tips(self, repository):
+        (etag, tips) = self._sensor._branch_tips.get(repository, (None, None))
+
+        url = '%s/repositories/%s/refs/branches' % (self._base_url, repository)
+        headers = {'If-None-Match': etag} if etag else {}
+        try:
+            (status, res_headers, data) = await self._request(url, params={'pagelen': 100},
+                                                              headers=headers)
+            if status == 304:
+                return tips
+
+            etag = res_headers.get('ETag')
+            tips = dict([(x['name'], x['target']['hash']) for x in data['values']])
+            if data.get('next'):
+                # The ETag of the first page doesn't reflect the following pages
+                etag = None
+                async for branch in self._get_cloud_pages(data['next']):
+                    tips[branch['name']] = branch['target']['hash']
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._logger.warning('Failed to get branches of the repository(%s) [%s]' %
+                                 (repository, e))
+            return None
+
+        self._sensor._branch_tips[repository] = (etag, tips)
+        return tips
+
+    async def _get_server_updated_commits(self, repository, branch):
+        (proj, repo) = repository.split('/')
+        url = '%s/projects/%s/repos/%s/commits' % (self._base_url, proj, repo)
+
+        async def get_commits(until, since, position):
+            params = {'until': until}
+            if since:
+                params['since'] = since
+
+            # the listing can be started from any commit, which is positioned by its index
+            index = position or 0
+            async for commit in self._get_server_pages(url, params, index):
+                yield (index, commit)
+                index += 1
+
+        async def parse_commit(commit):
+            async def get_updated_files():
+                changes_url = '%s/%s/changes' % (url, commit['id'])
+                return get_server_updated_files([x async for x in
+                                                 self._get_server_pages(changes_url)])
+
+            return parse_server_commit(commit, repository, branch,
+                                       await self._get_or_load(commit['id'], get_updated_files))
+
+        return await self._walk_commits(repository, branch, get_commits, parse_commit,
+                                        lambda commit: commit['id'])
+
+    async def _get_cloud_updated_commits(self, repository, branch):
+        url = '%s/repositories/%s' % (self._base_url, repository)
+
+        async def get_commits(until, since, position):
+            params = {'pagelen': self.PAGE_SIZE}
+            if since:
+                params['exclude'] = since
+
+            # the commits are positioned by the query of their page, which is applied to the
+            # URL of 'until' as well as the CloudBackend
+            query = position or urlencode(params)
+            while query:
+                (_, _, data) = await self._request('%s/commits/%s?%s' % (url, until, query))
+                for commit in data['values']:
+                    yield (query, commit)
+                query = urlsplit(data['next']).query if data.get('next') else None
+
+        async def parse_commit(commit):
+            async def get_updated_files():
+                diffstat_url = '%s/diffstat/%s' % (url, commit['hash'])
+                return get_cloud_updated_files([x async for x in
+                                                self._get_cloud_pages(diffstat_url)])
+
+            return parse_cloud_commit(commit, repository, branch,
+                                      await self._get_or_load(commit['hash'], get_updated_files))
+
+        return await self._walk_commits(repository, branch, get_commits, parse_commit,
+                                        lambda commit: commit['hash'])
+
+    async def _walk_commits(self, repository, branch, get_commits, parse_commit, get_commit_id):
+        """
+        This walks the commits of the branch in the same manner as the worker pool of the
+        RepositorySensor, and returns them with the cursor of the walk.
+        """
+        sensor = self._sensor
+        started_at = time.time()
+        deadline = started_at + sensor.TIMEOUT_SECONDS
+        since = sensor.last_commit[repository][branch]
+        cursor = dict(sensor.cursors.get(repository, {}).get(branch) or {'head': None, 'offset': 0})
+        page = cursor.get('page') or [None, 0]
+        finished = False
+        fetching = []
+        commits = get_commits(cursor['head'] or branch, since, page[0])
+        try:
+            index = page[1]
+            async for (position, commit) in commits:
+                if position != page[0]:
+                    page = [position, index]
+
+                if index < cursor['offset']:
+                    # this commit of the resumed page has been checked
+                    index += 1
+                    continue
+
+                cursor['page'] = page
+                sensor._check_deadline(deadline)
+
+                if len(fetching) >= sensor.BATCH_SIZE:
+                    # the rest of this walk is checked in the next polling
+                    break
+
+                if cursor['head'] is None:
+                    # pin the walk to the tip commit of the branch
+                    cursor['head'] = get_commit_id(commit)
+
+                    if since is None:
+                        # the branch isn't initialized, the tip is regarded as checked
+                        finished = True
+                        break
+
+                # the detail of each commit is fetched in parallel with the walk
+                fetching.append((index, page, asyncio.ensure_future(parse_commit(commit))))
+                index += 1
+                cursor['offset'] = index
+            else:
+                finished = True
+        except aiohttp.ClientResponseError as e:
+            if e.status != 404:
+                raise
+
+            # The branch or the last checked commit is missing (e.g. force pushed and
+            # garbage collected), then the branch is initialized again.
+            self._logger.warning("branch(%s) doesn't exist in the repository(%s) [%s]" %
+                                 (branch, repository, e))
+            for (_, _, task) in fetching:
+                task.cancel()
+            return (repository, branch, [], {'head': None, 'offset': None})
+        except (TimeoutError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+            sensor._metrics.inc('timeouts')
+            self._logger.info('checking processing is timedout (%s:%s) after %.3fs at the '
+                              'commit %d [%s]' % (repository, branch, time.time() - started_at,
+                                                  cursor['offset'], e))
+        finally:
+            await commits.aclose()
+
+        new_commits = []
+        for (index, page, task) in fetching:
+            try:
+                # append new commit
+                new_commits.append(await task)
+                continue
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                sensor._metrics.inc('timeouts')
+                self._logger.info('fetching commit detail is timedout (%s:%s) after %.3fs [%s]' %
+                                  (repository, branch, time.time() - started_at, e))
+            except Exception as e:
+                # The detail of the commit which has been listed can't be parsed (e.g. the
+                # unexpected JSON), which doesn't mean the branch is missing.
+                sensor._metrics.inc('errors')
+                self._logger.warning('fetching commit detail is failed (%s:%s) [%s]' %
+                                     (repository, branch, e))
+
+            # the walk is resumed from this commit at the next polling
+            for (_, _, rest) in fetching:
+                rest.cancel()
+            (cursor['offset'], cursor['page'], finished) = (index, page, False)
+            break
+
+        if cursor['head'] is None:
+            # there is no new commit in the branch (or nothing has been checked)
+            return (repository, branch, new_commits, None)
+
+        if not finished:
+            # the rest of this walk is resumed at the next polling
+            return (repository, branch, new_commits, cursor)
+
+        # The walk is finished. The last checked commit is advanced to its head.
+        return (repository, branch, new_commits, dict(cursor, offset=None))
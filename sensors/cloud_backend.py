@@ -0,0 +1,174 @@
+from commit_parser import get_cloud_updated_files
+from commit_parser import parse_cloud_commit
+from commit_parser import parse_cloud_date
+from pybitbucket.auth import BasicAuthenticator
+from pybitbucket.bitbucket import Client
+from requests.exceptions import HTTPError, Timeout
+from urllib.parse import urlencode, urlsplit
+
+
+class CloudBackend(object):
+    """
+    This accesses the BitBucket Cloud for the RepositorySensor through the pybitbucket. This is
+    imported only when the 'bitbucket_type' is 'cloud'.
+    """
+    # The errors which indicate that the branch or the commit doesn't exist
+    NOT_FOUND_ERRORS = (ValueError, HTTPError)
+
+    def __init__(self, sensor):
+        self._sensor = sensor
+        self._logger = sensor._logger
+
+        self.client = Client(BasicAuthenticator(
+            sensor._config.get('username'),
+            sensor._config.get('password'),
+            sensor._config.get('email'),
+        ))
+        sensor._configure_session(self.client.session)
+
+    def is_not_found(self, error):
+        # Only '404 Not Found' means that the branch or the commit is missing. The others
+        # (e.g. '503 Service Unavailable' or '429 Too Many Requests') are transient.
+        response = getattr(error, 'response', None)
+        return response is not None and response.status_code == 404
+
+    def list_repositories(self, project):
+        url = '%s/2.0/repositories/%s?pagelen=100&fields=next,values.slug' % (
+            self.client.get_bitbucket_url(), project)
+        return [x['slug'] for x in self._get_values(url)]
+
+    def get_branch_tips(self, repository):
+        """
+        This returns the tip commit-id of each branch in the repository. The branches are
+        requested with the ETag of the last response, so that the unchanged branches are
+        answered by '304 Not Modified' without the body.
+        """
+        (etag, tips) = self._sensor._branch_tips.get(repository, (None, None))
+
+        url = '%s/2.0/repositories/%s/refs/branches?pagelen=100' % (
+            self.client.get_bitbucket_url(), repository)
+        headers = {'If-None-Match': etag} if etag else {}
+        try:
+            res = self.client.session.get(url, headers=headers)
+            if res.status_code == 304:
+                return tips
+
+            etag = res.headers.get('ETag')
+            tips = {}
+            while True:
+                Client.expect_ok(res)
+
+                data = res.json()
+                for branch in data['values']:
+                    tips[branch['name']] = branch['target']['hash']
+
+                if not data.get('next'):
+                    break
+
+                # The ETag of the first page doesn't reflect the following pages
+                etag = None
+                res = self.client.session.get(data['next'])
+        except (HTTPError, Timeout) as e:
+            self._logger.warning('Failed to get branches of the repository(%s) [%s]' %
+                                 (repository, e))
+            return None
+
+        self._sensor._branch_tips[repository] = (etag, tips)
+        return tips
+
+    def get_last_commit_id(self, repository, branch):
+        (_, last_commit) = next(self.get_commits(repository, branch, None), (None, None))
+        if last_commit:
+            return last_commit['hash']
+
+    def get_commits(self, repository, until, since, position=None):
+        """
+        This generates the commits from 'until' to 'since' (exclusive) with their positions,
+        which are the queries of their pages. The query of the next page is applied to the
+        URL of 'until', so that the walk which is pinned to the commit-id after the first
+        page (whose URL has the branch name) is resumed from the page as well.
+        """
+        url = '%s/2.0/repositories/%s/commits/%s' % (self.client.get_bitbucket_url(),
+                                                     repository, until)
+        params = {'pagelen': 100}
+        if since:
+            params['exclude'] = since
+
+        query = position or urlencode(params)
+        while query:
+            res = self.client.session.get('%s?%s' % (url, query))
+            Client.expect_ok(res)
+
+            data = res.json()
+            for commit in data['values']:
+                yield (query, commit)
+            query = urlsplit(data['next']).query if data.get('next') else None
+
+    def get_commit_id(self, commit):
+        return commit['hash']
+
+    def parse_commit(self, repository, branch, commit):
+        return parse_cloud_commit(commit, repository, branch,
+                                  self._sensor._changes_cache.get_or_load(
+                                      commit['hash'],
+                                      lambda: self._get_updated_files(repository,
+                                                                      commit['hash'])))
+
+    def get_tags(self, repository):
+        """
+        This returns the commit-id of each tag in the repository.
+        """
+        url = '%s/2.0/repositories/%s/refs/tags?pagelen=100' % (
+            self.client.get_bitbucket_url(), repository)
+        return dict([(x['name'], x['target']['hash']) for x in self._get_values(url)])
+
+    def get_pull_requests(self, repository):
+        """
+        This returns the open pull-requests of the repository by their ids.
+        """
+        url = '%s/2.0/repositories/%s/pullrequests?state=OPEN&pagelen=50' % (
+            self.client.get_bitbucket_url(), repository)
+        return dict([(str(x['id']), self._parse_pull_request(x)) for x in self._get_values(url)])
+
+    def get_pull_request(self, repository, pr_id):
+        res = self.client.session.get('%s/2.0/repositories/%s/pullrequests/%s' % (
+            self.client.get_bitbucket_url(), repository, pr_id))
+        Client.expect_ok(res)
+        return self._parse_pull_request(res.json())
+
+    def _get_updated_files(self, repository, commit_id):
+        """
+        This returns file-pathes which are changed in the commit from its diffstat (following
+        all pages of it).
+        """
+        url = '%s/2.0/repositories/%s/diffstat/%s' % (self.client.get_bitbucket_url(),
+                                                      repository, commit_id)
+        return get_cloud_updated_files(self._get_values(url))
+
+    def _parse_pull_request(self, pr):
+        updated_on = parse_cloud_date(pr['updated_on'])
+        return {
+            'id': pr['id'],
+            'title': pr['title'],
+            'state': pr['state'].lower(),
+            'author': (pr.get('author') or {}).get('nickname', 'Unknown'),
+            'source': pr['source']['branch']['name'],
+            'destination': pr['destination']['branch']['name'],
+            'commit': (pr['source'].get('commit') or {}).get('hash'),
+            'updated_on': updated_on.strftime(self._sensor.DATE_FORMAT),
+        }
+
+    def _get_values(self, url):
+        """
+        This returns the values of all pages from the URL.
+        """
+        values = []
+        while url:
+            res = self.client.session.get(url)
+            Client.expect_ok(res)
+
+            data = res.json()
+            values += data['values']
+            url = data.get('next')
+
+        return values
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+# The format of the commit time in the payloads
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def get_server_updated_files(changes):
+    """
+    This returns file-pathes which are changed in the commit from its changes
+    on the BitBucket Server.
+    """
+    def do_get_updated_files(req_type):
+        return [x['path']['toString'] for x in changes if x['type'] == req_type]
+
+    return {
+        'added': do_get_updated_files('ADD'),
+        'moved': do_get_updated_files('MOVE'),
+        'deleted': do_get_updated_files('DELETE'),
+        'modified': do_get_updated_files('MODIFY'),
+    }
+
+
+def get_cloud_updated_files(diffstat):
+    """
+    This returns file-pathes which are changed in the commit from its diffstat
+    on the BitBucket Cloud.
+    """
+    def do_get_updated_files(status, side):
+        return [x[side]['path'] for x in diffstat if x['status'] == status]
+
+    return {
+        'added': do_get_updated_files('added', 'new'),
+        'moved': do_get_updated_files('renamed', 'new'),
+        'deleted': do_get_updated_files('removed', 'old'),
+        'modified': do_get_updated_files('modified', 'new'),
+    }
+
+
+def parse_cloud_date(date):
+    # the timezone of the date (e.g. '+00:00') is ignored as well as the BitBucket Server
+    return datetime.strptime(date[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def make_commit(commit_id, repository, branch, author, commit_time, msg, files):
+    """
+    This returns the commit information which is dispatched in the payload.
+    """
+    return {
+        'id': commit_id,
+        'repository': repository,
+        'branch': branch,
+        'author': author,
+        'time': commit_time.strftime(DATE_FORMAT),
+        'msg': msg,
+        'files': files,
+    }
+
+
+def parse_server_commit(commit, repository, branch, files):
+    """
+    This returns the commit information of the commit of the BitBucket Server API
+    (or the changeset of the webhook).
+    """
+    return make_commit(commit['id'], repository, branch, commit['author']['emailAddress'],
+                       datetime.fromtimestamp(commit['authorTimestamp'] / 1000),
+                       commit['message'], files)
+
+
+def parse_cloud_commit(commit, repository, branch, files):
+    """
+    This returns the commit information of the commit of the BitBucket Cloud API
+    (or the push of the webhook).
+    """
+    author = (commit['author'].get('user') or {}).get('username') or \
+        commit['author'].get('raw', 'Unknown')
+    return make_commit(commit['hash'], repository, branch, author,
+                       parse_cloud_date(commit['date']), commit['message'], files)
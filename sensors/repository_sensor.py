@@ -1,24 +1,543 @@
+import bisect
+import fnmatch
+import hashlib
 import json
-import stashy
+import random
+import re
+import socket
+import threading
+import time
+import uuid
 
-from pybitbucket.auth import BasicAuthenticator
-from pybitbucket.bitbucket import Client
-from pybitbucket.commit import Commit
-from pybitbucket.user import User
-
-from requests.exceptions import HTTPError
-
-from timeout_decorator import timeout
-from timeout_decorator.timeout_decorator import TimeoutError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, Timeout
+from sensor_metrics import Metrics
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
+from urllib.parse import urlsplit
 
 from st2reactor.sensor.base import PollingSensor
 
 
+def build_payloads(repository, branch, commits, change_types, max_commits=0, max_files=0,
+                   compact=False):
+    """
+    This generates the payloads of the new commits of the branch. The commits are split into
+    the numbered chunks which have 'max_commits' commits and 'max_files' changed files at most
+    (0 is unlimited), and the changed files of the commit are truncated when they exceed the
+    limit. Each commit only has its commit-id in the compact mode.
+    """
+    def truncate_files(files):
+        truncated = {}
+        rest = max_files
+        for t in change_types:
+            truncated[t] = files.get(t, [])[:rest]
+            rest -= len(truncated[t])
+        return truncated
+
+    chunks = []
+    (chunk, chunk_files) = ([], 0)
+    for commit in commits:
+        file_count = sum([len(x) for x in commit['files'].values()])
+        if max_files and file_count > max_files:
+            commit = dict(commit, files=truncate_files(commit['files']), files_truncated=True)
+            file_count = max_files
+
+        if chunk and ((max_commits and len(chunk) >= max_commits) or
+                      (max_files and chunk_files + file_count > max_files)):
+            chunks.append(chunk)
+            (chunk, chunk_files) = ([], 0)
+
+        chunk.append(commit)
+        chunk_files += file_count
+
+    if chunk:
+        chunks.append(chunk)
+
+    for (index, chunk) in enumerate(chunks, 1):
+        # Tally up the changed-files of the chunk (these are de-duplicated by the set)
+        changed_files = dict([(t, set()) for t in change_types])
+        for commit in chunk:
+            for (t, files) in commit['files'].items():
+                changed_files[t].update(files)
+
+        yield {
+            'repository': repository,
+            'branch': branch,
+            'commits': [{'id': x['id']} for x in chunk] if compact else chunk,
+            # The file informations which are changed in the added commits are set.
+            # This enables to make a more complex criteria in the Rule.
+            'changed_files': dict([(t, list(files)) for (t, files) in changed_files.items()]),
+            'chunk': index,
+            'chunks': len(chunks),
+        }
+
+
+class PathFilter(object):
+    """
+    This matches the changed files of the commits against the 'include' and the 'exclude'
+    globs of the target, which are compiled into one regular expression each. The commit is
+    watched when any of its changed files is included and isn't excluded (every file is
+    included when 'include' isn't specified).
+    """
+    def __init__(self, include=None, exclude=None):
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+
+    @classmethod
+    def create(cls, paths):
+        """
+        This returns the filter of the 'paths' of the target, or None when it's not specified.
+        """
+        paths = paths or {}
+        if not paths.get('include') and not paths.get('exclude'):
+            return None
+        return cls(paths.get('include'), paths.get('exclude'))
+
+    def match(self, files):
+        return any([self.match_path(x) for paths in files.values() for x in paths])
+
+    def match_path(self, path):
+        if self._exclude and self._exclude.match(path):
+            return False
+        return not self._include or bool(self._include.match(path))
+
+    def _compile(self, patterns):
+        if not patterns:
+            return None
+        if not isinstance(patterns, list):
+            raise ValueError('"paths.include" and "paths.exclude" must be lists of globs')
+        return re.compile('|'.join(['(?:%s)' % fnmatch.translate(x) for x in patterns]))
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter which applies the default timeout to every request that doesn't set it.
+    """
+    def __init__(self, timeout=None, *args, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache which evicts the least recently used entry when it's full,
+    and the entries which are older than the TTL seconds. The hits and the misses are
+    counted by the metrics when it's given.
+    """
+    def __init__(self, size, ttl, metrics=None):
+        self._size = size
+        self._ttl = ttl
+        self._metrics = metrics
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def get_or_load(self, key, loader):
+        """
+        This returns the cached value, or the value which is returned by the loader.
+        The loader is called only once even if the same key is requested concurrently.
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                return value
+
+            loading = self._loading.get(key)
+            if loading:
+                is_loader = False
+            else:
+                loading = self._loading[key] = Future()
+                is_loader = True
+
+        if not is_loader:
+            return loading.result()
+
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set_exception(e)
+            raise
+
+        with self._lock:
+            self._set(key, value)
+            self._loading.pop(key, None)
+        loading.set_result(value)
+
+        return value
+
+    def _get(self, key):
+        value = self._lookup(key)
+        if self._metrics:
+            self._metrics.inc('cache.miss' if value is None else 'cache.hit')
+        return value
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        (value, expires_at) = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value):
+        self._entries[key] = (value, time.time() + self._ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+
+class EventIdAllocator(object):
+    """
+    This hands out unique event-ids from a block of ids which is leased from the datastore,
+    so that the datastore isn't accessed every dispatching event.
+
+    The datastore doesn't provide compare-and-set operation, so the sensors never lease ids
+    from one shared counter. Each instance has its own counter which is keyed by its name,
+    and its event-ids are prefixed with the name (e.g. 'node1.repository:25').
+    """
+    def __init__(self, sensor_service, name, instance, block_size, logger):
+        self._sensor_service = sensor_service
+        self._name = '%s.%s' % (name, instance)
+        self._instance = instance
+        self._block_size = block_size
+        self._logger = logger
+        self._lock = threading.Lock()
+
+        # the range of the leased ids which are not handed out yet [next_id, end_id)
+        self._next_id = self._end_id = 0
+
+    def allocate(self):
+        with self._lock:
+            if self._next_id >= self._end_id:
+                self._lease()
+
+            event_id = '%s:%d' % (self._instance, self._next_id)
+            self._next_id += 1
+            return event_id
+
+    def release(self):
+        """
+        This returns the unused ids to the counter of this instance in the datastore.
+        """
+        with self._lock:
+            if self._next_id >= self._end_id:
+                return
+
+            self._set(self._next_id)
+            self._next_id = self._end_id = 0
+
+    def _lease(self):
+        next_id = self._get()
+        self._set(next_id + self._block_size)
+        (self._next_id, self._end_id) = (next_id, next_id + self._block_size)
+
+    def _get(self):
+        value = self._sensor_service.get_value(name=self._name)
+        if not value:
+            return 1
+        return int(value)
+
+    def _set(self, next_id):
+        self._sensor_service.set_value(name=self._name, value=str(next_id))
+
+
+class DispatchedCommits(object):
+    """
+    This shares the commits which have been dispatched for each (repository, branch) between
+    the RepositorySensor and the WebhookSensor through the datastore, so that each commit is
+    dispatched only by the sensor which detects it first.
+
+    Each dispatched commit-id has its own key which expires after the TTL, then the sensors
+    never overwrite the commits which the other one has recorded meanwhile. The record of each
+    branch only has the range of the commits which have been dispatched without a gap.
+
+    The keys aren't local to the sensor class (which st2 namespaces by the class name), so
+    that both sensors read the same records.
+    """
+    KEY_PREFIX = 'bitbucket.dispatched.'
+    COMMIT_KEY_PREFIX = 'bitbucket.dispatched_commit.'
+    TTL = 86400
+
+    def __init__(self, sensor_service, ttl=TTL):
+        self._sensor_service = sensor_service
+        self._ttl = ttl
+
+    def load(self):
+        """
+        This returns the records of all branches by one request to the datastore.
+        """
+        records = {}
+        for kvp in self._sensor_service.list_values(local=False, prefix=self.KEY_PREFIX) or []:
+            record = json.loads(kvp.value)
+            records[(record['repository'], record['branch'])] = record
+        return records
+
+    def get(self, repository, branch):
+        value = self._sensor_service.get_value(name=self._key(repository, branch), local=False)
+        if not value:
+            return {'repository': repository, 'branch': branch, 'base': None, 'head': None}
+        return json.loads(value)
+
+    def get_commits(self, repository, branch):
+        """
+        This returns the commit-ids of the branch which have been dispatched within the TTL.
+        """
+        prefix = self._commit_key(repository, branch, '')
+        expired_at = time.time() - self._ttl
+
+        # the commit which is dispatched before the TTL is ignored as well when the datastore
+        # doesn't expire the keys
+        return set([x.name[len(prefix):]
+                    for x in self._sensor_service.list_values(local=False, prefix=prefix) or []
+                    if x.name.startswith(prefix) and float(x.value) >= expired_at])
+
+    def add(self, repository, branch, commit_ids, base=None, head=None):
+        """
+        This records the dispatched commit-ids with the range of the commits (base, head]
+        which have been dispatched without a gap. The range is cleared when head is None,
+        and it's extended when the base is the head of the recorded one.
+        """
+        for commit_id in commit_ids:
+            self._set_value(self._commit_key(repository, branch, commit_id), str(time.time()),
+                            ttl=self._ttl)
+
+        # The range which the other sensor has extended meanwhile may be lost, then the
+        # RepositorySensor only walks the branch again.
+        record = self.get(repository, branch)
+        if head is None:
+            (record['base'], record['head']) = (None, None)
+        elif record['head'] is None or record['head'] != base:
+            (record['base'], record['head']) = (base, head)
+        else:
+            record['head'] = head
+
+        self._set_value(self._key(repository, branch), json.dumps(record))
+
+    def _set_value(self, name, value, ttl=None):
+        try:
+            self._sensor_service.set_value(name=name, value=value, ttl=ttl, local=False)
+        except ValueError:
+            # the datastore which doesn't support the TTL (e.g. the one of st2tests)
+            self._sensor_service.set_value(name=name, value=value, local=False)
+
+    def _key(self, repository, branch):
+        return '%s%s:%s' % (self.KEY_PREFIX, repository, branch)
+
+    def _commit_key(self, repository, branch, commit_id):
+        return '%s%s:%s:%s' % (self.COMMIT_KEY_PREFIX, repository, branch, commit_id)
+
+
+class ShardCoordinator(object):
+    """
+    This splits the repositories between the RepositorySensor instances which share the
+    datastore. The live instances are tracked by their heartbeats, and each repository is
+    assigned to one of them by the consistent hashing, so that only the repositories of the
+    instance which joins or leaves are moved.
+
+    An instance polls the repository only while it holds the lease of the repository. The lease
+    is taken over after the previous owner releases it or its heartbeat expires, so that each
+    repository is polled by one instance at a time.
+    """
+    MEMBER_KEY_PREFIX = 'shard_member:'
+    LEASE_KEY_PREFIX = 'shard_lease:'
+
+    def __init__(self, sensor_service, ttl, vnodes, logger):
+        self._sensor_service = sensor_service
+        self._ttl = ttl
+        self._vnodes = vnodes
+        self._logger = logger
+
+        # identifies this instance in the datastore
+        self.member_id = uuid.uuid4().hex
+
+        self._members = []
+        self._ring = []
+        self._heartbeat_at = 0
+
+        # The heartbeat is stamped with the counter of the member instead of its clock. The
+        # last counter of each member is kept with the time when this instance saw it changed.
+        self._beat = 0
+        self._seen = {}
+
+        # the repositories which are leased by this instance
+        self._leases = set()
+
+    def heartbeat(self):
+        """
+        This refreshes the heartbeat of this instance and the live members of the shards,
+        and returns whether the members are changed.
+        """
+        now = time.time()
+        self._beat += 1
+        self._set(self.MEMBER_KEY_PREFIX + self.member_id,
+                  {'member': self.member_id, 'beat': self._beat})
+        self._heartbeat_at = now
+
+        # The heartbeat of the other member expires when its counter isn't changed for the TTL
+        # by the clock of this instance, so the clocks of the nodes aren't compared.
+        members = set([self.member_id])
+        seen = {}
+        for record in self._list(self.MEMBER_KEY_PREFIX):
+            if record['member'] == self.member_id:
+                continue
+
+            (beat, seen_at) = self._seen.get(record['member'], (record.get('beat'), now))
+            if record.get('beat') != beat:
+                seen_at = now
+
+            if now - seen_at <= self._ttl:
+                members.add(record['member'])
+                seen[record['member']] = (record.get('beat'), seen_at)
+            else:
+                # the heartbeat of the dead instance is removed by any survivor
+                self._logger.info('The sensor instance(%s) has left the shards' %
+                                  record['member'])
+                self._delete(self.MEMBER_KEY_PREFIX + record['member'])
+        self._seen = seen
+
+        if sorted(members) == self._members:
+            return False
+
+        self._members = sorted(members)
+        self._ring = sorted([(self._hash('%s:%d' % (x, i)), x)
+                             for x in self._members for i in range(self._vnodes)])
+        self._logger.info('The repositories are split between %d sensor instances' %
+                          len(self._members))
+        return True
+
+    def get_owner(self, repository):
+        """
+        This returns the member which the repository is assigned to on the hash ring.
+        """
+        index = bisect.bisect_left(self._ring, (self._hash(repository),))
+        return self._ring[index % len(self._ring)][1]
+
+    def acquire(self, repositories):
+        """
+        This leases the repositories which are assigned to this instance, and releases the
+        leased ones which are assigned to others. This returns the leased repositories and
+        the newly leased ones.
+        """
+        assigned = set([x for x in repositories if self.get_owner(x) == self.member_id])
+        leases = self._load_leases()
+
+        for repository in self._leases - assigned:
+            self._logger.info('The repository(%s) is handed over to other sensor instance' %
+                              repository)
+            if leases.pop(repository, None) == self.member_id:
+                self._delete(self.LEASE_KEY_PREFIX + repository)
+
+        # The lease of the live member is never taken over. It's released by the owner when
+        # the owner finds the repository is assigned to other one.
+        candidates = [x for x in assigned if leases.get(x) in (None, self.member_id) or
+                      leases[x] not in self._members]
+        for repository in candidates:
+            if leases.get(repository) != self.member_id:
+                self._set(self.LEASE_KEY_PREFIX + repository,
+                          {'repository': repository, 'owner': self.member_id})
+
+        # The datastore doesn't provide compare-and-set operation, so the leases are confirmed
+        # by reading them back (the ones which other instance leased meanwhile are given up).
+        leases = self._load_leases()
+        leased = set([x for x in candidates if leases.get(x) == self.member_id])
+
+        acquired = leased - self._leases
+        self._leases = leased
+        return (leased, acquired)
+
+    def confirm(self):
+        """
+        This returns the repositories which are still leased by this instance. Nothing is
+        returned when the heartbeat of this instance has expired during the polling, because
+        the others may have taken over its repositories.
+        """
+        if time.time() > self._heartbeat_at + self._ttl:
+            self._logger.warning('The polling took longer than the heartbeat TTL (%ss), its '
+                                 'results are discarded' % self._ttl)
+            self._leases = set()
+            return self._leases
+
+        leases = self._load_leases()
+        self._leases = set([x for x in self._leases if leases.get(x) == self.member_id])
+        return self._leases
+
+    def leave(self):
+        """
+        This releases all leases and the heartbeat, then the others take over the repositories
+        of this instance at their next polling.
+        """
+        leases = self._load_leases()
+        for repository in self._leases:
+            if leases.get(repository) == self.member_id:
+                self._delete(self.LEASE_KEY_PREFIX + repository)
+        self._delete(self.MEMBER_KEY_PREFIX + self.member_id)
+        self._leases = set()
+
+    def _load_leases(self):
+        return dict([(x['repository'], x['owner']) for x in self._list(self.LEASE_KEY_PREFIX)])
+
+    def _hash(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def _list(self, prefix):
+        return [json.loads(x.value) for x in self._sensor_service.list_values(prefix=prefix) or []]
+
+    def _set(self, name, value):
+        self._sensor_service.set_value(name=name, value=json.dumps(value))
+
+    def _delete(self, name):
+        self._sensor_service.delete_value(name=name)
+
+
 class RepositorySensor(PollingSensor):
     DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
     TIMEOUT_SECONDS = 20
+    CONCURRENCY = 4
+    BATCH_SIZE = 200
+    EVENT_ID_BLOCK_SIZE = 100
+    CACHE_SIZE = 1000
+    CACHE_TTL = 3600
+    POOL_CONNECTIONS = 10
+    POOL_MAXSIZE = 10
+    MAX_POLL_INTERVAL = 0
+    POLL_JITTER = 0.1
+    DISCOVERY_INTERVAL = 3600
+    SHARD_VNODES = 64
+    MAX_COMMITS_PER_EVENT = 0
+    MAX_FILES_PER_EVENT = 0
+    COMPACT_PAYLOAD = False
+    METRICS_PREFIX = 'bitbucket'
+    CHANGE_TYPES = ['added', 'moved', 'deleted', 'modified']
+    REF_EVENT_TYPES = ['tag', 'branch_created', 'branch_deleted', 'pull_request']
+    REF_EVENTS = []
+
+    # The datastore key prefix to persist the last checked commits of each repository
+    LAST_COMMIT_KEY_PREFIX = 'last_commit:'
 
     def __init__(self, sensor_service, config=None, poll_interval=None):
         super(RepositorySensor, self).__init__(sensor_service=sensor_service,
@@ -28,6 +547,24 @@ class RepositorySensor(PollingSensor):
         self._logger = self._sensor_service.get_logger(__name__)
         self.last_commit = {}
 
+        # The checkpoints of the unfinished commit walks of each (repository, branch)
+        self.cursors = {}
+
+        # The new commits of each (repository, branch) which are buffered in the coalescing
+        # window of the target
+        self.pending_commits = {}
+
+        # The snapshots of the refs (branches, tags and pull-requests) of each repository
+        self.refs = {}
+
+        # The ETag and the branch tips of the last response of each repository
+        self._branch_tips = {}
+
+        # The branch tips of each repository which are fetched in this polling
+        self._observed_tips = {}
+
+        self._engine = None
+
     def setup(self):
         sensor_config = self._config.get('sensor', None)
         if not sensor_config:
@@ -44,180 +581,257 @@ class RepositorySensor(PollingSensor):
         if not all([len(x['repository'].split('/')) == 2 for x in self.targets]):
             raise ValueError('Invalid repository name is specified in the "targets" parameter')
 
+        if any([self._is_pattern(x['repository'].split('/')[0]) for x in self.targets]):
+            raise ValueError('Wildcard is only allowed in the repository name of "targets" '
+                             '(e.g. "PROJ/*")')
+
+        # The new commits of the target which has the coalescing window are merged into one
+        # event when the window closes or the buffered commits reach the 'max_commits'.
+        for target in self.targets:
+            coalesce = target.get('coalesce') or {}
+            if coalesce and (coalesce.get('window', 0) <= 0 or
+                             coalesce.get('max_commits', 0) < 0):
+                raise ValueError('"coalesce.window" must be greater than 0 and '
+                                 '"coalesce.max_commits" must not be negative in "targets"')
+
+        # The paths of each target are compiled once, then the commits which don't change
+        # any watched path are dropped before dispatching.
+        self._pattern_filters = [PathFilter.create(x.get('paths')) for x in self.targets]
+
+        # The targets may have wildcards in the repository name (e.g. 'PROJ/*') and the branches
+        # (e.g. 'release/*'). The repositories of each project are discovered in the slower
+        # cadence of 'discovery_interval' seconds, and the branches are matched against the
+        # branch tips which are fetched every polling.
+        self._target_patterns = self.targets
+        self._repositories = {}
+        self._discovered_at = None
+        self.DISCOVERY_INTERVAL = sensor_config.get('discovery_interval', self.DISCOVERY_INTERVAL)
+
         self.TIMEOUT_SECONDS = sensor_config.get('timeout', self.TIMEOUT_SECONDS)
 
+        self.CONCURRENCY = sensor_config.get('concurrency', self.CONCURRENCY)
+        if self.CONCURRENCY < 1:
+            raise ValueError('"concurrency" parameter in the "sensor" must be greater than 0')
+
+        self.BATCH_SIZE = sensor_config.get('batch_size', self.BATCH_SIZE)
+        if self.BATCH_SIZE < 1:
+            raise ValueError('"batch_size" parameter in the "sensor" must be greater than 0')
+
+        self.EVENT_ID_BLOCK_SIZE = sensor_config.get('event_id_block_size',
+                                                     self.EVENT_ID_BLOCK_SIZE)
+        if self.EVENT_ID_BLOCK_SIZE < 1:
+            raise ValueError('"event_id_block_size" parameter in the "sensor" '
+                             'must be greater than 0')
+
+        # identifies this sensor instance in the event-ids (the host name by default)
+        self.INSTANCE_NAME = sensor_config.get('instance_name') or socket.gethostname()
+
+        # The large pushes are split into the numbered chunks of the events, whose commits and
+        # changed files are limited (0 is unlimited). The commits only have their commit-ids in
+        # the compact mode, then the consumers fetch their details on demand.
+        self.MAX_COMMITS_PER_EVENT = sensor_config.get('max_commits_per_event',
+                                                       self.MAX_COMMITS_PER_EVENT)
+        self.MAX_FILES_PER_EVENT = sensor_config.get('max_files_per_event',
+                                                     self.MAX_FILES_PER_EVENT)
+        if self.MAX_COMMITS_PER_EVENT < 0 or self.MAX_FILES_PER_EVENT < 0:
+            raise ValueError('"max_commits_per_event" and "max_files_per_event" parameters in '
+                             'the "sensor" must not be negative')
+        self.COMPACT_PAYLOAD = sensor_config.get('compact_payload', self.COMPACT_PAYLOAD)
+
+        # The changes of the refs are dispatched as the events of the 'ref_events' types, which
+        # are detected by diffing the snapshot of the refs of each repository against the last
+        # one. The tags and the pull-requests are requested only when their events are enabled.
+        self.REF_EVENTS = sensor_config.get('ref_events', self.REF_EVENTS)
+        if set(self.REF_EVENTS) - set(self.REF_EVENT_TYPES):
+            raise ValueError('"ref_events" parameter in the "sensor" must be in %s' %
+                             self.REF_EVENT_TYPES)
+
+        # The idle repositories are polled less frequently up to the 'max_poll_interval' seconds.
+        # Their poll timings are spread by the 'poll_jitter' ratio of the interval, which only
+        # chooses the polling (not the time within it) that checks each repository.
+        if sensor_config.get('poll_interval'):
+            self.set_poll_interval(sensor_config['poll_interval'])
+        self.MAX_POLL_INTERVAL = sensor_config.get('max_poll_interval', self.MAX_POLL_INTERVAL)
+        self.POLL_JITTER = sensor_config.get('poll_jitter', self.POLL_JITTER)
+        self._schedule = {}
+
+        # The repositories are split between the sensor instances which share the datastore
+        # when the sharding is enabled. The instance which stops heartbeating for 'shard_ttl'
+        # seconds is regarded as dead, then its repositories are taken over by the others.
+        self._shard = None
+        if sensor_config.get('sharding'):
+            shard_ttl = sensor_config.get('shard_ttl', self.get_poll_interval() * 3)
+            if shard_ttl <= self.get_poll_interval():
+                raise ValueError('"shard_ttl" parameter in the "sensor" must be greater than '
+                                 'the poll interval')
+            self._shard = ShardCoordinator(self._sensor_service, shard_ttl,
+                                           sensor_config.get('shard_vnodes', self.SHARD_VNODES),
+                                           self._logger)
+
+        # allocator which hands out unique ids of the dispatching events
+        self._event_ids = EventIdAllocator(self._sensor_service, self._trigger_ref,
+                                           '%s.repository' % self.INSTANCE_NAME,
+                                           self.EVENT_ID_BLOCK_SIZE, self._logger)
+
+        # The commits which are dispatched by the WebhookSensor are shared through the datastore
+        # when it's configured, then polling reconciles the commits which the webhook missed.
+        self._dispatched = None
+        if sensor_config.get('webhook'):
+            self._dispatched = DispatchedCommits(self._sensor_service)
+
+        # The metrics of each polling cycle are sent to the metrics driver of StackStorm, and
+        # the profile of each cycle is dumped into the 'metrics.profile_dir' when it's set.
+        metrics_config = self._config.get('metrics') or {}
+        self._metrics = Metrics('%s.sensor' % metrics_config.get('prefix', self.METRICS_PREFIX),
+                                self._logger, metrics_config.get('profile_dir'))
+
+        # worker pool which checks updated commits of each (repository, branch)
+        self._executor = ThreadPoolExecutor(max_workers=self.CONCURRENCY)
+
+        # worker pool which fetches the detail of each commit (e.g. changed files)
+        self._fetch_executor = ThreadPoolExecutor(max_workers=self.CONCURRENCY)
+
+        # The changed files of each commit-id are cached over branches and pollings
+        self.CACHE_SIZE = sensor_config.get('cache_size', self.CACHE_SIZE)
+        self.CACHE_TTL = sensor_config.get('cache_ttl', self.CACHE_TTL)
+        self._changes_cache = LRUCache(self.CACHE_SIZE, self.CACHE_TTL, self._metrics)
+
         # initialize global parameter
         self.commits = {}
 
+        # The last checked commits which are saved before restarting are restored, then
+        # the commits pushed in the meantime are checked in the following pollings.
+        self._load_last_commit()
+
+        # Only the backend of the specified BitBucket type is imported, so that the client
+        # library of the other one (stashy or pybitbucket) isn't loaded.
         self.service_type = sensor_config.get('bitbucket_type')
         if self.service_type == 'server':
-            # initialization for BitBucket Server
-            self.client = stashy.connect(sensor_config.get('bitbucket_server_url'),
-                                         self._config.get('username'),
-                                         self._config.get('password'))
-
-            self._init_server_last_commit()
+            from server_backend import ServerBackend
+            self._backend = ServerBackend(self)
         elif self.service_type == 'cloud':
-            # initialization for BitBucket Cloud
-            self.client = Client(BasicAuthenticator(
-                self._config.get('username'),
-                self._config.get('password'),
-                self._config.get('email'),
-            ))
-            self._init_cloud_last_commit()
+            from cloud_backend import CloudBackend
+            self._backend = CloudBackend(self)
         else:
             raise ValueError('specified bitbucket type (%s) is not supported' % self.service_type)
-        self._increment_event_id()
+        self.client = self._backend.client
+
+        self._discover_targets()
+        if not self._shard:
+            # the repositories of each instance are initialized when they're leased
+            self._init_last_commit(self.targets)
+            self._save_last_commit(self.last_commit.keys())
+
+        # The asyncio engine checks the branches by non-blocking HTTP requests on one event loop.
+        # This is imported only when it's specified because it depends on the aiohttp.
+        engine = sensor_config.get('engine', 'thread')
+        if engine == 'async':
+            from async_engine import AsyncEngine
+            self._engine = AsyncEngine(self)
+        elif engine != 'thread':
+            raise ValueError('specified engine (%s) is not supported' % engine)
 
         self._logger.info("It's ready to monitor events.")
 
     def poll(self):
-        @timeout(self.TIMEOUT_SECONDS)
-        def get_server_updated_commits():
-            def get_commit_info(repo, commit_id):
-                """
-                This returns detail information associated with the specific commit-id
-                to get the changed files in the commit.
-                """
-                res = repo._client.get(repo.url('/commits/{}/changes'.format(commit_id)))
-                return json.loads(res.content)
-
-            def get_updated_files(commit):
-                """
-                This returns file-pathes which are changed in this commit.
-                """
-                def do_get_updated_files(req_type):
-                    return [x['path']['toString'] for x in commit['values']
-                            if x['type'] == req_type]
-
-                return {
-                    'added': do_get_updated_files('ADD'),
-                    'moved': do_get_updated_files('MOVE'),
-                    'deleted': do_get_updated_files('DELETE'),
-                    'modified': do_get_updated_files('MODIFY'),
-                }
-
-            for target in self.targets:
-                (proj, repo) = target['repository'].split('/')
-
-                # The case of initialized processing was failed
-                if not target['repository'] in self.last_commit:
-                    self._logger.warning('Initialization processing might be failed')
-                    self.last_commit[target['repository']] = {}
-
-                for branch in target['branches']:
-                    # The case that last_commit for branch was blank by some reasons
-                    if branch not in self.last_commit[target['repository']]:
-                        self._logger.info("The branch(%s) isn't initialized" % (branch))
-                        self.last_commit[target['repository']][branch] = datetime.now()
-
-                    try:
-                        robj = self.client.projects[proj].repos[repo]
-                        for commit in robj.commits(branch):
-                            commit_time = datetime.fromtimestamp(commit['authorTimestamp'] / 1000)
-                            if commit_time <= self.last_commit[target['repository']][branch]:
-                                break
-
-                            # append new commit
-                            self.new_commits.append({
-                                'repository': target['repository'],
-                                'branch': branch,
-                                'author': commit['author']['emailAddress'],
-                                'time': commit_time.strftime(self.DATE_FORMAT),
-                                'msg': commit['message'],
-                                'files': get_updated_files(get_commit_info(robj, commit['id'])),
-                            })
-                    except stashy.errors.NotFoundException as e:
-                        self._logger.warning("branch(%s) doesn't exist in the repository(%s) [%s]" %
-                                             (branch, target['repository'], e))
-
-        @timeout(self.TIMEOUT_SECONDS)
-        def get_cloud_updated_commits():
-            for target in self.targets:
-                (proj, repo) = target['repository'].split('/')
-
-                # The case of initialized processing was failed
-                if not target['repository'] in self.last_commit:
-                    self._logger.warning('Initialization processing might be failed')
-                    self.last_commit[target['repository']] = {}
-
-                for branch in target['branches']:
-                    # The case that last_commit for branch was blank by some reasons
-                    if branch not in self.last_commit[target['repository']]:
-                        self._logger.info("The branch(%s) isn't initialized" % (branch))
-                        self.last_commit[target['repository']][branch] = datetime.now()
-
-                    try:
-                        for commit in Commit.find_commits_in_repository(username=proj,
-                                                                        repository_name=repo,
-                                                                        branch=branch,
-                                                                        client=self.client):
-
-                            commit_time = datetime.strptime(commit.date, "%Y-%m-%dT%H:%M:%SZ")
-                            if commit_time <= self.last_commit[target['repository']][branch]:
-                                break
-
-                            author = 'Unknown'
-                            if isinstance(commit.author, User):
-                                author = commit.author.username
-                            elif isinstance(commit.author, dict):
-                                author = commit.author['raw']
-
-                            # append new commit
-                            self.new_commits.append({
-                                'repository': target['repository'],
-                                'branch': branch,
-                                'author': author,
-                                'time': commit_time.strftime(self.DATE_FORMAT),
-                                'msg': commit.message,
-                                'files': {},  # XXX: This is not implemented, yet.
-                            })
-                    except (ValueError, HTTPError):
-                        self._logger.warning("branch(%s) doesn't exist in the repository(%s)" %
-                                             (branch, target['repository']))
-
-        # On the assumption the case that the processing is aborted by timeout,
-        # we need to prepare the variable to save update information (may be inchoate).
-        #
-        # This variable is cleared at the outset of each polling processing.
-        self.new_commits = []
+        with self._metrics.cycle():
+            if time.time() - self._discovered_at >= self.DISCOVERY_INTERVAL:
+                with self._metrics.timer('discovery'):
+                    self._discover_targets()
 
-        try:
-            if self.service_type == 'server':
-                get_server_updated_commits()
-            elif self.service_type == 'cloud':
-                get_cloud_updated_commits()
-        except TimeoutError:
-            self._logger.info('checking processing is timedout')
+            owned_targets = self._assign_shard() if self._shard else self.targets
+
+            now = time.time()
+            targets = [x for x in owned_targets if self._is_scheduled(x['repository'], now)]
+
+            dispatched = self._dispatched.load() if self._dispatched else {}
+            updated_repositories = set()
+
+            # The new commits of each branch are checked by the engine
+            with self._metrics.timer('check'):
+                if self._engine:
+                    results = self._engine.check_targets(targets, dispatched,
+                                                         updated_repositories)
+                else:
+                    results = self._check_targets(targets, dispatched, updated_repositories)
 
-        if self.new_commits:
-            # update last_commit instance variable
-            self._update_last_commit()
+            if self._shard:
+                # The repositories which other instance has taken over meanwhile are left to it,
+                # which walks them from the last checked commits saved by this instance.
+                leased = self._shard.confirm()
+                owned_targets = [x for x in owned_targets if x['repository'] in leased]
+                results = [x for x in results if x[0] in leased]
+                updated_repositories &= leased
+
+            # This variable is cleared at the outset of each polling processing.
+            self.new_commits = []
+            for (repository, branch, commits, cursor) in results:
+                if commits:
+                    self._metrics.record_commits(repository, len(commits))
+
+                if self._dispatched and commits:
+                    # the commits which have been dispatched by the WebhookSensor are dropped
+                    dispatched_ids = self._dispatched.get_commits(repository, branch)
+                    self.new_commits += [x for x in commits if x['id'] not in dispatched_ids]
+                else:
+                    self.new_commits += commits
+
+            # the changes of the refs are detected in the repositories which are polled
+            (ref_snapshots, ref_events) = ({}, [])
+            if self.REF_EVENTS:
+                owned = set([x['repository'] for x in owned_targets])
+                with self._metrics.timer('refs'):
+                    (ref_snapshots, ref_events) = self._check_refs(
+                        [x for x in targets if x['repository'] in owned])
+
+            # the commits which don't change any watched path of the target are dropped
+            self.new_commits = self._filter_commits(self.new_commits)
+
+            # The last checked commits are advanced after all stages which may fail, then
+            # the commits are walked again at the next polling when any of them fails.
+            for (repository, branch, commits, cursor) in results:
+                if self._update_last_commit(repository, branch, cursor):
+                    updated_repositories.add(repository)
+
+                if self._dispatched and commits:
+                    head = cursor['head'] if cursor and cursor['offset'] is None else None
+                    self._dispatched.add(repository, branch, [x['id'] for x in commits],
+                                         head, head)
+
+            for (repository, snapshot) in ref_snapshots.items():
+                if snapshot != self.refs.get(repository, {}):
+                    self.refs[repository] = snapshot
+                    updated_repositories.add(repository)
+
+            # The commits of the branches in the coalescing windows are held over, which are
+            # persisted with the last checked commits.
+            ready_commits = self._coalesce_commits(self.new_commits, owned_targets,
+                                                   updated_repositories)
+
+            # persist the last checked commits of the updated repositories at once
+            self._save_last_commit(updated_repositories)
+
+            # The repositories which have been updated are polled in the shortest interval
+            for target in targets:
+                self._reschedule(target['repository'],
+                                 target['repository'] in updated_repositories, now)
 
             # dispatch new commit informatoins every repository/branch
-            for (repo, branch) in set([(x['repository'], x['branch']) for x in self.new_commits]):
-                payload = {
-                    'repository': repo,
-                    'branch': branch,
-                    'commits': [x for x in self.new_commits if (x['repository'] == repo and
-                                                                x['branch'] == branch)],
-                    # The file informations which are changed in the added commits are set.
-                    'changed_files': {'added': [], 'moved': [], 'deleted': [], 'modified': []},
-                }
-
-                # This processing enables to make a more complex criteria in the Rule
-                for t in ['added', 'moved', 'deleted', 'modified']:
-                    # Tally up the all changed-files
-                    payload['changed_files'][t] += sum([x['files'][t] for x in self.new_commits
-                                                        if t in x['files']], [])
-
-                    # De-duplicate each changed-files
-                    payload['changed_files'][t] = list(set(payload['changed_files'][t]))
-
-                self._dispatch_trigger('commit', payload)
+            with self._metrics.timer('dispatch'):
+                for payload in self._group_commits(ready_commits):
+                    self._dispatch_trigger('commit', payload)
+
+                for (event_type, payload) in ref_events:
+                    self._dispatch_trigger(event_type, payload)
 
     def cleanup(self):
-        pass
+        if self._engine:
+            self._engine.close()
+        self._executor.shutdown(wait=False)
+        self._fetch_executor.shutdown(wait=False)
+        self._event_ids.release()
+        if self._shard:
+            self._shard.leave()
 
     def add_trigger(self, trigger):
         pass
@@ -228,85 +842,663 @@ class RepositorySensor(PollingSensor):
     def remove_trigger(self, trigger):
         pass
 
-    def _poll_bitbucket_server(self):
-        pass
+    def _check_targets(self, targets, dispatched, updated_repositories):
+        """
+        This checks the new commits of the branches in the targets on the worker pool, and
+        returns them with the cursor of the commit walk of each (repository, branch).
+        """
+        def walk(repository, branch):
+            with self._metrics.walk_timer(repository):
+                return self._get_updated_commits(repository, branch)
 
-    def _poll_bitbucket_cloud(self):
-        pass
+        # The jobs on the worker pool are profiled when the profiling is enabled
+        get_branch_tips = self._metrics.profiled(self._backend.get_branch_tips)
+        walk = self._metrics.profiled(walk)
 
-    def _dispatch_trigger(self, event_type, payload):
-        data = {
-            'id': self._get_event_id(),
-            'created_at': datetime.now().strftime(self.DATE_FORMAT),
-            'type': event_type,
-            'payload': payload,
-        }
-        self._increment_event_id()
+        # The tips of all branches in each repository are fetched by one request, so that
+        # only the branches which have been moved since the last polling are walked.
+        tips_futures = [(target, self._executor.submit(get_branch_tips, target['repository']))
+                        for target in targets]
 
-        self._sensor_service.dispatch(trigger=self._trigger_ref, payload=data)
+        # Each (repository, branch) is checked as an individual job on the worker pool.
+        # Every job has its own deadline, so that one slow repository doesn't starve the rest.
+        futures = []
+        for (target, tips_future) in tips_futures:
+            try:
+                tips = tips_future.result()
+            except Exception as e:
+                # this repository is checked again at the next polling
+                self._logger.warning('Failed to check the repository(%s) [%s]' %
+                                     (target['repository'], e))
+                continue
 
-    # Returns unique id for the dispatching events
-    def _get_event_id(self):
-        ret_id = self._sensor_service.get_value(name=self._trigger_ref)
-        if not ret_id:
-            return 1
-        return ret_id
+            for branch in self._select_branches(target, tips, dispatched, updated_repositories):
+                futures.append((target['repository'], branch,
+                                self._executor.submit(walk, target['repository'], branch)))
 
-    # Increments event id of datastore
-    def _increment_event_id(self):
-        self._sensor_service.set_value(name=self._trigger_ref,
-                                       value=int(self._get_event_id()) + 1)
+        results = []
+        for (repository, branch, future) in futures:
+            try:
+                results.append((repository, branch) + future.result())
+            except Exception as e:
+                results.append(self._get_failed_result(repository, branch, e))
 
-    # initialize last commit for each branches
-    def _init_server_last_commit(self):
-        def _last_ctime(project, repository, branch):
-            commits = self.client.projects[project].repos[repository].commits(branch)
-            last_commit = next(commits)
+        return results
 
-            if last_commit:
-                return datetime.fromtimestamp(last_commit['authorTimestamp'] / 1000)
-            else:
-                return datetime.strptime('1900-01-01 00:00:00', self.DATE_FORMAT)
+    def _get_failed_result(self, repository, branch, error):
+        """
+        This returns the result of the branch whose check is failed by an unexpected error
+        (e.g. the server error of BitBucket), then the cursor of the branch is kept as it is,
+        so that the branch is checked again from there at the next polling.
+        """
+        self._metrics.inc('errors')
+        self._logger.warning('Failed to check the branch(%s) in the repository(%s) [%s]' %
+                             (branch, repository, error))
+        return (repository, branch, [], self.cursors.get(repository, {}).get(branch))
 
-        for target in self.targets:
-            (proj, repo) = target['repository'].split('/')
+    def _select_branches(self, target, tips, dispatched, updated_repositories):
+        """
+        This returns the branches of the target which should be walked in this polling.
+        """
+        if tips is not None:
+            self._observed_tips[target['repository']] = tips
+
+        # The case of initialized processing was failed
+        if not target['repository'] in self.last_commit:
+            self._logger.warning('Initialization processing might be failed')
+            self.last_commit[target['repository']] = {}
+
+        branches = []
+        for branch in self._match_branches(target, tips):
+            # The case that last_commit for branch was blank by some reasons.
+            # Then the tip of the branch is regarded as the last checked commit.
+            if branch not in self.last_commit[target['repository']]:
+                self._logger.info("The branch(%s) isn't initialized" % (branch))
+                self.last_commit[target['repository']][branch] = None
+
+            if self._is_dispatched_by_webhook(target['repository'], branch, tips,
+                                              dispatched.get((target['repository'], branch))):
+                updated_repositories.add(target['repository'])
+                continue
+
+            if self._is_branch_moved(target['repository'], branch, tips):
+                branches.append(branch)
+
+        return branches
+
+    def _is_pattern(self, name):
+        return any([x in name for x in '*?['])
+
+    def _match_branches(self, target, tips):
+        """
+        This returns the branches of the target, whose wildcards are matched against
+        the branch tips of the repository.
+        """
+        branches = [x for x in target['branches'] if not self._is_pattern(x)]
+        patterns = [x for x in target['branches'] if self._is_pattern(x)]
+
+        for branch in sorted(tips or {}):
+            if branch not in branches and any([fnmatch.fnmatchcase(branch, x) for x in patterns]):
+                branches.append(branch)
 
-            for branch in target['branches']:
+        return branches
+
+    def _discover_targets(self):
+        """
+        This expands the targets whose repository name has wildcards into the repositories
+        which are listed from each project. The listed repositories are kept until the next
+        discovery, and the last ones are used when listing the project is failed.
+        """
+        targets = [x for x in self._target_patterns if not self._is_pattern(x['repository'])]
+        explicit_repositories = set([x['repository'].lower() for x in targets])
+
+        # the compiled path filter of each repository
+        path_filters = {}
+
+        discovered = OrderedDict()
+        listed_projects = set()
+        for (pattern, path_filter) in zip(self._target_patterns, self._pattern_filters):
+            (proj, repo_pattern) = pattern['repository'].split('/')
+            if not self._is_pattern(repo_pattern):
+                path_filters.setdefault(pattern['repository'], path_filter)
+                continue
+
+            # each project is listed once even if it's matched by multiple targets
+            if proj not in listed_projects:
+                listed_projects.add(proj)
                 try:
-                    self._set_last_commit_time(target['repository'],
-                                               branch,
-                                               _last_ctime(proj, repo, branch))
-                except stashy.errors.NotFoundException as e:
-                    self._logger.warning("branch(%s) doesn't exist in the repository(%s) [%s]" %
-                                         (branch, target['repository'], e))
+                    self._repositories[proj] = self._backend.list_repositories(proj)
+                except self._backend.NOT_FOUND_ERRORS + (RequestException,) as e:
+                    self._metrics.inc('errors')
+                    self._logger.warning('Failed to list repositories of the project(%s) [%s]' %
+                                         (proj, e))
+
+            for repo in self._repositories.get(proj, []):
+                repository = '%s/%s' % (proj, repo)
+                if repository.lower() in explicit_repositories or \
+                        not fnmatch.fnmatch(repo.lower(), repo_pattern.lower()):
+                    continue
+
+                # the discovered repository takes over the settings of the first target
+                if repository not in discovered:
+                    path_filters[repository] = path_filter
+                target = discovered.setdefault(repository,
+                                               dict(pattern, repository=repository, branches=[]))
+                target['branches'] += [x for x in pattern['branches']
+                                       if x not in target['branches']]
 
-    def _init_cloud_last_commit(self):
+        if discovered:
+            self._logger.debug('%d repositories are discovered' % len(discovered))
+
+        self.targets = targets + list(discovered.values())
+        self._path_filters = dict([(k, v) for (k, v) in path_filters.items() if v])
         for target in self.targets:
-            (proj, repo) = target['repository'].split('/')
+            self.last_commit.setdefault(target['repository'], {})
+
+        self._discovered_at = time.time()
+
+    def _assign_shard(self):
+        """
+        This returns the targets whose repositories are leased by this instance. The last
+        checked commits of the newly leased repositories are restored from the datastore,
+        because the previous owner has advanced them.
+        """
+        with self._metrics.timer('shard'):
+            self._shard.heartbeat()
+            (leased, acquired) = self._shard.acquire([x['repository'] for x in self.targets])
+
+        targets = [x for x in self.targets if x['repository'] in leased]
+        if acquired:
+            self._logger.info('%d repositories are taken over' % len(acquired))
+            for repository in acquired:
+                self._restore_last_commit(repository)
+                self._schedule.pop(repository, None)
+
+            self._init_last_commit([x for x in targets if x['repository'] in acquired])
+            self._save_last_commit(acquired)
+
+        self._metrics.gauge('shard.repositories', len(leased))
+        return targets
+
+    def _is_scheduled(self, repository, now):
+        """
+        This returns whether the repository should be polled at this time.
+        """
+        if self.MAX_POLL_INTERVAL <= (self.get_poll_interval() or 0):
+            # the adaptive scheduling is disabled, all repositories are polled every time
+            return True
+
+        if repository not in self._schedule:
+            # The first polling of each repository is spread within the shortest interval
+            # so that the requests don't fire in a burst.
+            interval = self.get_poll_interval()
+            self._schedule[repository] = {
+                'interval': interval,
+                'next': now + random.uniform(0, interval * self.POLL_JITTER),
+            }
+
+        # the repository which will be due before the next polling is polled at this time
+        return self._schedule[repository]['next'] < now + self.get_poll_interval() / 2
+
+    def _reschedule(self, repository, active, now):
+        """
+        This schedules the next polling of the repository. The interval is reset to the
+        shortest one when the repository is active, otherwise it's doubled up to the ceiling.
+        """
+        if repository not in self._schedule:
+            return
+
+        schedule = self._schedule[repository]
+        if active:
+            schedule['interval'] = self.get_poll_interval()
+        else:
+            schedule['interval'] = min(schedule['interval'] * 2, self.MAX_POLL_INTERVAL)
+
+        jitter = random.uniform(-self.POLL_JITTER, self.POLL_JITTER)
+        schedule['next'] = now + schedule['interval'] * (1 + jitter)
+
+    def _is_dispatched_by_webhook(self, repository, branch, tips, record):
+        """
+        This returns whether all commits from the last checked one to the tip of the branch
+        have been dispatched by the WebhookSensor. Then the last checked commit is advanced
+        to the tip without walking the branch.
+        """
+        if not record or not tips or branch not in tips:
+            return False
+
+        last_commit = self.last_commit[repository][branch]
+        if self.cursors.get(repository, {}).get(branch) or tips[branch] == last_commit:
+            return False
+
+        if (record['base'], record['head']) != (last_commit, tips[branch]):
+            return False
+
+        self._logger.debug('The commits of the branch(%s) in the repository(%s) have been '
+                           'dispatched by the webhook' % (branch, repository))
+        self.last_commit[repository][branch] = tips[branch]
+        self._dispatched.add(repository, branch, [], tips[branch], tips[branch])
+        return True
+
+    def _is_branch_moved(self, repository, branch, tips):
+        if tips is None:
+            # the tips couldn't be fetched, then the commits of the branch are walked
+            return True
+
+        if branch in self.cursors.get(repository, {}):
+            # the unfinished walk of the branch is resumed
+            return True
+
+        if branch not in tips:
+            self._logger.debug("branch(%s) doesn't exist in the repository(%s)" %
+                               (branch, repository))
+            return False
+
+        return tips[branch] != self.last_commit[repository][branch]
+
+    def _get_updated_commits(self, repository, branch):
+        """
+        This returns new commits of the branch in the repository and the cursor of the
+        commit walk.
+        """
+        try:
+            return self._walk_commits(repository, branch)
+        except self._backend.NOT_FOUND_ERRORS as e:
+            self._logger.warning("branch(%s) doesn't exist in the repository(%s) [%s]" %
+                                 (branch, repository, e))
+
+        # The branch or the last checked commit is missing (e.g. force pushed and
+        # garbage collected), then the branch is initialized again.
+        return ([], {'head': None, 'offset': None})
 
-            for branch in target['branches']:
-                commits = Commit.find_commits_in_repository(username=proj,
-                                                            repository_name=repo,
-                                                            branch=branch,
-                                                            client=self.client)
+    def _walk_commits(self, repository, branch):
+        """
+        This walks the commits in the range from the last checked commit (exclusive)
+        to the tip of the branch, so that only new commits are fetched from BitBucket.
+
+        The walk is pinned to the commit which was the tip when it started. When the deadline
+        of this branch is exceeded, the position of the walk is returned as a cursor, and the
+        next polling resumes the walk from there. Then the last checked commit isn't advanced
+        until the walk is finished, so that the commits which aren't reached yet are never
+        dropped.
+
+        The cursor also has the page of the next commit with the index of its first commit,
+        so that the resumed walk is started from that page instead of listing all pages
+        before it again.
+        """
+        started_at = time.time()
+        deadline = started_at + self.TIMEOUT_SECONDS
+        since = self.last_commit[repository][branch]
+        cursor = dict(self.cursors.get(repository, {}).get(branch) or {'head': None, 'offset': 0})
+        page = cursor.get('page') or [None, 0]
+        finished = False
+        fetching = []
+        parse_commit = self._metrics.profiled(self._backend.parse_commit)
+        try:
+            commits = self._backend.get_commits(repository, cursor['head'] or branch, since,
+                                                page[0])
+            for (index, (position, commit)) in enumerate(commits, page[1]):
+                if position != page[0]:
+                    page = [position, index]
+
+                if index < cursor['offset']:
+                    # this commit of the resumed page has been checked
+                    continue
+
+                cursor['page'] = page
+                self._check_deadline(deadline)
+
+                if len(fetching) >= self.BATCH_SIZE:
+                    # the rest of this walk is checked in the next polling
+                    break
+
+                if cursor['head'] is None:
+                    # pin the walk to the tip commit of the branch
+                    cursor['head'] = self._backend.get_commit_id(commit)
+
+                    if since is None:
+                        # the branch isn't initialized, the tip is regarded as checked
+                        finished = True
+                        break
+
+                # the detail of each commit is fetched in parallel with the walk
+                fetching.append((index, page, self._fetch_executor.submit(parse_commit,
+                                                                          repository, branch,
+                                                                          commit)))
+                cursor['offset'] = index + 1
+            else:
+                finished = True
+        except (TimeoutError, Timeout) as e:
+            self._metrics.inc('timeouts')
+            self._logger.info('checking processing is timedout (%s:%s) after %.3fs at the '
+                              'commit %d [%s]' % (repository, branch, time.time() - started_at,
+                                                  cursor['offset'], e))
+        except self._backend.NOT_FOUND_ERRORS as e:
+            if self._backend.is_not_found(e):
+                for (_, _, rest) in fetching:
+                    rest.cancel()
+                raise
+
+            # The other errors (e.g. the server is unavailable) don't reset the branch, and
+            # the walk is resumed at the next polling as well as the timeout.
+            self._metrics.inc('errors')
+            self._logger.warning('checking processing is failed (%s:%s) at the commit %d [%s]' %
+                                 (repository, branch, cursor['offset'], e))
+
+        new_commits = []
+        for (index, page, future) in fetching:
+            try:
+                # append new commit
+                new_commits.append(future.result())
+                continue
+            except (FutureTimeoutError, Timeout) as e:
+                self._metrics.inc('timeouts')
+                self._logger.info('fetching commit detail is timedout (%s:%s) after %.3fs [%s]' %
+                                  (repository, branch, time.time() - started_at, e))
+            except Exception as e:
+                # The detail of the commit which has been listed can't be fetched (e.g. the
+                # server error of the diffstat), which doesn't mean the branch is missing.
+                self._metrics.inc('errors')
+                self._logger.warning('fetching commit detail is failed (%s:%s) [%s]' %
+                                     (repository, branch, e))
+
+            # the walk is resumed from this commit at the next polling
+            for (_, _, rest) in fetching:
+                rest.cancel()
+            (cursor['offset'], cursor['page'], finished) = (index, page, False)
+            break
+
+        if cursor['head'] is None:
+            # there is no new commit in the branch (or nothing has been checked)
+            return (new_commits, None)
+
+        if not finished:
+            # the rest of this walk is resumed at the next polling
+            return (new_commits, cursor)
+
+        # The walk is finished. The last checked commit is advanced to its head.
+        return (new_commits, dict(cursor, offset=None))
+
+    # Raises TimeoutError when the deadline of the checking processing is exceeded
+    def _check_deadline(self, deadline):
+        if time.time() > deadline:
+            raise TimeoutError()
+
+    # Applies the connection pool settings and the timeout of the checking processing
+    # to the session, which keeps the connections alive over the pollings.
+    def _configure_session(self, session):
+        http_config = self._config.get('http') or {}
+        adapter = TimeoutHTTPAdapter(timeout=self.TIMEOUT_SECONDS,
+                                     pool_connections=http_config.get('pool_connections',
+                                                                      self.POOL_CONNECTIONS),
+                                     pool_maxsize=http_config.get('pool_maxsize',
+                                                                  self.POOL_MAXSIZE),
+                                     pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        # every API call is recorded by the kind of the endpoint with its latency
+        session.hooks['response'].append(self._record_response)
+
+    def _record_response(self, res, *args, **kwargs):
+        self._metrics.record_request(urlsplit(res.url).path, res.elapsed.total_seconds(),
+                                     res.status_code)
+
+    def _check_refs(self, targets):
+        """
+        This takes the snapshot of the refs of each repository on the worker pool, and returns
+        the snapshots and the events of the changes since the last snapshot. The snapshots are
+        persisted with the last checked commits.
+        """
+        diff_refs = self._metrics.profiled(self._diff_refs)
+        futures = [(x['repository'], self._executor.submit(diff_refs, x)) for x in targets]
+
+        (snapshots, events) = ({}, [])
+        for (repository, future) in futures:
+            try:
+                (snapshot, ref_events) = future.result()
+            except Exception as e:
+                # the last snapshot is kept, then the changes are detected at the next polling
+                self._metrics.inc('errors')
+                self._logger.warning('Failed to check the refs of the repository(%s) [%s]' %
+                                     (repository, e))
+                continue
+            events += ref_events
+            snapshots[repository] = snapshot
+
+        return (snapshots, events)
+
+    def _diff_refs(self, target):
+        """
+        This returns the snapshot of the refs of the target and the events of the changes.
+        The refs which couldn't be fetched are carried over from the last snapshot, and
+        the events of each kind of the refs are made only when it has the last snapshot.
+        """
+        repository = target['repository']
+        previous = self.refs.get(repository) or {}
+        snapshot = dict(previous)
+        events = []
+
+        def fetch(kind, getter):
+            try:
+                snapshot[kind] = getter(repository)
+            except self._backend.NOT_FOUND_ERRORS + (RequestException,) as e:
+                self._logger.warning('Failed to get the %s of the repository(%s) [%s]' %
+                                     (kind, repository, e))
+                return False
+            return kind in previous
+
+        tips = self._observed_tips.pop(repository, None)
+        if ({'branch_created', 'branch_deleted'} & set(self.REF_EVENTS)) and tips is not None:
+            # the branch tips are the ones which are fetched to check the commits
+            if fetch('branches', lambda x: tips):
+                events += self._diff_branches(target, previous['branches'], tips)
+
+        if 'tag' in self.REF_EVENTS and fetch('tags', self._backend.get_tags):
+            for tag in sorted(set(previous['tags']) | set(snapshot['tags'])):
+                (old, new) = (previous['tags'].get(tag), snapshot['tags'].get(tag))
+                if old != new:
+                    action = 'deleted' if new is None else 'created' if old is None else 'moved'
+                    events.append(('tag', {'repository': repository, 'tag': tag,
+                                           'action': action, 'commit': new or old}))
+
+        if 'pull_request' in self.REF_EVENTS and \
+                fetch('pull_requests', self._backend.get_pull_requests):
+            events += self._diff_pull_requests(repository, previous['pull_requests'],
+                                               snapshot['pull_requests'])
+
+        return (snapshot, events)
+
+    def _diff_branches(self, target, previous, tips):
+        def is_watched(branch):
+            return any([fnmatch.fnmatchcase(branch, x) for x in target['branches']])
+
+        events = []
+        if 'branch_created' in self.REF_EVENTS:
+            events += [('branch_created', {'repository': target['repository'], 'branch': x,
+                                           'commit': tips[x]})
+                       for x in sorted(set(tips) - set(previous)) if is_watched(x)]
+        if 'branch_deleted' in self.REF_EVENTS:
+            events += [('branch_deleted', {'repository': target['repository'], 'branch': x,
+                                           'commit': previous[x]})
+                       for x in sorted(set(previous) - set(tips)) if is_watched(x)]
+        return events
+
+    def _diff_pull_requests(self, repository, previous, current):
+        """
+        This returns the events of the pull-requests which are opened, updated or closed.
+        The final state of the closed one (e.g. merged) is requested individually.
+        """
+        events = []
+        for (pr_id, pr) in sorted(current.items()):
+            if pr_id not in previous:
+                events.append(('pull_request', {'repository': repository, 'action': 'opened',
+                                                'pull_request': pr}))
+            elif pr != previous[pr_id]:
+                events.append(('pull_request', {'repository': repository, 'action': 'updated',
+                                                'pull_request': pr}))
+
+        for pr_id in sorted(set(previous) - set(current)):
+            try:
+                pr = self._backend.get_pull_request(repository, pr_id)
+            except self._backend.NOT_FOUND_ERRORS + (RequestException,) as e:
+                self._logger.warning('Failed to get the pull-request(%s) of the repository(%s) '
+                                     '[%s]' % (pr_id, repository, e))
+                pr = dict(previous[pr_id], state='closed')
+
+            events.append(('pull_request', {'repository': repository, 'action': pr['state'],
+                                            'pull_request': pr}))
+
+        return events
+
+    def _filter_commits(self, commits):
+        filtered = [x for x in commits if x['repository'] not in self._path_filters or
+                    self._path_filters[x['repository']].match(x['files'])]
+        if len(filtered) < len(commits):
+            self._metrics.inc('filtered.commits', len(commits) - len(filtered))
+        return filtered
+
+    def _coalesce_commits(self, commits, targets, updated_repositories):
+        """
+        This buffers the new commits of the branches whose target has the coalescing window,
+        and returns the commits to dispatch in this polling. Those are the commits of the other
+        branches, and the buffered ones whose window has closed or which reached the limit.
+        """
+        now = time.time()
+        settings = dict([(x['repository'], x.get('coalesce')) for x in targets])
+
+        ready_commits = []
+        groups = OrderedDict()
+        for commit in commits:
+            if settings.get(commit['repository']):
+                groups.setdefault((commit['repository'], commit['branch']), []).append(commit)
+            else:
+                ready_commits.append(commit)
+
+        for ((repo, branch), group_commits) in groups.items():
+            pending = self.pending_commits.setdefault(repo, {}).setdefault(branch, {
+                'opened_at': now,
+                'commits': [],
+            })
+            # the commits are kept in the order of the walk (the newest one is the first)
+            pending['commits'][:0] = group_commits
+            updated_repositories.add(repo)
+
+        # only the repositories which this instance owns are flushed (the others' are handed
+        # over with the last checked commits)
+        for (repo, branches) in self.pending_commits.items():
+            if repo not in settings:
+                continue
+
+            coalesce = settings[repo] or {}
+            for branch in list(branches):
+                pending = branches[branch]
+                if not coalesce or now - pending['opened_at'] >= coalesce['window'] or \
+                        0 < coalesce.get('max_commits', 0) <= len(pending['commits']):
+                    ready_commits += branches.pop(branch)['commits']
+                    updated_repositories.add(repo)
+
+        return ready_commits
+
+    def _group_commits(self, commits):
+        """
+        This groups the commits by (repository, branch) in a single pass, and generates
+        the payloads of each group.
+        """
+        groups = OrderedDict()
+        for commit in commits:
+            groups.setdefault((commit['repository'], commit['branch']), []).append(commit)
+
+        for ((repo, branch), group_commits) in groups.items():
+            for payload in build_payloads(repo, branch, group_commits, self.CHANGE_TYPES,
+                                          self.MAX_COMMITS_PER_EVENT, self.MAX_FILES_PER_EVENT,
+                                          self.COMPACT_PAYLOAD):
+                yield payload
+
+    def _dispatch_trigger(self, event_type, payload):
+        self._metrics.inc('dispatch')
+
+        data = {
+            'id': self._event_ids.allocate(),
+            'created_at': datetime.now().strftime(self.DATE_FORMAT),
+            'type': event_type,
+            'payload': payload,
+        }
+
+        self._sensor_service.dispatch(trigger=self._trigger_ref, payload=data)
+
+    # initialize last commit for each branches
+    def _init_last_commit(self, targets):
+        for target in targets:
+            for branch in self._match_branches(target, None):
+                if branch in self.last_commit.get(target['repository'], {}):
+                    continue
 
                 try:
-                    self._set_last_commit_time(target['repository'],
-                                               branch,
-                                               datetime.strptime(next(commits).date,
-                                                                 "%Y-%m-%dT%H:%M:%SZ"))
-                except (ValueError, HTTPError) as e:
+                    self._set_last_commit(target['repository'],
+                                          branch,
+                                          self._backend.get_last_commit_id(target['repository'],
+                                                                           branch))
+                except self._backend.NOT_FOUND_ERRORS as e:
                     self._logger.warning("branch(%s) doesn't exist in the repository(%s) [%s]" %
                                          (branch, target['repository'], e))
 
-    def _set_last_commit_time(self, repo, branch, last_commit_time):
+    def _set_last_commit(self, repo, branch, last_commit_id):
         if repo not in self.last_commit:
             self.last_commit[repo] = {}
-        self.last_commit[repo][branch] = last_commit_time
+        self.last_commit[repo][branch] = last_commit_id
+
+    def _update_last_commit(self, repo, branch, cursor):
+        """
+        This applies the result of the commit walk to the last checked commit of the branch,
+        and returns whether it's changed or not.
+        """
+        if cursor and cursor['offset'] is not None:
+            # the commit walk is unfinished, this is resumed at the next polling
+            self.cursors.setdefault(repo, {})[branch] = cursor
+            return True
+
+        updated = self.cursors.get(repo, {}).pop(branch, None) is not None
+        if cursor and self.last_commit[repo][branch] != cursor['head']:
+            self.last_commit[repo][branch] = cursor['head']
+            updated = True
+
+        return updated
+
+    def _load_last_commit(self):
+        for kvp in self._sensor_service.list_values(prefix=self.LAST_COMMIT_KEY_PREFIX) or []:
+            self._parse_last_commit(kvp.name, kvp.value)
+
+    def _restore_last_commit(self, repo):
+        self.last_commit[repo] = {}
+        self.cursors.pop(repo, None)
+        self.pending_commits.pop(repo, None)
+        self.refs.pop(repo, None)
+
+        value = self._sensor_service.get_value(name=self.LAST_COMMIT_KEY_PREFIX + repo)
+        if value:
+            self._parse_last_commit(self.LAST_COMMIT_KEY_PREFIX + repo, value)
+
+    def _parse_last_commit(self, name, value):
+        try:
+            value = json.loads(value)
+        except ValueError as e:
+            self._logger.warning('Failed to load the last checked commits (%s) [%s]' % (name, e))
+            return
 
-    def _update_last_commit(self):
-        for commit in self.new_commits:
-            commit_time = datetime.strptime(commit['time'], self.DATE_FORMAT)
+        self.last_commit[value['repository']] = value['last_commit']
+        self.cursors[value['repository']] = value.get('cursors', {})
+        self.pending_commits[value['repository']] = value.get('pending_commits', {})
+        self.refs[value['repository']] = value.get('refs', {})
 
-            if self.last_commit[commit['repository']][commit['branch']] < commit_time:
-                self.last_commit[commit['repository']][commit['branch']] = commit_time
+    def _save_last_commit(self, repos):
+        # The last checked commits are saved every repository to reduce the datastore writes
+        for repo in repos:
+            self._sensor_service.set_value(name=self.LAST_COMMIT_KEY_PREFIX + repo,
+                                           value=json.dumps({
+                                               'repository': repo,
+                                               'last_commit': self.last_commit.get(repo, {}),
+                                               'cursors': self.cursors.get(repo, {}),
+                                               'pending_commits':
+                                                   self.pending_commits.get(repo, {}),
+                                               'refs': self.refs.get(repo, {}),
+                                           }))
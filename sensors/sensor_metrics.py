@@ -0,0 +1,213 @@
+import cProfile
+import os
+import pstats
+import re
+import threading
+import time
+
+from collections import Counter
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    from st2common.metrics.base import get_driver
+except ImportError:
+    # the metrics driver is available since StackStorm v2.9
+    get_driver = None
+
+# The kinds of the API endpoints which are requested by the sensors
+ENDPOINTS = [
+    ('changes', re.compile(r'/commits/[^/]+/changes$')),
+    ('diffstat', re.compile(r'/diffstat/[^/]+$')),
+    ('commits', re.compile(r'/commits(/.+)?$')),
+    ('branches', re.compile(r'/branches$')),
+    ('repositories', re.compile(r'/repos$|/2\.0/repositories/[^/]+$')),
+]
+
+
+def get_endpoint(path):
+    """
+    This returns the kind of the API endpoint of the URL path (e.g. 'commits').
+    """
+    for (name, pattern) in ENDPOINTS:
+        if pattern.search(path):
+            return name
+    return 'other'
+
+
+class Metrics(object):
+    """
+    This sends the metrics of the sensor to the metrics driver of StackStorm, which is
+    configured in st2.conf (e.g. statsd), and tallies them up in each polling cycle to log
+    the summary of the cycle. When the profile directory is specified, the profile of each
+    cycle (including the jobs on the worker pools) is dumped into it.
+    """
+    def __init__(self, prefix, logger, profile_dir=None):
+        self._prefix = prefix
+        self._logger = logger
+        self._profile_dir = profile_dir
+        self._driver = get_driver() if get_driver else None
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._start_cycle()
+
+        if self._profile_dir and not os.path.isdir(self._profile_dir):
+            os.makedirs(self._profile_dir)
+
+    def inc(self, key, amount=1):
+        with self._lock:
+            self._counts[key] += amount
+
+        if self._driver:
+            self._driver.inc_counter(self._key(key), amount)
+
+    def time(self, key, seconds):
+        with self._lock:
+            self._timings[key] += seconds
+
+        if self._driver:
+            self._driver.time(self._key(key), seconds)
+
+    def gauge(self, key, value):
+        if self._driver:
+            self._driver.set_gauge(self._key(key), value)
+
+    @contextmanager
+    def timer(self, key):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.time(key, time.time() - started_at)
+
+    def record_commits(self, repository, count):
+        """
+        This records the new commits of the repository. Only the total is sent to the driver,
+        because the repositories of the wildcard targets are unbounded, and the count of each
+        repository is kept for the summary of the cycle.
+        """
+        self.inc('commits', count)
+        with self._lock:
+            self._counts['commits.%s' % repository] += count
+
+    @contextmanager
+    def walk_timer(self, repository):
+        """
+        This measures the walk of a branch of the repository in the same manner as the commits,
+        which is sent to the driver as 'walk' and kept by the repository for the summary.
+        """
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - started_at
+            self.time('walk', seconds)
+            with self._lock:
+                self._timings['walk.%s' % repository] += seconds
+
+    def record_request(self, path, seconds, status=None):
+        """
+        This records the API call and its latency by the kind of the endpoint. The status is
+        None when the request is failed without the response (e.g. timeout).
+        """
+        endpoint = get_endpoint(path)
+        self.inc('api.%s' % endpoint)
+        self.time('api.%s' % endpoint, seconds)
+
+        if status is None or status >= 400:
+            self.inc('api.%s.error' % endpoint)
+
+    def profiled(self, func):
+        """
+        This returns the function which is profiled in the cycle, which is used to profile
+        the jobs on the worker pools because the profiler only profiles its own thread.
+        """
+        if not self._profile_dir:
+            return func
+
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self._profiles.append(profile)
+
+        return wrapper
+
+    @contextmanager
+    def cycle(self):
+        """
+        This measures a polling cycle, then logs its summary and dumps its profile.
+        """
+        self._start_cycle()
+        profile = cProfile.Profile() if self._profile_dir else None
+        if profile:
+            profile.enable()
+
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            self.time('poll', time.time() - started_at)
+            self._finish_cycle(profile)
+
+    def _start_cycle(self):
+        with self._lock:
+            self._counts = Counter()
+            self._timings = defaultdict(float)
+            self._profiles = []
+
+    def _finish_cycle(self, profile):
+        with self._lock:
+            (counts, timings, profiles) = (self._counts, self._timings, self._profiles)
+
+        self.gauge('poll.api_calls', sum([v for (k, v) in counts.items()
+                                          if k.startswith('api.') and not k.endswith('.error')]))
+        self.gauge('poll.commits', counts['commits'])
+
+        hits = counts['cache.hit']
+        lookups = hits + counts['cache.miss']
+        if lookups:
+            self.gauge('cache.hit_rate', float(hits) / lookups)
+
+        # The timeouts are logged in the INFO level to find which phase, endpoint or repository
+        # is slow, otherwise the summary is logged in the DEBUG level.
+        log = self._logger.info if counts['timeouts'] else self._logger.debug
+        log(self._format_summary(counts, timings))
+
+        if profile:
+            filepath = os.path.join(self._profile_dir, 'poll-%d.prof' % int(time.time() * 1000))
+            pstats.Stats(profile, *profiles).dump_stats(filepath)
+            self._logger.debug('The profile of the polling cycle is dumped to %s' % filepath)
+
+    def _format_summary(self, counts, timings):
+        def format_phases():
+            return ', '.join(['%s %.3fs' % (x, timings[x])
+                              for x in ['discovery', 'check', 'dispatch'] if x in timings])
+
+        def format_endpoints():
+            endpoints = sorted([k[len('api.'):] for k in counts
+                                if k.startswith('api.') and not k.endswith('.error')])
+            return ', '.join(['%s %d calls/%d errors/%.3fs' % (
+                x, counts['api.%s' % x], counts['api.%s.error' % x], timings['api.%s' % x])
+                for x in endpoints])
+
+        walks = sorted([(v, k[len('walk.'):]) for (k, v) in timings.items()
+                        if k.startswith('walk.')], reverse=True)
+        commits = sorted([(v, k[len('commits.'):]) for (k, v) in counts.items()
+                          if k.startswith('commits.')], reverse=True)
+
+        return ('The polling cycle took %.3fs (%s): API [%s], %d commits, %d events, '
+                '%d timeouts, cache %d hits/%d misses, the slowest repository %s, '
+                'the busiest repository %s' % (
+                    timings['poll'], format_phases(), format_endpoints(), counts['commits'],
+                    counts['dispatch'], counts['timeouts'], counts['cache.hit'],
+                    counts['cache.miss'],
+                    '%s (%.3fs)' % (walks[0][1], walks[0][0]) if walks else '-',
+                    '%s (%d commits)' % (commits[0][1], commits[0][0]) if commits else '-'))
+
+    def _key(self, key):
+        return '%s.%s' % (self._prefix, re.sub(r'[^\w.\-/]', '_', key).replace('/', '.'))
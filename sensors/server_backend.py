@@ -0,0 +1,128 @@
+import json
+import stashy
+
+from commit_parser import get_server_updated_files
+from commit_parser import parse_server_commit
+from datetime import datetime
+from requests.exceptions import RequestException
+
+
+class ServerBackend(object):
+    """
+    This accesses the BitBucket Server for the RepositorySensor through the stashy. This is
+    imported only when the 'bitbucket_type' is 'server'.
+    """
+    # The errors which indicate that the branch or the commit doesn't exist
+    NOT_FOUND_ERRORS = (stashy.errors.NotFoundException,)
+
+    def __init__(self, sensor):
+        self._sensor = sensor
+        self._logger = sensor._logger
+
+        self.client = stashy.connect(sensor._config['sensor'].get('bitbucket_server_url'),
+                                     sensor._config.get('username'),
+                                     sensor._config.get('password'))
+        sensor._configure_session(self.client._client._session)
+
+    def is_not_found(self, error):
+        return isinstance(error, stashy.errors.NotFoundException)
+
+    def list_repositories(self, project):
+        return [x['slug'] for x in self.client.projects[project].repos.list()]
+
+    def get_branch_tips(self, repository):
+        """
+        This returns the tip commit-id of each branch in the repository.
+        (BitBucket Server doesn't support conditional requests for the branches)
+        """
+        try:
+            return dict([(x['displayId'], x['latestCommit'])
+                         for x in self._get_repository(repository).branches()])
+        except (stashy.errors.NotFoundException, stashy.errors.GenericException,
+                RequestException, ValueError) as e:
+            self._logger.warning('Failed to get branches of the repository(%s) [%s]' %
+                                 (repository, e))
+
+    def get_last_commit_id(self, repository, branch):
+        last_commit = next(self._get_repository(repository).commits(branch), None)
+        if last_commit:
+            return last_commit['id']
+
+    def get_commits(self, repository, until, since, position=None):
+        """
+        This generates the commits from 'until' to 'since' (exclusive) with their positions,
+        which are their indexes because the listing can be started from any commit.
+        """
+        params = {'until': until, 'withCounts': False, 'start': position or 0}
+        if since is not None:
+            params['since'] = since
+
+        commits = self._get_repository(repository).paginate('/commits', params=params)
+        for (index, commit) in enumerate(commits, position or 0):
+            yield (index, commit)
+
+    def get_commit_id(self, commit):
+        return commit['id']
+
+    def parse_commit(self, repository, branch, commit):
+        return parse_server_commit(commit, repository, branch,
+                                   self._sensor._changes_cache.get_or_load(
+                                       commit['id'],
+                                       lambda: self._get_updated_files(repository, commit['id'])))
+
+    def get_tags(self, repository):
+        """
+        This returns the commit-id of each tag in the repository.
+        """
+        return dict([(x['displayId'], x['latestCommit'])
+                     for x in self._get_repository(repository).paginate('/tags')])
+
+    def get_pull_requests(self, repository):
+        """
+        This returns the open pull-requests of the repository by their ids.
+        """
+        return dict([(str(x['id']), self._parse_pull_request(x))
+                     for x in self._get_repository(repository).pull_requests.all(state='OPEN')])
+
+    def get_pull_request(self, repository, pr_id):
+        return self._parse_pull_request(
+            self._get_repository(repository).pull_requests[pr_id].get())
+
+    def _parse_pull_request(self, pr):
+        updated_on = datetime.fromtimestamp(pr['updatedDate'] / 1000)
+        return {
+            'id': pr['id'],
+            'title': pr['title'],
+            'state': pr['state'].lower(),
+            'author': pr['author']['user'].get('emailAddress') or pr['author']['user']['name'],
+            'source': pr['fromRef']['displayId'],
+            'destination': pr['toRef']['displayId'],
+            'commit': pr['fromRef']['latestCommit'],
+            'updated_on': updated_on.strftime(self._sensor.DATE_FORMAT),
+        }
+
+    def _get_repository(self, repository):
+        (proj, repo) = repository.split('/')
+        return self.client.projects[proj].repos[repo]
+
+    def _get_updated_files(self, repository, commit_id):
+        """
+        This returns file-pathes which are changed in the commit (following all pages of
+        the changes).
+        """
+        return self._get_changes(repository, '/commits/{}/changes'.format(commit_id), {})
+
+    def _get_changes(self, repository, path, params):
+        robj = self._get_repository(repository)
+
+        changes = []
+        while True:
+            res = robj._client.get(robj.url(path), params=params)
+            stashy.errors.maybe_throw(res)
+
+            data = json.loads(res.content)
+            changes += data['values']
+
+            if data.get('isLastPage', True):
+                return get_server_updated_files(changes)
+            params = dict(params, start=data['nextPageStart'])
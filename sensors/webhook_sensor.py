@@ -0,0 +1,354 @@
+import fnmatch
+import hashlib
+import hmac
+import json
+import requests
+import socket
+
+from commit_parser import get_cloud_updated_files
+from commit_parser import get_server_updated_files
+from commit_parser import parse_cloud_commit
+from commit_parser import parse_server_commit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from repository_sensor import DispatchedCommits
+from repository_sensor import EventIdAllocator
+from repository_sensor import PathFilter
+from repository_sensor import TimeoutHTTPAdapter
+from repository_sensor import build_payloads
+from requests.exceptions import RequestException
+from sensor_metrics import Metrics
+from st2reactor.sensor.base import Sensor
+from urllib.parse import urlsplit
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    This receives the push webhooks and passes them to the WebhookSensor.
+    """
+    def do_POST(self):
+        sensor = self.server.sensor
+
+        if self.path.split('?')[0] != sensor.PATH:
+            return self._respond(404)
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not sensor._verify_signature(body, self.headers.get('X-Hub-Signature')):
+            return self._respond(401)
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return self._respond(400)
+
+        # The webhook is acknowledged before the commits are processed because fetching
+        # the changed files of the commits may take longer than BitBucket waits for.
+        sensor._submit_push(data)
+        self._respond(202)
+
+    def log_message(self, format, *args):
+        self.server.sensor._logger.debug(format % args)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.end_headers()
+
+
+class WebhookSensor(Sensor):
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+    HOST = '0.0.0.0'
+    PORT = 8090
+    PATH = '/bitbucket'
+    TIMEOUT_SECONDS = 20
+    EVENT_ID_BLOCK_SIZE = 100
+    MAX_COMMITS_PER_EVENT = 0
+    MAX_FILES_PER_EVENT = 0
+    COMPACT_PAYLOAD = False
+    METRICS_PREFIX = 'bitbucket'
+    CHANGE_TYPES = ['added', 'moved', 'deleted', 'modified']
+
+    # The endpoint of the BitBucket Cloud API to get the changed files of each commit
+    BITBUCKET_CLOUD_URL = 'https://api.bitbucket.org'
+
+    def __init__(self, sensor_service, config=None):
+        super(WebhookSensor, self).__init__(sensor_service=sensor_service, config=config)
+        self._trigger_ref = 'bitbucket.repository_event'
+        self._logger = self._sensor_service.get_logger(__name__)
+        self._serving = False
+
+    def setup(self):
+        sensor_config = self._config.get('sensor', None)
+        if not sensor_config:
+            raise ValueError('"sensor" config value is required')
+
+        webhook_config = sensor_config.get('webhook', None)
+        if not webhook_config:
+            raise ValueError('"webhook" parameter in the "sensor" is required')
+
+        # Only the pushes to the branches which are monitored by the RepositorySensor are
+        # dispatched. The targets may have wildcards as well as the RepositorySensor.
+        self.targets = sensor_config.get('targets') or []
+        self._path_filters = [PathFilter.create(x.get('paths')) for x in self.targets]
+
+        self.PATH = webhook_config.get('path', self.PATH)
+        self.secret = webhook_config.get('secret')
+        self.TIMEOUT_SECONDS = sensor_config.get('timeout', self.TIMEOUT_SECONDS)
+        self.EVENT_ID_BLOCK_SIZE = sensor_config.get('event_id_block_size',
+                                                     self.EVENT_ID_BLOCK_SIZE)
+        self.INSTANCE_NAME = sensor_config.get('instance_name') or socket.gethostname()
+
+        # the payloads are bounded in the same manner as the RepositorySensor
+        self.MAX_COMMITS_PER_EVENT = sensor_config.get('max_commits_per_event',
+                                                       self.MAX_COMMITS_PER_EVENT)
+        self.MAX_FILES_PER_EVENT = sensor_config.get('max_files_per_event',
+                                                     self.MAX_FILES_PER_EVENT)
+        self.COMPACT_PAYLOAD = sensor_config.get('compact_payload', self.COMPACT_PAYLOAD)
+
+        # The event-ids and the dispatched commits are shared with the RepositorySensor
+        self._event_ids = EventIdAllocator(self._sensor_service, self._trigger_ref,
+                                           '%s.webhook' % self.INSTANCE_NAME,
+                                           self.EVENT_ID_BLOCK_SIZE, self._logger)
+        self._dispatched = DispatchedCommits(self._sensor_service)
+
+        metrics_config = self._config.get('metrics') or {}
+        self._metrics = Metrics('%s.webhook' % metrics_config.get('prefix', self.METRICS_PREFIX),
+                                self._logger)
+
+        # The push payload of the BitBucket Cloud doesn't contain the changed files
+        self.session = requests.Session()
+        self.session.auth = (self._config.get('username'), self._config.get('password'))
+        adapter = TimeoutHTTPAdapter(timeout=self.TIMEOUT_SECONDS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.hooks['response'].append(self._record_response)
+
+        # The pushes are processed one by one in the order they are received, then the pushes
+        # to the same branch are dispatched in order.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self._server = ThreadingHTTPServer((webhook_config.get('host', self.HOST),
+                                            webhook_config.get('port', self.PORT)),
+                                           WebhookHandler)
+        self._server.sensor = self
+
+        self._logger.info("It's ready to receive webhooks on %s:%d%s" %
+                          (self._server.server_address + (self.PATH,)))
+
+    def run(self):
+        self._serving = True
+        self._server.serve_forever()
+
+    def cleanup(self):
+        if self._serving:
+            self._server.shutdown()
+            self._serving = False
+        self._server.server_close()
+        self._executor.shutdown(wait=True)
+        self._event_ids.release()
+
+    def add_trigger(self, trigger):
+        pass
+
+    def update_trigger(self, trigger):
+        pass
+
+    def remove_trigger(self, trigger):
+        pass
+
+    def _verify_signature(self, body, signature):
+        """
+        This verifies the HMAC signature of the payload when the secret is configured.
+        """
+        if not self.secret:
+            return True
+
+        expected = 'sha256=' + hmac.new(self.secret.encode('utf-8'), body,
+                                        hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+    def _submit_push(self, body):
+        self._executor.submit(self._do_handle_push, body)
+
+    def _do_handle_push(self, body):
+        try:
+            self._handle_push(body)
+        except Exception as e:
+            self._metrics.inc('errors')
+            self._logger.warning('Failed to handle the webhook: %s' % e)
+
+    def _handle_push(self, body):
+        if 'refChanges' in body:
+            pushes = self._parse_server_push(body)
+        elif 'push' in body:
+            pushes = self._parse_cloud_push(body)
+        else:
+            self._logger.debug('The webhook which is not a push is ignored')
+            return
+
+        for (repository, branch, commits, base, head) in pushes:
+            self._metrics.record_commits(repository, len(commits))
+            with self._metrics.timer('dispatch'):
+                self._dispatch_push(repository, branch, commits, base, head)
+
+    def _get_target(self, repository, branch):
+        """
+        This returns the repository name of the target which monitors the branch, which is
+        the same one as the RepositorySensor dispatches. The repository names are compared
+        in case-insensitive manner because the project key of the BitBucket Server is sent
+        in upper case.
+        """
+        return self._match_target(repository, branch)[0]
+
+    def _match_target(self, repository, branch):
+        """
+        This returns the repository name of the target which monitors the branch, and
+        the path filter of the target.
+        """
+        def is_pattern(name):
+            return any([x in name for x in '*?['])
+
+        # the explicit targets take precedence over the wildcard ones
+        for (target, path_filter) in sorted(zip(self.targets, self._path_filters),
+                                            key=lambda x: is_pattern(x[0]['repository'])):
+            if not fnmatch.fnmatch(repository.lower(), target['repository'].lower()):
+                continue
+            if not any([fnmatch.fnmatchcase(branch, x) for x in target['branches']]):
+                continue
+
+            (proj, repo) = target['repository'].split('/')
+            if is_pattern(repo):
+                return ('%s/%s' % (proj, repository.split('/')[1]), path_filter)
+            return (target['repository'], path_filter)
+
+        return (None, None)
+
+    def _parse_server_push(self, body):
+        """
+        This returns the pushed commits of the BitBucket Server (post-receive webhook),
+        which contains 'refChanges' and 'changesets'.
+        """
+        repository = '%s/%s' % (body['repository']['project']['key'], body['repository']['slug'])
+        refs = [x for x in body['refChanges']
+                if x['refId'].startswith('refs/heads/') and x['type'] != 'DELETE']
+
+        if not refs:
+            return []
+
+        # The changesets don't indicate which branch they were pushed to, then the pushes
+        # to multiple branches are left to the RepositorySensor.
+        if len(refs) > 1:
+            self._logger.info('The push to multiple branches of the repository(%s) is left to '
+                              'the polling' % repository)
+            return []
+
+        branch = refs[0]['refId'][len('refs/heads/'):]
+        target = self._get_target(repository, branch)
+        if not target:
+            return []
+
+        changesets = body.get('changesets', {})
+        commits = []
+        for changeset in changesets.get('values', []):
+            # the commit whose changes are truncated is left to the polling
+            if not changeset.get('changes', {}).get('isLastPage', True):
+                continue
+
+            commits.append(parse_server_commit(
+                changeset['toCommit'], target, branch,
+                get_server_updated_files(changeset['changes'].get('values', []))))
+
+        # The tip of the branch is recorded only when all pushed commits are dispatched
+        complete = (changesets.get('isLastPage', True) and
+                    len(commits) == len(changesets.get('values', [])))
+
+        return [(target, branch, commits, refs[0]['fromHash'],
+                 refs[0]['toHash'] if complete else None)]
+
+    def _parse_cloud_push(self, body):
+        """
+        This returns the pushed commits of the BitBucket Cloud (repo:push webhook).
+        """
+        repository = body['repository']['full_name']
+
+        pushes = []
+        for change in body['push'].get('changes', []):
+            # the deleted branches and the tags are ignored
+            if not change.get('new') or change['new']['type'] != 'branch':
+                continue
+
+            branch = change['new']['name']
+            target = self._get_target(repository, branch)
+            if not target:
+                continue
+
+            complete = not change.get('truncated', False)
+            commits = []
+            for commit in change.get('commits', []):
+                try:
+                    files = self._get_cloud_updated_files(repository, commit['hash'])
+                except RequestException as e:
+                    self._logger.warning('Failed to get the changed files of the commit(%s) [%s]' %
+                                         (commit['hash'], e))
+                    complete = False
+                    continue
+
+                commits.append(parse_cloud_commit(commit, target, branch, files))
+
+            base = change['old']['target']['hash'] if change.get('old') else None
+            pushes.append((target, branch, commits, base,
+                           change['new']['target']['hash'] if complete else None))
+
+        return pushes
+
+    def _record_response(self, res, *args, **kwargs):
+        self._metrics.record_request(urlsplit(res.url).path, res.elapsed.total_seconds(),
+                                     res.status_code)
+
+    def _get_cloud_updated_files(self, repository, commit_id):
+        """
+        This returns file-pathes which are changed in the commit (following all pages of
+        the diffstat).
+        """
+        url = '%s/2.0/repositories/%s/diffstat/%s' % (self.BITBUCKET_CLOUD_URL,
+                                                      repository, commit_id)
+        diffstat = []
+        while url:
+            res = self.session.get(url)
+            res.raise_for_status()
+
+            data = res.json()
+            diffstat += data['values']
+            url = data.get('next')
+
+        return get_cloud_updated_files(diffstat)
+
+    def _dispatch_push(self, repository, branch, commits, base, head):
+        # the commits which have been dispatched by the RepositorySensor are dropped
+        dispatched_ids = self._dispatched.get_commits(repository, branch)
+        new_commits = [x for x in commits if x['id'] not in dispatched_ids]
+
+        # the commits which don't change any watched path of the target are dropped
+        (_, path_filter) = self._match_target(repository, branch)
+        if path_filter:
+            new_commits = [x for x in new_commits if path_filter.match(x['files'])]
+
+        for payload in build_payloads(repository, branch, new_commits, self.CHANGE_TYPES,
+                                      self.MAX_COMMITS_PER_EVENT, self.MAX_FILES_PER_EVENT,
+                                      self.COMPACT_PAYLOAD):
+            self._dispatch_trigger('commit', payload)
+
+        self._dispatched.add(repository, branch, [x['id'] for x in commits], base, head)
+
+    def _dispatch_trigger(self, event_type, payload):
+        self._metrics.inc('dispatch')
+
+        data = {
+            'id': self._event_ids.allocate(),
+            'created_at': datetime.now().strftime(self.DATE_FORMAT),
+            'type': event_type,
+            'payload': payload,
+        }
+
+        self._sensor_service.dispatch(trigger=self._trigger_ref, payload=data)
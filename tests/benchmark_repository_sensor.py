@@ -0,0 +1,196 @@
+"""
+Benchmark of the RepositorySensor against the local stand-in of the BitBucket, which reports
+the latency, the number of the API calls and the peak memory of the polling over the matrix
+of the number of the targets and the new commits.
+
+    $ python tests/benchmark_repository_sensor.py --targets 10,100,1000,5000 \\
+        --commits 1,100,1000,10000 --latency 0.005
+
+The results can be saved by '--output' and compared with the saved ones by '--baseline',
+then it exits with non-zero status when any result regresses over the tolerance.
+"""
+import argparse
+import contextlib
+import functools
+import json
+import mock
+import sys
+import time
+import tracemalloc
+
+from bitbucket_standin import BitBucketStandIn
+from repository_sensor import RepositorySensor
+
+# The number of pollings to dispatch all new commits is bounded by this
+MAX_POLLS = 100
+
+
+def run_benchmark(sensor_service, service_type, targets, commits, branches=1, latency=0,
+                  page_size=25, engine='thread', concurrency=4):
+    """
+    This pushes the new commits to the targets of the stand-in (round robin), and polls them
+    until all of them are dispatched. Then this polls once more without any new commit to
+    measure the cost of the idle polling.
+    """
+    standin = BitBucketStandIn(service_type, latency=latency, page_size=page_size)
+    standin.start()
+
+    repositories = ['BENCH/repo-%d' % x for x in range(targets)]
+    branch_names = ['master'] + ['branch-%d' % x for x in range(1, branches)]
+    for repository in repositories:
+        standin.add_repository(repository, branch_names)
+
+    config = {
+        'username': 'username',
+        'password': 'password',
+        'email': 'test@test.local',
+        'sensor': {
+            'bitbucket_type': service_type,
+            'bitbucket_server_url': standin.url,
+            'targets': [{'repository': x, 'branches': branch_names} for x in repositories],
+            'concurrency': concurrency,
+            'engine': engine,
+        },
+    }
+
+    sensor = RepositorySensor(sensor_service=sensor_service, config=config)
+    try:
+        with contextlib.ExitStack() as stack:
+            if service_type == 'cloud':
+                # the client of the BitBucket Cloud is pointed to the stand-in
+                from pybitbucket.auth import BasicAuthenticator
+                stack.enter_context(mock.patch('cloud_backend.BasicAuthenticator',
+                                               functools.partial(BasicAuthenticator,
+                                                                 server_base_uri=standin.url)))
+
+            started_at = time.time()
+            sensor.setup()
+            setup_latency = time.time() - started_at
+
+            for index in range(commits):
+                standin.push(repositories[index % targets], 'master', 1)
+
+            standin.reset_calls()
+            tracemalloc.start()
+            (polls, dispatched, started_at) = (0, 0, time.time())
+            while dispatched < commits and polls < MAX_POLLS:
+                sensor.poll()
+                polls += 1
+                dispatched = sum([len(x['payload']['payload']['commits'])
+                                  for x in sensor_service.dispatched_triggers])
+            latency_ = time.time() - started_at
+            (_, peak_memory) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            calls = dict(standin.calls)
+
+            standin.reset_calls()
+            started_at = time.time()
+            sensor.poll()
+            idle_latency = time.time() - started_at
+            idle_calls = dict(standin.calls)
+    finally:
+        sensor.cleanup()
+        standin.stop()
+
+    return {
+        'service_type': service_type,
+        'engine': engine,
+        'targets': targets,
+        'commits': commits,
+        'setup_latency': setup_latency,
+        'polls': polls,
+        'dispatched': dispatched,
+        'latency': latency_,
+        'calls': calls,
+        'peak_memory': peak_memory,
+        'idle_latency': idle_latency,
+        'idle_calls': idle_calls,
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    This returns the descriptions of the results which are worse than the baseline ones
+    over the tolerance ratio. The API calls are compared strictly.
+    """
+    baseline = dict([((x['service_type'], x['engine'], x['targets'], x['commits']), x)
+                     for x in baseline])
+
+    regressions = []
+    for result in results:
+        key = (result['service_type'], result['engine'], result['targets'], result['commits'])
+        if key not in baseline:
+            continue
+
+        for name in ['latency', 'idle_latency', 'peak_memory']:
+            if result[name] > baseline[key][name] * (1 + tolerance):
+                regressions.append('%s %s: %.3f -> %.3f' % ('/'.join(map(str, key)), name,
+                                                            baseline[key][name], result[name]))
+
+        for name in ['calls', 'idle_calls']:
+            if sum(result[name].values()) > sum(baseline[key][name].values()):
+                regressions.append('%s %s: %s -> %s' % ('/'.join(map(str, key)), name,
+                                                        baseline[key][name], result[name]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the RepositorySensor')
+    parser.add_argument('--type', default='server,cloud',
+                        help='comma separated bitbucket types (server, cloud)')
+    parser.add_argument('--engine', default='thread', help='comma separated engines')
+    parser.add_argument('--targets', default='10,100,1000,5000',
+                        help='comma separated numbers of the targets')
+    parser.add_argument('--commits', default='1,100,1000,10000',
+                        help='comma separated numbers of the new commits')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds which each request takes')
+    parser.add_argument('--page-size', type=int, default=25)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--output', help='file to save the results as JSON')
+    parser.add_argument('--baseline', help='file of the results to be compared with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='acceptable ratio of the regression of latency and memory')
+    args = parser.parse_args()
+
+    from st2tests.mocks.sensor import MockSensorService
+    from st2tests.mocks.sensor import MockSensorWrapper
+
+    print('%-6s %-6s %7s %7s %5s %9s %9s %9s %9s %10s' % (
+        'type', 'engine', 'targets', 'commits', 'polls', 'setup(s)', 'poll(s)', 'calls',
+        'idle(s)', 'memory(MB)'))
+
+    results = []
+    for service_type in args.type.split(','):
+        for engine in args.engine.split(','):
+            for targets in [int(x) for x in args.targets.split(',')]:
+                for commits in [int(x) for x in args.commits.split(',')]:
+                    sensor_service = MockSensorService(
+                        MockSensorWrapper('bitbucket', 'RepositorySensor'))
+                    result = run_benchmark(sensor_service, service_type, targets, commits,
+                                           latency=args.latency, page_size=args.page_size,
+                                           engine=engine, concurrency=args.concurrency)
+                    results.append(result)
+
+                    print('%-6s %-6s %7d %7d %5d %9.3f %9.3f %9d %9.3f %10.2f' % (
+                        service_type, engine, targets, commits, result['polls'],
+                        result['setup_latency'], result['latency'],
+                        sum(result['calls'].values()), result['idle_latency'],
+                        result['peak_memory'] / 1024.0 / 1024.0))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import re
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    This answers the requests to the BitBucketStandIn by the routes of its service type.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    # the headers and the body are sent at once to the kept-alive connection
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_GET(self):
+        standin = self.server.standin
+        url = urlsplit(self.path)
+        params = dict([(k, v[-1]) for (k, v) in parse_qs(url.query).items()])
+
+        # every request takes the latency of the network and the BitBucket
+        if standin.latency:
+            time.sleep(standin.latency)
+
+        for (name, pattern, handler) in standin.routes:
+            matched = re.match(pattern, url.path)
+            if matched:
+                standin.count(name)
+                (status, headers, body) = handler(self, params, *matched.groups())
+                return self._respond(status, headers, body)
+
+        self._respond(404, {}, {'errors': [{'message': 'Not Found'}]})
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, headers, body):
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+
+        self.send_response(status)
+        for (key, value) in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class BitBucketStandIn(object):
+    """
+    Local HTTP server which emulates the endpoints of the BitBucket Server or Cloud that the
+    RepositorySensor requests (the repositories, the branches, the commits and the changed files
+    of each commit). The latency of each request, the page size of the paged APIs and the number
+    of the changed files of each commit are configurable, and the requests are counted by each
+    endpoint.
+    """
+    AUTHOR = 'test@test.local'
+
+    def __init__(self, service_type, latency=0, page_size=25, files_per_commit=3):
+        self.service_type = service_type
+        self.latency = latency
+        self.page_size = page_size
+        self.files_per_commit = files_per_commit
+        self.calls = Counter()
+
+        # The commits of each (repository, branch) from the oldest to the newest, and the
+        # index of each commit-id in its branch
+        self._branches = {}
+        self._commits = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+        if service_type == 'server':
+            prefix = r'^/rest/api/1\.0/projects/([^/]+)'
+            self.routes = [
+                ('changes', prefix + r'/repos/([^/]+)/commits/([^/]+)/changes$',
+                 self._get_server_changes),
+                ('commits', prefix + r'/repos/([^/]+)/commits$', self._get_server_commits),
+                ('branches', prefix + r'/repos/([^/]+)/branches$', self._get_server_branches),
+                ('repositories', prefix + r'/repos$', self._get_server_repositories),
+            ]
+        elif service_type == 'cloud':
+            prefix = r'^/2\.0/repositories/([^/]+)'
+            self.routes = [
+                ('diffstat', prefix + r'/([^/]+)/diffstat/([^/]+)$', self._get_cloud_diffstat),
+                ('commits', prefix + r'/([^/]+)/commits/(.+)$', self._get_cloud_commits),
+                ('branches', prefix + r'/([^/]+)/refs/branches$', self._get_cloud_branches),
+                ('repositories', prefix + r'$', self._get_cloud_repositories),
+            ]
+        else:
+            raise ValueError('specified bitbucket type (%s) is not supported' % service_type)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self._server.daemon_threads = True
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def add_repository(self, repository, branches=('master',)):
+        """
+        This creates the repository whose branches have one initial commit.
+        """
+        for branch in branches:
+            self._branches[(repository, branch)] = []
+            self.push(repository, branch, 1)
+
+    def push(self, repository, branch, count):
+        """
+        This appends the new commits to the branch, and returns their commit-ids.
+        """
+        history = self._branches[(repository, branch)]
+        commit_ids = []
+        for _ in range(count):
+            with self._lock:
+                self._sequence += 1
+                sequence = self._sequence
+
+            commit_id = hashlib.sha1(str(sequence).encode('utf-8')).hexdigest()
+            self._commits[commit_id] = (repository, branch, len(history), sequence)
+            history.append(commit_id)
+            commit_ids.append(commit_id)
+
+        return commit_ids
+
+    def _get_history(self, repository, until, since):
+        """
+        This returns the commits from 'until' (inclusive) to 'since' (exclusive) in the newest
+        first order, or None when any of them doesn't exist in the repository.
+        """
+        def get_index(ref):
+            if (repository, ref) in self._branches:
+                return (ref, len(self._branches[(repository, ref)]) - 1)
+            if ref in self._commits and self._commits[ref][0] == repository:
+                return (self._commits[ref][1], self._commits[ref][2])
+            return (None, None)
+
+        (branch, until_index) = get_index(until)
+        if branch is None:
+            return None
+
+        since_index = -1
+        if since:
+            (since_branch, since_index) = get_index(since)
+            if since_branch != branch:
+                return None
+
+        history = self._branches[(repository, branch)]
+        return history[until_index:since_index:-1] if since_index >= 0 else \
+            history[until_index::-1]
+
+    def _get_changed_files(self, commit_id):
+        return ['src/%s/file-%d' % (commit_id[:8], x) for x in range(self.files_per_commit)]
+
+    def _get_commit_time(self, commit_id):
+        # the commits are authored one second apart in the order of their pushes
+        return 1500000000 + self._commits[commit_id][3]
+
+    def _server_page(self, values, params):
+        start = int(params.get('start', 0))
+        limit = min(int(params.get('limit', self.page_size)), self.page_size)
+        return (200, {}, {
+            'values': values[start:start + limit],
+            'size': len(values[start:start + limit]),
+            'start': start,
+            'limit': limit,
+            'isLastPage': start + limit >= len(values),
+            'nextPageStart': start + limit,
+        })
+
+    def _cloud_page(self, handler, values, params):
+        page = int(params.get('page', 1))
+        pagelen = min(int(params.get('pagelen', self.page_size)), self.page_size)
+        body = {
+            'values': values[(page - 1) * pagelen:page * pagelen],
+            'page': page,
+            'pagelen': pagelen,
+        }
+        if page * pagelen < len(values):
+            next_params = dict(params, page=page + 1)
+            body['next'] = '%s%s?%s' % (self.url, urlsplit(handler.path).path,
+                                        urlencode(next_params))
+        return (200, {}, body)
+
+    def _get_server_repositories(self, handler, params, proj):
+        slugs = sorted(set([r.split('/')[1] for (r, _) in self._branches
+                            if r.split('/')[0] == proj]))
+        return self._server_page([{'slug': x} for x in slugs], params)
+
+    def _get_server_branches(self, handler, params, proj, repo):
+        repository = '%s/%s' % (proj, repo)
+        branches = [{'id': 'refs/heads/%s' % b, 'displayId': b, 'latestCommit': h[-1]}
+                    for ((r, b), h) in sorted(self._branches.items()) if r == repository]
+        if not branches:
+            return (404, {}, {'errors': [{'message': 'Repository does not exist'}]})
+        return self._server_page(branches, params)
+
+    def _get_server_commits(self, handler, params, proj, repo):
+        history = self._get_history('%s/%s' % (proj, repo), params.get('until'),
+                                    params.get('since'))
+        if history is None:
+            return (404, {}, {'errors': [{'message': 'Commit does not exist'}]})
+
+        start = int(params.get('start', 0))
+        limit = min(int(params.get('limit', self.page_size)), self.page_size)
+        commits = [{
+            'id': x,
+            'displayId': x[:11],
+            'author': {'name': 'test', 'emailAddress': self.AUTHOR},
+            'authorTimestamp': self._get_commit_time(x) * 1000,
+            'message': 'commit %s' % x[:8],
+        } for x in history[start:start + limit]]
+
+        # only the requested page of the commits is built
+        (status, headers, body) = self._server_page(commits, dict(params, start=0))
+        body.update({
+            'start': start,
+            'isLastPage': start + limit >= len(history),
+            'nextPageStart': start + limit,
+        })
+        return (status, headers, body)
+
+    def _get_server_changes(self, handler, params, proj, repo, commit_id):
+        if commit_id not in self._commits:
+            return (404, {}, {'errors': [{'message': 'Commit does not exist'}]})
+
+        changes = [{'type': 'MODIFY', 'path': {'toString': x}}
+                   for x in self._get_changed_files(commit_id)]
+        return self._server_page(changes, params)
+
+    def _get_cloud_repositories(self, handler, params, workspace):
+        slugs = sorted(set([r.split('/')[1] for (r, _) in self._branches
+                            if r.split('/')[0] == workspace]))
+        return self._cloud_page(handler, [{'slug': x} for x in slugs], params)
+
+    def _get_cloud_branches(self, handler, params, workspace, repo):
+        repository = '%s/%s' % (workspace, repo)
+        branches = [{'name': b, 'target': {'hash': h[-1]}}
+                    for ((r, b), h) in sorted(self._branches.items()) if r == repository]
+        if not branches:
+            return (404, {}, {'error': {'message': 'Repository not found'}})
+
+        # The ETag reflects the tips of all branches, then the unchanged branches are
+        # answered by '304 Not Modified'
+        etag = '"%s"' % hashlib.sha1(json.dumps(branches).encode('utf-8')).hexdigest()
+        if handler.headers.get('If-None-Match') == etag:
+            return (304, {'ETag': etag}, None)
+
+        (status, headers, body) = self._cloud_page(handler, branches, params)
+        return (status, dict(headers, ETag=etag), body)
+
+    def _get_cloud_commits(self, handler, params, workspace, repo, until):
+        repository = '%s/%s' % (workspace, repo)
+        history = self._get_history(repository, until, params.get('exclude'))
+        if history is None:
+            return (404, {}, {'error': {'message': 'Commit not found'}})
+
+        page = int(params.get('page', 1))
+        pagelen = min(int(params.get('pagelen', self.page_size)), self.page_size)
+        commits = [{
+            'type': 'commit',
+            'hash': x,
+            'author': {'raw': 'test <%s>' % self.AUTHOR},
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S+00:00',
+                                  time.gmtime(self._get_commit_time(x))),
+            'message': 'commit %s' % x[:8],
+            'links': {'self': {
+                'href': '%s/2.0/repositories/%s/commit/%s' % (self.url, repository, x),
+            }},
+        } for x in history[(page - 1) * pagelen:page * pagelen]]
+
+        # only the requested page of the commits is built
+        body = {'values': commits, 'page': page, 'pagelen': pagelen}
+        if page * pagelen < len(history):
+            body['next'] = '%s%s?%s' % (self.url, urlsplit(handler.path).path,
+                                        urlencode(dict(params, page=page + 1)))
+        return (200, {}, body)
+
+    def _get_cloud_diffstat(self, handler, params, workspace, repo, commit_id):
+        if commit_id not in self._commits:
+            return (404, {}, {'error': {'message': 'Commit not found'}})
+
+        diffstat = [{'status': 'modified', 'old': {'path': x}, 'new': {'path': x}}
+                    for x in self._get_changed_files(commit_id)]
+        return self._cloud_page(handler, diffstat, params)
@@ -0,0 +1,121 @@
+import json
+import mock
+import requests
+import shutil
+import tempfile
+import time
+import yaml
+
+from delete_issues import DeleteIssuesAction
+from lib.cache import DatastoreCache
+from lib.cache import DiskCache
+from list_branches import ListBrachesAction
+from st2tests.base import BaseActionTestCase
+
+
+class ActionCacheTestCase(BaseActionTestCase):
+    action_cls = ListBrachesAction
+
+    def setUp(self):
+        super(ActionCacheTestCase, self).setUp()
+
+        self.cfg = yaml.safe_load(self.get_fixture_content('cfg_cloud.yaml'))
+        self.cfg['cache'] = {'backend': 'datastore', 'ttl': 60, 'size': 10}
+
+        self.branches = {'master': {'branch': 'master'}}
+        self.requests = []
+
+        patcher = mock.patch.object(requests.Session, 'send', side_effect=self.send)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, request, **kwargs):
+        self.requests.append((request.method, request.url))
+
+        mock_response = mock.Mock(status_code=200, reason='OK')
+        if request.method == 'GET':
+            mock_response.text = json.dumps(self.branches)
+        else:
+            (mock_response.status_code, mock_response.text) = (204, '')
+        return mock_response
+
+    def list_cache_names(self):
+        return [x.name for x in self.action_service.list_values(local=False,
+                                                                prefix='bitbucket.cache.')]
+
+    def run_action(self, action_cls, **kwargs):
+        # st2 sets the action_service after the action is instantiated as well as this
+        action = action_cls(config=self.cfg)
+        action.action_service = self.action_service
+        return action.run(**kwargs)
+
+    def test_hitting_cached_response(self):
+        self.assertEqual(self.run_action(ListBrachesAction, repo='foo/bar'), self.branches)
+        self.assertEqual(self.run_action(ListBrachesAction, repo='foo/bar'), self.branches)
+        self.assertEqual(len(self.requests), 1)
+
+        # the response is stored by the key which every action shares
+        self.assertEqual(len(self.list_cache_names()), 1)
+        self.assertEqual(self.action_service.list_values(), [])
+
+        # the other repository isn't served from the cache
+        self.run_action(ListBrachesAction, repo='foo/baz')
+        self.assertEqual(len(self.requests), 2)
+
+    def test_expiring_cached_response(self):
+        self.run_action(ListBrachesAction, repo='foo/bar')
+
+        with mock.patch('lib.cache.time.time', return_value=time.time() + 61):
+            self.run_action(ListBrachesAction, repo='foo/bar')
+        self.assertEqual(len(self.requests), 2)
+
+    def test_invalidating_cached_response_by_other_action(self):
+        self.run_action(ListBrachesAction, repo='foo/bar')
+        self.run_action(ListBrachesAction, repo='foo/baz')
+
+        (success, _) = self.run_action(DeleteIssuesAction, repo='foo/bar', ids=[1],
+                                       concurrency=1, retries=0)
+        self.assertTrue(success)
+
+        # only the responses of the modified repository are requested again
+        self.run_action(ListBrachesAction, repo='foo/bar')
+        self.run_action(ListBrachesAction, repo='foo/baz')
+        self.assertEqual([x[0] for x in self.requests], ['GET', 'GET', 'DELETE', 'GET'])
+        self.assertIn('/foo-bar/branches/', self.requests[-1][1])
+
+    def test_invalidating_cache_once_per_bulk_operation(self):
+        self.run_action(ListBrachesAction, repo='foo/bar')
+
+        with mock.patch.object(DatastoreCache, 'invalidate') as invalidate:
+            (success, _) = self.run_action(DeleteIssuesAction, repo='foo/bar', ids=[1, 2, 3],
+                                           concurrency=2, retries=0)
+        self.assertTrue(success)
+        self.assertEqual(invalidate.call_count, 1)
+        self.assertIn('repositories/username/foo-bar/', invalidate.call_args[0][0])
+
+    def test_creating_cache_lazily(self):
+        action = self.get_action_instance(config=self.cfg)
+        self.assertIsInstance(action._get_cache(), DatastoreCache)
+
+        action = ListBrachesAction(config=self.cfg)
+        action.action_service = self.action_service
+        self.assertIsInstance(action._get_cache(), DatastoreCache)
+
+    def test_limiting_size_of_cache(self):
+        cache = DatastoreCache(self.action_service, size=1)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+
+        # the entry of the same slot is evicted
+        self.assertEqual(len(self.list_cache_names()), 1)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('bar'), 2)
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        cache = DiskCache(path, size=1)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('bar'), 2)
@@ -0,0 +1,79 @@
+import math
+import os
+import unittest
+
+from benchmark_repository_sensor import find_regressions
+from benchmark_repository_sensor import run_benchmark
+from repository_sensor import RepositorySensor
+from st2tests.base import BaseSensorTestCase
+
+
+# The latency and the memory depend on the machine, then they're checked only on demand
+RUN_BENCHMARK = bool(os.environ.get('RUN_BENCHMARK'))
+
+
+class BenchmarkRepositorySensorTestCase(BaseSensorTestCase):
+    """
+    These run the benchmark in the small scale to catch the regressions of the number of
+    the API calls of the polling. The latency and the memory usage are checked as well when
+    the RUN_BENCHMARK environment variable is set.
+    """
+    sensor_cls = RepositorySensor
+
+    def assert_api_calls(self, service_type, engine):
+        (targets, commits, page_size) = (20, 60, 2)
+        result = run_benchmark(self.sensor_service, service_type, targets, commits,
+                               page_size=page_size, engine=engine)
+
+        self.assertEqual((result['polls'], result['dispatched']), (1, commits))
+
+        # Each target is requested its branches once, and only the new commits are walked.
+        # The changed files of each commit are requested once following all pages.
+        files_name = 'changes' if service_type == 'server' else 'diffstat'
+        self.assertEqual(result['calls'], {
+            'branches': targets,
+            'commits': targets * math.ceil(commits / targets / page_size),
+            files_name: commits * math.ceil(3 / page_size),
+        })
+
+        # the idle polling only requests the branches
+        self.assertEqual(result['idle_calls'], {'branches': targets})
+
+    def test_api_calls_of_server_polling(self):
+        self.assert_api_calls('server', 'thread')
+
+    def test_api_calls_of_server_polling_by_async_engine(self):
+        self.assert_api_calls('server', 'async')
+
+    def test_api_calls_of_cloud_polling(self):
+        self.assert_api_calls('cloud', 'thread')
+
+    def test_api_calls_of_cloud_polling_by_async_engine(self):
+        self.assert_api_calls('cloud', 'async')
+
+    @unittest.skipUnless(RUN_BENCHMARK, 'RUN_BENCHMARK is not set')
+    def test_latency_of_polling(self):
+        (targets, commits, latency) = (20, 40, 0.02)
+        result = run_benchmark(self.sensor_service, 'server', targets, commits, latency=latency)
+
+        # the requests are issued concurrently, then the polling is much faster than sequential
+        sequential_latency = sum(result['calls'].values()) * latency
+        self.assertLess(result['latency'], sequential_latency * 0.6)
+
+    @unittest.skipUnless(RUN_BENCHMARK, 'RUN_BENCHMARK is not set')
+    def test_memory_of_polling(self):
+        commits = 100
+        result = run_benchmark(self.sensor_service, 'server', 10, commits)
+
+        # the memory grows only by the new commits
+        self.assertLess(result['peak_memory'], 1024 * 1024 + commits * 16 * 1024)
+
+    def test_finding_regressions(self):
+        baseline = [{'service_type': 'server', 'engine': 'thread', 'targets': 10, 'commits': 1,
+                     'latency': 1.0, 'idle_latency': 0.1, 'peak_memory': 1000,
+                     'calls': {'branches': 10, 'commits': 1}, 'idle_calls': {'branches': 10}}]
+        result = dict(baseline[0], latency=1.1, calls={'branches': 10, 'commits': 2})
+
+        self.assertEqual(find_regressions([result], baseline, 0.2),
+                         ["server/thread/10/1 calls: {'branches': 10, 'commits': 1} -> "
+                          "{'branches': 10, 'commits': 2}"])
@@ -0,0 +1,95 @@
+import mock
+import threading
+import yaml
+
+from delete_issues import DeleteIssuesAction
+from delete_services import DeleteServicesAction
+from st2tests.base import BaseActionTestCase
+
+
+class BulkActionTestCase(BaseActionTestCase):
+    action_cls = DeleteIssuesAction
+
+    def setUp(self):
+        super(BulkActionTestCase, self).setUp()
+
+        self.cfg = yaml.safe_load(self.get_fixture_content('cfg_cloud.yaml'))
+
+        # the statuses which BitBucket answers for each id in order
+        self.statuses = {}
+        self.requests = []
+        self.barrier = None
+        self.local = threading.local()
+
+        self.bb = mock.MagicMock()
+        self.bb.issue.delete.side_effect = lambda issue_id: self.delete(issue_id)
+        self.bb.service.delete.side_effect = lambda service_id: self.delete(service_id)
+        self.bb.get_last_response.side_effect = lambda: self.local.response
+
+        patcher = mock.patch('lib.action.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def delete(self, item_id):
+        # the first requests of all ids are in flight at once when they run concurrently
+        is_first = item_id not in self.requests
+        self.requests.append(item_id)
+        if self.barrier and is_first:
+            self.barrier.wait()
+
+        (status, retry_after) = self.statuses[item_id].pop(0)
+        self.local.response = mock.Mock(status_code=status,
+                                        headers={'Retry-After': retry_after}
+                                        if retry_after else {})
+        if status < 300:
+            return (True, '')
+        elif status == 429:
+            return (False, 'Rate limit exceeded.')
+        return (False, 'Server error.' if status >= 500 else 'Service not found.')
+
+    def run_action(self, action_cls, **kwargs):
+        action = action_cls(config=self.cfg, action_service=self.action_service)
+        action._get_client = mock.Mock(return_value=self.bb)
+        return action.run(repo='foo/bar', **kwargs)
+
+    def test_retrying_rate_limited_request(self):
+        self.statuses = {
+            1: [(429, '2'), (204, None)],
+            2: [(404, None)],
+            3: [(503, None), (503, None), (204, None)],
+        }
+        (success, results) = self.run_action(DeleteIssuesAction, ids=[1, 2, 3],
+                                             concurrency=1, retries=3)
+
+        # the request which isn't found isn't retried and fails the action
+        self.assertFalse(success)
+        self.assertEqual(results, {
+            '1': {'success': True, 'status': 204, 'error': None},
+            '2': {'success': False, 'status': 404, 'error': 'Service not found.'},
+            '3': {'success': True, 'status': 204, 'error': None},
+        })
+        self.assertEqual(self.requests, [1, 1, 2, 3, 3, 3])
+
+        # the retries wait for the 'Retry-After' seconds, or back off exponentially
+        self.assertEqual([x[0][0] for x in self.sleep.call_args_list], [2.0, 1, 2])
+
+    def test_giving_up_after_retries(self):
+        self.statuses = {'svc': [(500, None), (429, None), (500, None)]}
+        (success, results) = self.run_action(DeleteServicesAction, ids=['svc'],
+                                             concurrency=1, retries=2)
+
+        self.assertFalse(success)
+        self.assertEqual(results, {'svc': {'success': False, 'status': 500,
+                                           'error': 'Server error.'}})
+        self.assertEqual(len(self.requests), 3)
+
+    def test_deleting_concurrently(self):
+        # all first requests have to be in flight at once to pass the barrier
+        self.barrier = threading.Barrier(3, timeout=10)
+        self.statuses = dict([(x, [(204, None)]) for x in range(3)])
+
+        (success, results) = self.run_action(DeleteIssuesAction, ids=[0, 1, 2],
+                                             concurrency=3, retries=0)
+        self.assertTrue(success)
+        self.assertEqual(sorted(results), ['0', '1', '2'])
+        self.assertFalse(self.barrier.broken)
@@ -0,0 +1,110 @@
+import mock
+import yaml
+
+from list_branches import ListBrachesAction
+from list_issues import ListIssuesAction
+from st2tests.base import BaseActionTestCase
+
+
+class ListIssuesActionTestCase(BaseActionTestCase):
+    action_cls = ListIssuesAction
+
+    def setUp(self):
+        super(ListIssuesActionTestCase, self).setUp()
+
+        self.cfg = yaml.safe_load(self.get_fixture_content('cfg_cloud.yaml'))
+        self.issues = [{'local_id': x, 'title': 'issue-%d' % x,
+                        'status': 'open' if x % 2 else 'resolved'} for x in range(1, 8)]
+        self.requests = []
+
+        self.action = self.get_action_instance(config=self.cfg)
+        self.bb = mock.Mock()
+        self.bb.issue.all.side_effect = self.get_issues
+        self.action._get_client = mock.Mock(return_value=self.bb)
+
+    def get_issues(self, params=None):
+        # this pages the issues in the same manner as the BitBucket
+        params = params or {}
+        self.requests.append(params)
+
+        issues = [x for x in self.issues if x['status'] == params.get('status', x['status'])]
+        start = params.get('start', 0)
+        limit = params.get('limit', 15)
+        return (True, {'count': len(issues), 'issues': issues[start:start + limit]})
+
+    def test_listing_issues_without_options(self):
+        result = self.action.run(repo='foo/bar')
+        self.assertEqual(result['count'], 7)
+        self.assertEqual(result['issues'], self.issues)
+
+        # the status filter doesn't change the result
+        result = self.action.run(repo='foo/bar', status='open')
+        self.assertEqual(result['count'], 4)
+        self.assertEqual([x['local_id'] for x in result['issues']], [1, 3, 5, 7])
+
+    def test_paging_issues(self):
+        result = self.action.run(repo='foo/bar', limit=3)
+        self.assertEqual([x['local_id'] for x in result['items']], [1, 2, 3])
+        self.assertEqual(result['next_cursor'], '3')
+
+        # only the issues of the page are requested
+        self.assertEqual(self.requests, [{'limit': 4, 'start': 0}])
+
+        result = self.action.run(repo='foo/bar', limit=3, cursor=result['next_cursor'])
+        self.assertEqual([x['local_id'] for x in result['items']], [4, 5, 6])
+
+        result = self.action.run(repo='foo/bar', limit=3, page=3)
+        self.assertEqual([x['local_id'] for x in result['items']], [7])
+        self.assertEqual(result['next_cursor'], None)
+
+    def test_filtering_and_projecting_issues(self):
+        result = self.action.run(repo='foo/bar', status='resolved', fields=['local_id'])
+        self.assertEqual(result, [{'local_id': 2}, {'local_id': 4}, {'local_id': 6}])
+        self.assertEqual(self.requests[0]['status'], 'resolved')
+
+        result = self.action.run(repo='foo/bar', status='open', limit=2, page=2,
+                                 fields=['title', 'unknown'])
+        self.assertEqual(result, {'items': [{'title': 'issue-5'}, {'title': 'issue-7'}],
+                                  'next_cursor': None})
+
+    def test_failing_to_list_issues(self):
+        self.bb.issue.all.side_effect = None
+        self.bb.issue.all.return_value = (False, 'Server error.')
+
+        self.assertEqual(self.action.run(repo='foo/bar'), (False, 'Server error.'))
+        self.assertEqual(self.action.run(repo='foo/bar', limit=3), (False, 'Server error.'))
+
+
+class ListBranchesActionTestCase(BaseActionTestCase):
+    action_cls = ListBrachesAction
+
+    def setUp(self):
+        super(ListBranchesActionTestCase, self).setUp()
+
+        self.cfg = yaml.safe_load(self.get_fixture_content('cfg_cloud.yaml'))
+        self.branches = dict([(x, {'branch': x, 'raw_node': '%040x' % i})
+                              for (i, x) in enumerate(['master', 'dev', 'feature'])])
+
+        self.action = self.get_action_instance(config=self.cfg)
+        self.bb = mock.Mock()
+        self.bb.get_branches.return_value = (True, self.branches)
+        self.action._get_client = mock.Mock(return_value=self.bb)
+
+    def test_listing_branches_without_options(self):
+        self.assertEqual(self.action.run(repo='foo/bar'), self.branches)
+
+    def test_paging_and_projecting_branches(self):
+        result = self.action.run(repo='foo/bar', limit=2, fields=['branch'])
+        self.assertEqual(result, {'items': [{'branch': 'dev'}, {'branch': 'feature'}],
+                                  'next_cursor': '2'})
+
+        result = self.action.run(repo='foo/bar', limit=2, cursor='2', fields=['branch'])
+        self.assertEqual(result, {'items': [{'branch': 'master'}], 'next_cursor': None})
+
+        result = self.action.run(repo='foo/bar', fields=['branch'])
+        self.assertEqual(result, [{'branch': 'dev'}, {'branch': 'feature'}, {'branch': 'master'}])
+
+    def test_failing_to_list_branches(self):
+        self.bb.get_branches.return_value = (False, 'Service not found.')
+
+        self.assertEqual(self.action.run(repo='foo/bar'), (False, 'Service not found.'))
@@ -1,16 +1,33 @@
 from collections.abc import Iterator
+import copy
+import itertools
 import mock
+import os
+import pstats
+import requests
+import shutil
 import stashy
+import sys
+import tempfile
+import threading
 import time
 import json
 import yaml
 
 from datetime import datetime
 from datetime import timedelta
-from pybitbucket.commit import Commit
-from pybitbucket.user import User
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from commit_parser import parse_cloud_date
+from repository_sensor import DispatchedCommits
+from repository_sensor import EventIdAllocator
+from repository_sensor import LRUCache
+from repository_sensor import PathFilter
 from repository_sensor import RepositorySensor
+from repository_sensor import ShardCoordinator
 from st2tests.base import BaseSensorTestCase
+from st2tests.mocks.sensor import MockSensorService
+from st2tests.mocks.sensor import MockSensorWrapper
+from webhook_sensor import WebhookSensor
 
 
 class RepositorySensorTestCase(BaseSensorTestCase):
@@ -23,13 +40,19 @@ class RepositorySensorTestCase(BaseSensorTestCase):
         def get_mock(name):
             return self.client_mock_for_server()
 
-        def get_commits(_branch):
-            self.dummy_commits.delay = self.delay
-            return self.dummy_commits
+        def get_commits(until, since=None):
+            self.commits_requests.append((until, since))
 
-        mock_response = mock.Mock()
-        mock_response.content = json.dumps({
-            'values': [
+            # each call has its own iterator because branches are checked concurrently
+            commits = self.dummy_commits.start_at(until, since)
+            commits.delay = self.delay
+            return commits
+
+        def get_changes(url, params=None):
+            self.changes_requests.append((url, params))
+
+            # the changes of each commit are split into two pages
+            changes = [
                 {
                     'type': 'ADD',
                     'path': {'toString': 'foo/bar'},
@@ -50,20 +73,80 @@ class RepositorySensorTestCase(BaseSensorTestCase):
                     'type': 'MODIFY',
                     'path': {'toString': 'fuga'},
                 },
-            ],
-        })
+            ]
+            start = (params or {}).get('start', 0)
+
+            mock_response = mock.Mock()
+            mock_response.status_code = self.changes_status
+            mock_response.ok = self.changes_status == 200
+            mock_response.content = json.dumps({
+                'values': changes[start:start + 3],
+                'isLastPage': start + 3 >= len(changes),
+                'nextPageStart': start + 3,
+            })
+            return mock_response
+
+        def get_branches():
+            self.branches_requests.append(True)
+            if self.branches_error:
+                raise self.branches_error
+
+            # all branches share the commits
+            tip = self.dummy_commits.commits[0].commit_id
+            return iter([{'displayId': x, 'latestCommit': tip} for x in self.branch_names])
+
+        def paginate(path, params=None):
+            if path == '/commits':
+                # the listing of the commits is started from the specified index
+                start = params.get('start', 0)
+                self.commits_starts.append(start)
+
+                commits = get_commits(params['until'], since=params.get('since'))
+                commits.commits = commits.commits[start:]
+                return commits
+
+            return iter([{'displayId': k, 'latestCommit': v} for (k, v) in self.tags.items()])
+
+        def get_pull_request(pr_id):
+            pr = mock.Mock()
+            pr.get.return_value = dict(self.closed_pull_requests[pr_id], id=int(pr_id))
+            return pr
+
+        def list_repositories():
+            self.list_requests.append(True)
+            return iter([{'slug': x} for x in self.repositories])
 
         client = mock.MagicMock()
         client.projects.__getitem__.side_effect = get_mock
+        client.repos.list.side_effect = list_repositories
+        client.branches.side_effect = get_branches
         client.repos.__getitem__.side_effect = get_mock
         client.commits.side_effect = get_commits
-        client._client.get.return_value = mock_response
+        client._client.get.side_effect = get_changes
+        client.url.side_effect = lambda path: path
+        client.paginate.side_effect = paginate
+        client.pull_requests.all.side_effect = lambda state: iter(self.pull_requests)
+        client.pull_requests.__getitem__.side_effect = get_pull_request
 
         return client
 
     def setUp(self):
         super(RepositorySensorTestCase, self).setUp()
 
+        self.commits_requests = []
+        self.commits_starts = []
+        self.commits_status = 200
+        self.changes_requests = []
+        self.changes_status = 200
+        self.branches_requests = []
+        self.branches_error = None
+        self.list_requests = []
+        self.repositories = ['bar', 'baz', 'qux']
+        self.branch_names = ['master', 'dev']
+        self.tags = {}
+        self.pull_requests = []
+        self.closed_pull_requests = {}
+
         self.cfg_server = yaml.safe_load(self.get_fixture_content('cfg_server.yaml'))
         self.cfg_cloud = yaml.safe_load(self.get_fixture_content('cfg_cloud.yaml'))
 
@@ -116,6 +199,29 @@ class RepositorySensorTestCase(BaseSensorTestCase):
         self.assertEqual(changing_files['deleted'], ['abcd'])
         self.assertEqual(sorted(changing_files['modified']), sorted(['hoge', 'fuga']))
 
+    def test_loading_only_backend_of_bitbucket_type(self):
+        self.dummy_commits = MockCommitsForServer(1, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        # the backend of the BitBucket Cloud (and pybitbucket) can't be imported
+        with mock.patch.dict(sys.modules, {'cloud_backend': None, 'pybitbucket': None}):
+            with mock.patch.object(stashy, 'connect',
+                                   mock.Mock(return_value=self.client_mock_for_server())):
+                sensor.setup()
+                self.dummy_commits.insert_commit(1)
+                sensor.poll()
+
+        self.assertEqual(type(sensor._backend).__name__, 'ServerBackend')
+        self.assertEqual(len(self.get_dispatched_triggers()), 3)
+
+        # the unknown type is rejected
+        self.cfg_server['sensor']['bitbucket_type'] = 'unknown'
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+        with self.assertRaises(ValueError):
+            sensor.setup()
+
     def test_dispatching_commit_from_server_with_timeout(self):
         # set variables for Bitbucket Server test
         self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
@@ -145,46 +251,1089 @@ class RepositorySensorTestCase(BaseSensorTestCase):
             self.sensor_service.dispatched_triggers = []
 
             # get commits that could not acquired due to the timeout
+            self.delay = 0
+            self.commits_starts = []
+            sensor.TIMEOUT_SECONDS = 20
             sensor.poll()
             contexts_second = self.get_dispatched_triggers()
 
-        self.assertEqual(len(contexts_first), 1)
+            # the resumed walks are started from the commits which haven't been checked
+            self.assertEqual(sorted(self.commits_starts),
+                             sorted([len(x['payload']['payload']['commits'])
+                                     for x in contexts_first]))
+
+            # there is no commit to be dispatched after finishing the commit walk
+            self.sensor_service.dispatched_triggers = []
+            sensor.poll()
+            self.assertEqual(self.get_dispatched_triggers(), [])
+
+        # every branch is checked with its own deadline, so all of them are dispatched
+        self.assertEqual(len(contexts_first), 3)
+        self.assertTrue(all([len(x['payload']['payload']['commits']) <= 10
+                             for x in contexts_first]))
+
+        # the rest commits are dispatched in the second polling without duplication
+        self.assertEqual(len(contexts_second), 3)
+        for context in contexts_first:
+            p1 = context['payload']['payload']
+            p2 = [x['payload']['payload'] for x in contexts_second
+                  if (x['payload']['payload']['repository'] == p1['repository'] and
+                      x['payload']['payload']['branch'] == p1['branch'])][0]
+
+            msgs1 = [x['msg'] for x in p1['commits']]
+            msgs2 = [x['msg'] for x in p2['commits']]
+            self.assertEqual(set(msgs1) & set(msgs2), set())
+            self.assertEqual(len(msgs1) + len(msgs2), 99)
+
+    def test_dispatching_commit_after_server_error(self):
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+            self.dummy_commits.insert_commit(1)
+
+            # the changes of the commits can't be fetched by the server error
+            self.changes_status = 500
+            sensor.poll()
+            self.assertEqual(self.get_dispatched_triggers(), [])
+            self.assertEqual(sensor.last_commit['foo/bar']['master'], '%040x' % 0)
+
+            # the commits are dispatched once the changes are recovered, even though the
+            # branches can't be fetched (then every branch of the target is walked)
+            self.changes_status = 200
+            self.branches_error = stashy.errors.GenericException(mock.Mock(status_code=500))
+            sensor.poll()
+
+            contexts = self.get_dispatched_triggers()
+            self.assertEqual(len(contexts), 3)
+            self.assertTrue(all([len(x['payload']['payload']['commits']) == 1
+                                 for x in contexts]))
+
+            # there is no commit to be dispatched again
+            self.sensor_service.dispatched_triggers = []
+            self.branches_error = None
+            sensor.poll()
+            self.assertEqual(self.get_dispatched_triggers(), [])
+
+    def test_dispatching_commit_which_has_older_author_date(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            # the last checked commit is stored as the commit-id of the branch tip
+            self.assertEqual(sensor.last_commit['foo/bar']['master'], '%040x' % 0)
+
+            # add a cherry-picked commit whose author date is older than the tip
+            self.dummy_commits.insert_commit(-100)
+
+            sensor.poll()
+
+        contexts = self.get_dispatched_triggers()
+        self.assertEqual(len(contexts), 3)
+        self.assertTrue(all([len(x['payload']['payload']['commits']) == 1 for x in contexts]))
+        self.assertEqual(sensor.last_commit['foo/bar']['master'], '%040x' % 3)
+
+    def test_restoring_last_commit_from_datastore(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            self.get_sensor_instance(config=self.cfg_server).setup()
+
+        # add commits while the sensor is stopped
+        self.dummy_commits.insert_commit(1)
+        self.dummy_commits.insert_commit(2)
+
+        self.commits_requests = []
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            # restart the sensor, the last checked commits are restored from the datastore
+            sensor = self.get_sensor_instance(config=self.cfg_server)
+            sensor.setup()
+            self.assertEqual(self.commits_requests, [])
+
+            sensor.poll()
+
+        # the commits which were pushed while the sensor is stopped are dispatched
+        contexts = self.get_dispatched_triggers()
+        self.assertEqual(len(contexts), 3)
+        self.assertTrue(all([len(x['payload']['payload']['commits']) == 2 for x in contexts]))
+
+    def test_dispatching_commit_in_bounded_batches(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        cfg = copy.deepcopy(self.cfg_server)
+        cfg['sensor']['batch_size'] = 4
+        sensor = self.get_sensor_instance(config=cfg)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            for i in range(10, 0, -1):
+                self.dummy_commits.insert_commit(i)
+
+            dispatched_commits = []
+            for _ in range(3):
+                self.sensor_service.dispatched_triggers = []
+                sensor.poll()
+                dispatched_commits.append([len(x['payload']['payload']['commits'])
+                                           for x in self.get_dispatched_triggers()])
+
+        self.assertEqual(dispatched_commits, [[4, 4, 4], [4, 4, 4], [2, 2, 2]])
+
+    def test_allocating_event_ids_from_leased_block(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        cfg = copy.deepcopy(self.cfg_server)
+        cfg['sensor']['event_id_block_size'] = 2
+        cfg['sensor']['instance_name'] = 'node1'
+        sensor = self.get_sensor_instance(config=cfg)
+
+        # the counter of this instance is continued from the last run
+        self.sensor_service.set_value(name='bitbucket.repository_event.node1.repository',
+                                      value='5')
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            self.dummy_commits.insert_commit(1)
+            with mock.patch.object(self.sensor_service, 'get_value',
+                                   wraps=self.sensor_service.get_value) as get_value:
+                sensor.poll()
+
+            # three events are dispatched by leasing two blocks of ids
+            self.assertEqual(get_value.call_count, 2)
+
+        ids = sorted([x['payload']['id'] for x in self.get_dispatched_triggers()])
+        self.assertEqual(ids, ['node1.repository:5', 'node1.repository:6',
+                               'node1.repository:7'])
+
+        # the unused ids are returned to the counter of this instance at the cleanup
+        sensor.cleanup()
+        self.assertEqual(
+            self.sensor_service.get_value('bitbucket.repository_event.node1.repository'), '8')
+
+        # the other instances never hand out the same ids, even if they lease concurrently
+        allocators = [EventIdAllocator(self.sensor_service, 'bitbucket.repository_event',
+                                       'node%d.repository' % i, 2, mock.Mock())
+                      for i in range(2, 4)]
+        ids = [x.allocate() for _ in range(3) for x in allocators]
+        self.assertEqual(len(set(ids)), 6)
+        self.assertEqual(sorted(ids)[:3], ['node2.repository:1', 'node2.repository:2',
+                                           'node2.repository:3'])
+
+    def test_grouping_changed_files_by_branch(self):
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        commits = [
+            make_commit('foo/bar', 'master', added=['a'], modified=['b']),
+            make_commit('foo/bar', 'dev', added=['c']),
+            make_commit('foo/bar', 'master', modified=['b', 'd']),
+        ]
+        payloads = dict([(x['branch'], x) for x in sensor._group_commits(commits)])
+
+        self.assertEqual(len(payloads['master']['commits']), 2)
+        self.assertEqual(payloads['master']['changed_files']['added'], ['a'])
+        self.assertEqual(sorted(payloads['master']['changed_files']['modified']), ['b', 'd'])
+
+        # the changed files of the other branches are not mixed
+        self.assertEqual(len(payloads['dev']['commits']), 1)
+        self.assertEqual(payloads['dev']['changed_files']['added'], ['c'])
+        self.assertEqual(payloads['dev']['changed_files']['modified'], [])
+
+    def test_grouping_commits_in_linear_time(self):
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        class CountingCommit(dict):
+            # this counts the lookups of the fields of all commits
+            lookups = [0]
+
+            def __getitem__(self, key):
+                self.lookups[0] += 1
+                return dict.__getitem__(self, key)
+
+        def count_lookups(count):
+            # the number of the branches grows with the commits
+            commits = [CountingCommit(make_commit('foo/bar', 'branch-%d' % (i % (count // 10)),
+                                                  added=['file-%d' % i], modified=['common']))
+                       for i in range(count)]
+
+            CountingCommit.lookups[0] = 0
+            payloads = list(sensor._group_commits(commits))
+
+            self.assertEqual(len(payloads), count // 10)
+            self.assertEqual(sum([len(x['commits']) for x in payloads]), count)
+            return CountingCommit.lookups[0]
+
+        # each commit is looked up the same times regardless of the number of the branches,
+        # while the quadratic implementation looks up every commit for each branch
+        self.assertEqual(count_lookups(10000), count_lookups(1000) * 10)
+
+    def test_splitting_payloads_into_chunks(self):
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+        sensor.MAX_COMMITS_PER_EVENT = 3
+        sensor.MAX_FILES_PER_EVENT = 4
+
+        commits = [dict(make_commit('foo/bar', 'master', modified=['file-%d' % i]), id=str(i))
+                   for i in range(5)]
+        commits.append(dict(make_commit('foo/bar', 'master', added=['a', 'b', 'c'],
+                                        deleted=['d', 'e']), id='5'))
+        payloads = list(sensor._group_commits(commits))
+
+        # the chunks are bounded by the number of the commits and the changed files
+        self.assertEqual([[x['id'] for x in p['commits']] for p in payloads],
+                         [['0', '1', '2'], ['3', '4'], ['5']])
+        self.assertEqual([(x['chunk'], x['chunks']) for x in payloads], [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual(sorted(payloads[1]['changed_files']['modified']), ['file-3', 'file-4'])
+
+        # the changed files of the commit which exceed the limit are truncated
+        self.assertTrue(payloads[2]['commits'][0]['files_truncated'])
+        self.assertEqual(payloads[2]['commits'][0]['files']['deleted'], ['d'])
+        self.assertEqual(sorted(payloads[2]['changed_files']['added']), ['a', 'b', 'c'])
+
+        # the commits only have their ids in the compact mode
+        sensor.COMPACT_PAYLOAD = True
+        payloads = list(sensor._group_commits(commits))
+        self.assertEqual(payloads[0]['commits'], [{'id': '0'}, {'id': '1'}, {'id': '2'}])
+        self.assertEqual(sorted(payloads[0]['changed_files']['modified']),
+                         ['file-0', 'file-1', 'file-2'])
+
+    def test_caching_changes_of_commit(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            # the same commit lands on all branches
+            self.dummy_commits.insert_commit(1)
+            sensor.poll()
+
+        self.assertEqual(len(self.get_dispatched_triggers()), 3)
+
+        # the changes of the commit are fetched only once (the two pages of them)
+        self.assertEqual(self.changes_requests, [
+            ('/commits/%040x/changes' % 3, {}),
+            ('/commits/%040x/changes' % 3, {'start': 3}),
+        ])
+
+    def test_sending_metrics_of_polling(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        self.cfg_server['metrics'] = {'prefix': 'bb', 'profile_dir': profile_dir}
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        driver = mock.Mock()
+        with mock.patch('sensor_metrics.get_driver', mock.Mock(return_value=driver)), \
+                mock.patch.object(stashy, 'connect',
+                                  mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            self.dummy_commits.insert_commit(1)
+            sensor.poll()
+
+        counters = [x[0] for x in driver.inc_counter.call_args_list]
+        self.assertEqual(counters.count(('bb.sensor.dispatch', 1)), 3)
+        self.assertIn(('bb.sensor.commits', 1), counters)
+
+        # the metric keys don't have the repository names, which are unbounded
+        self.assertFalse([x for x in counters if x[0].startswith('bb.sensor.commits.')])
+        self.assertEqual(len([x for x in counters if x[0] == 'bb.sensor.cache.miss']) +
+                         len([x for x in counters if x[0] == 'bb.sensor.cache.hit']), 3)
+
+        timers = [x[0][0] for x in driver.time.call_args_list]
+        for key in ['bb.sensor.poll', 'bb.sensor.check', 'bb.sensor.dispatch', 'bb.sensor.walk']:
+            self.assertIn(key, timers)
+        self.assertFalse([x for x in timers if x.startswith('bb.sensor.walk.')])
+
+        # the profile of the polling cycle contains the jobs on the worker pools
+        profiles = os.listdir(profile_dir)
+        self.assertEqual(len(profiles), 1)
+        stats = pstats.Stats(os.path.join(profile_dir, profiles[0]))
+        self.assertTrue(any([x[2] == 'parse_commit' for x in stats.stats]))
+
+    def test_evicting_entries_of_cache(self):
+        cache = LRUCache(2, 3600)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # the least recently used entry is evicted
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual([cache.get(x) for x in ['a', 'b', 'c']], [1, None, 3])
+
+        # the expired entry is reloaded
+        cache = LRUCache(2, 0)
+        self.assertEqual(cache.get_or_load('a', lambda: 1), 1)
+        time.sleep(0.01)
+        self.assertEqual(cache.get_or_load('a', lambda: 2), 2)
+
+    def test_walking_only_moved_branches(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            # the branches of each repository are requested once, and no branch is walked
+            self.commits_requests = []
+            sensor.poll()
+            self.assertEqual(len(self.branches_requests), 2)
+            self.assertEqual(self.commits_requests, [])
+
+            # only the moved branches are walked
+            self.dummy_commits.insert_commit(1)
+            sensor.poll()
+            self.assertEqual(len(self.commits_requests), 3)
+
+        self.assertEqual(len(self.get_dispatched_triggers()), 3)
+
+    def test_backing_off_idle_repositories(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+        self.cfg_server['sensor']['poll_interval'] = 30
+        self.cfg_server['sensor']['max_poll_interval'] = 120
+        self.cfg_server['sensor']['poll_jitter'] = 0
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+            self.assertEqual(sensor.get_poll_interval(), 30)
+
+            # the idle repositories are backed off after the first polling
+            sensor.poll()
+            self.assertEqual(len(self.branches_requests), 2)
+            self.assertEqual([x['interval'] for x in sensor._schedule.values()], [60, 60])
+
+            # none of repositories is due at the next polling
+            self.dummy_commits.insert_commit(1)
+            sensor.poll()
+            self.assertEqual(len(self.branches_requests), 2)
+            self.assertEqual(len(self.get_dispatched_triggers()), 0)
+
+            # the active repositories are reset to the shortest interval
+            for schedule in sensor._schedule.values():
+                schedule['next'] = 0
+            sensor.poll()
+            self.assertEqual(len(self.branches_requests), 4)
+            self.assertEqual([x['interval'] for x in sensor._schedule.values()], [30, 30])
+
+            # the interval doesn't exceed the ceiling
+            for _ in range(4):
+                for schedule in sensor._schedule.values():
+                    schedule['next'] = 0
+                sensor.poll()
+            self.assertEqual([x['interval'] for x in sensor._schedule.values()], [120, 120])
+
+        self.assertEqual(len(self.get_dispatched_triggers()), 3)
+
+    def test_skipping_commits_dispatched_by_webhook(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+        self.cfg_server['sensor']['webhook'] = {'port': 8090}
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            self.dummy_commits.insert_commit(1)
+            self.dummy_commits.insert_commit(2)
+
+            # the webhook has dispatched all new commits of a branch, and a commit of another
+            dispatched = DispatchedCommits(self.sensor_service)
+            dispatched.add('foo/bar', 'master', ['%040x' % 4, '%040x' % 3],
+                           '%040x' % 0, '%040x' % 4)
+            dispatched.add('hoge/fuga', 'master', ['%040x' % 4], '%040x' % 3, None)
+
+            self.commits_requests = []
+            sensor.poll()
+
+        # the branch which the webhook has dispatched until the tip isn't walked
+        self.assertEqual(len(self.commits_requests), 2)
+        self.assertEqual(sensor.last_commit['foo/bar']['master'], '%040x' % 4)
+
+        contexts = self.get_dispatched_triggers()
+        self.assertEqual(len(contexts), 2)
+        self.assertEqual([x['id'] for x in self.filter_payload(contexts, 'branch', 'master')[0][
+            'commits']], ['%040x' % 3])
+        self.assertEqual([x['id'] for x in self.filter_payload(contexts, 'branch', 'dev')[0][
+            'commits']], ['%040x' % 4, '%040x' % 3])
+
+        # the commits dispatched by the polling are shared with the webhook
+        self.assertEqual(dispatched.get_commits('hoge/fuga', 'dev'), set(['%040x' % 4,
+                                                                          '%040x' % 3]))
+        record = dispatched.get('hoge/fuga', 'dev')
+        self.assertEqual((record['base'], record['head']), ('%040x' % 4, '%040x' % 4))
+
+        # each commit-id is recorded by its own key with the TTL
+        with mock.patch.object(self.sensor_service, 'set_value') as set_value:
+            dispatched.add('foo/bar', 'dev', ['%040x' % 5, '%040x' % 6])
+        self.assertEqual([x[1]['ttl'] for x in set_value.call_args_list[:2]],
+                         [DispatchedCommits.TTL] * 2)
+
+    def test_sharing_dispatched_commits_with_webhook_sensor(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+        self.cfg_server['sensor']['webhook'] = {'host': '127.0.0.1', 'port': 0}
+
+        # each sensor has its own sensor_service, whose local keys are namespaced by
+        # the sensor class, on the same datastore
+        webhook_service = MockSensorService(MockSensorWrapper('tests', 'WebhookSensor'))
+        webhook_service._datastore_service._datastore_items = \
+            self.sensor_service._datastore_service._datastore_items
+        webhook_sensor = WebhookSensor(sensor_service=webhook_service, config=self.cfg_server)
+        webhook_sensor.setup()
+        self.addCleanup(webhook_sensor.cleanup)
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            self.dummy_commits.insert_commit(1)
+            self.dummy_commits.insert_commit(2)
+
+            # the webhook dispatches one of the new commits before the polling
+            webhook_sensor._dispatch_push('foo/bar', 'master',
+                                          [dict(make_commit('foo/bar', 'master'),
+                                                id='%040x' % 4)], None, None)
+            sensor.poll()
+
+        self.assertEqual(len(webhook_service.dispatched_triggers), 1)
+        self.assertEqual([x['id'] for x in self.filter_payload(
+            self.get_dispatched_triggers(), 'branch', 'master')[0]['commits']], ['%040x' % 3])
+
+        # the commits dispatched by the polling are dropped by the webhook as well
+        webhook_sensor._dispatch_push('hoge/fuga', 'dev',
+                                      [dict(make_commit('hoge/fuga', 'dev'), id='%040x' % 3)],
+                                      None, None)
+        self.assertEqual(len(webhook_service.dispatched_triggers), 1)
+
+    def test_coalescing_commits_in_window(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(1, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        self.cfg_server['sensor']['targets'][0]['coalesce'] = {'window': 60, 'max_commits': 3}
+
+        def poll(sensor, now=None):
+            self.sensor_service.dispatched_triggers = []
+            with mock.patch.object(time, 'time', return_value=now or time.time()):
+                sensor.poll()
+            return dict([((x['payload']['payload']['repository'],
+                           x['payload']['payload']['branch']),
+                          [c['id'] for c in x['payload']['payload']['commits']])
+                         for x in self.get_dispatched_triggers()])
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor = self.get_sensor_instance(config=self.cfg_server)
+            sensor.setup()
+
+            # the commits of the target which has the window are held over
+            started_at = time.time()
+            self.dummy_commits.insert_commit(1)
+            self.assertEqual(sorted(poll(sensor)), [('hoge/fuga', 'dev'),
+                                                    ('hoge/fuga', 'master')])
+            self.dummy_commits.insert_commit(2)
+            self.assertEqual(sorted(poll(sensor)), [('hoge/fuga', 'dev'),
+                                                    ('hoge/fuga', 'master')])
+
+            # the buffered commits are restored after restarting
+            sensor = self.get_sensor_instance(config=self.cfg_server)
+            sensor.setup()
+            self.assertEqual(len(sensor.pending_commits['foo/bar']['master']['commits']), 2)
+
+            # they're merged into one event when the window closes
+            self.assertEqual(poll(sensor, started_at + 61), {
+                ('foo/bar', 'master'): ['%040x' % 2, '%040x' % 1],
+            })
+
+            # or when the buffered commits reach the limit
+            for i in range(3):
+                self.dummy_commits.insert_commit(i)
+            self.assertEqual(poll(sensor)[('foo/bar', 'master')],
+                             ['%040x' % 5, '%040x' % 4, '%040x' % 3])
+        self.assertEqual(sensor.pending_commits['foo/bar'], {})
+
+    def test_filtering_commits_by_paths(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(1, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        self.cfg_server['sensor']['targets'][0]['paths'] = {'include': ['docs/*']}
+        self.cfg_server['sensor']['targets'][1]['paths'] = {'include': ['hoge', 'foo/*'],
+                                                            'exclude': ['foo/*']}
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            # the commits which don't change any watched path are dropped after the walk
+            self.dummy_commits.insert_commit(1)
+            sensor.poll()
+
+            contexts = self.get_dispatched_triggers()
+            self.assertEqual(sorted([x['payload']['payload']['branch'] for x in contexts]),
+                             ['dev', 'master'])
+            self.assertTrue(all([x['payload']['payload']['repository'] == 'hoge/fuga'
+                                 for x in contexts]))
+            self.assertEqual(sensor.last_commit['foo/bar']['master'], '%040x' % 1)
+
+            # Every new commit is checked by its own changed files (the changes of the whole
+            # range would miss the change which is reverted by the following commit).
+            self.cfg_server['sensor']['targets'][0]['paths'] = {'include': ['foo/bar']}
+            sensor = self.get_sensor_instance(config=self.cfg_server)
+            sensor.setup()
+
+            self.dummy_commits.insert_commit(2)
+            self.dummy_commits.insert_commit(3)
+            self.sensor_service.dispatched_triggers = []
+            sensor.poll()
+
+            payloads = self.filter_payload(self.get_dispatched_triggers(), 'repository',
+                                           'foo/bar')
+            self.assertEqual([len(x['commits']) for x in payloads], [2])
+
+        path_filter = PathFilter.create({'include': ['docs/*'], 'exclude': ['docs/tmp/*']})
+        self.assertTrue(path_filter.match({'added': ['src/foo'], 'modified': ['docs/foo']}))
+        self.assertFalse(path_filter.match({'added': ['src/foo'], 'modified': ['docs/tmp/a']}))
+        self.assertIsNone(PathFilter.create({'include': []}))
+
+    def test_dispatching_ref_events(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(1, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        def pull_request(pr_id, title, state='OPEN'):
+            return {'id': pr_id, 'title': title, 'state': state,
+                    'author': {'user': {'emailAddress': 'test@test.local'}},
+                    'fromRef': {'displayId': 'feature/%d' % pr_id, 'latestCommit': 'abcd'},
+                    'toRef': {'displayId': 'master'}, 'updatedDate': 1500000000000}
+
+        self.cfg_server['sensor']['ref_events'] = ['tag', 'branch_created', 'branch_deleted',
+                                                   'pull_request']
+        self.cfg_server['sensor']['targets'][1]['branches'].append('feature/*')
+        self.tags = {'v1.0': 'a' * 40}
+        self.pull_requests = [pull_request(1, 'foo'), pull_request(3, 'bar')]
+
+        def get_ref_events():
+            return [(x['payload']['type'], x['payload']['payload'])
+                    for x in self.get_dispatched_triggers()
+                    if x['payload']['payload']['repository'] == 'hoge/fuga']
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor = self.get_sensor_instance(config=self.cfg_server)
+            sensor.setup()
+
+            # the first snapshot of the refs is taken without dispatching
+            sensor.poll()
+            self.assertEqual(self.get_dispatched_triggers(), [])
+
+            # the snapshot is restored after restarting
+            sensor = self.get_sensor_instance(config=self.cfg_server)
+            sensor.setup()
+            self.assertEqual(sorted(sensor.refs['hoge/fuga']['pull_requests']), ['1', '3'])
+
+            self.branch_names = ['master', 'feature/x', 'topic']
+            self.tags = {'v1.0': 'b' * 40, 'v1.1': 'c' * 40}
+            self.pull_requests = [pull_request(1, 'foo (updated)'), pull_request(2, 'baz')]
+            self.closed_pull_requests = {'3': pull_request(3, 'bar', 'MERGED')}
+            sensor.poll()
+
+        tip = self.dummy_commits.commits[0].commit_id
+        self.assertEqual([(t, x.get('branch') or x.get('tag') or x['action'])
+                          for (t, x) in get_ref_events()], [
+            ('branch_created', 'feature/x'),
+            ('branch_deleted', 'dev'),
+            ('tag', 'v1.0'),
+            ('tag', 'v1.1'),
+            ('pull_request', 'updated'),
+            ('pull_request', 'opened'),
+            ('pull_request', 'merged'),
+        ])
+
+        events = get_ref_events()
+        self.assertEqual(events[0][1]['commit'], tip)
+        self.assertEqual([(x['action'], x['commit']) for (_, x) in events[2:4]],
+                         [('moved', 'b' * 40), ('created', 'c' * 40)])
+        self.assertEqual([(x['pull_request']['id'], x['pull_request']['state'])
+                          for (_, x) in events[4:]], [(1, 'open'), (2, 'open'), (3, 'merged')])
+        self.assertEqual(events[5][1]['pull_request']['source'], 'feature/2')
+
+        # the unwatched branches of the other target aren't dispatched
+        self.assertEqual(len([x for x in self.get_dispatched_triggers()
+                              if x['payload']['type'].startswith('branch_')]), 2)
+
+    def test_dispatching_commits_after_failing_to_check_refs(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(1, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        self.cfg_server['sensor']['ref_events'] = ['tag']
+        self.tags = {'v1.0': 'a' * 40}
+
+        def get_dispatched(event_type):
+            return [x['payload']['payload'] for x in self.get_dispatched_triggers()
+                    if x['payload']['type'] == event_type]
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor = self.get_sensor_instance(config=self.cfg_server)
+            sensor.setup()
+            sensor.poll()
+
+            # the commits are dispatched even though the tags can't be fetched
+            self.dummy_commits.insert_commit(1)
+            self.tags = {'v1.0': 'b' * 40}
+            with mock.patch.object(sensor._backend, 'get_tags',
+                                   side_effect=requests.ConnectionError('refused')):
+                sensor.poll()
+            self.assertEqual(len(get_dispatched('commit')), 3)
+            self.assertEqual(get_dispatched('tag'), [])
+
+            # the unexpected error of a repository doesn't stop the polling either
+            self.dummy_commits.insert_commit(2)
+            with mock.patch.object(sensor._backend, 'get_tags', side_effect=KeyError('tags')):
+                sensor.poll()
+            self.assertEqual(len(get_dispatched('commit')), 6)
+
+            # the last checked commits aren't advanced when the polling fails on the way
+            self.dummy_commits.insert_commit(3)
+            with mock.patch.object(sensor, '_filter_commits', side_effect=RuntimeError):
+                self.assertRaises(RuntimeError, sensor.poll)
+            self.assertEqual(len(get_dispatched('commit')), 6)
+
+            # the changes which have been missed are dispatched after recovering
+            sensor.poll()
+
+        self.assertEqual(len(get_dispatched('commit')), 9)
+        self.assertEqual([x['commit'] for x in get_dispatched('tag')], ['b' * 40, 'b' * 40])
+
+    def test_sharding_targets_between_sensors(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(1, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+
+        repositories = ['foo/repo%d' % i for i in range(10)]
+        self.cfg_server['sensor']['targets'] = [{'repository': x, 'branches': ['master']}
+                                                for x in repositories]
+        self.cfg_server['sensor']['sharding'] = True
+        sensors = [self.get_sensor_instance(config=copy.deepcopy(self.cfg_server),
+                                            poll_interval=30) for _ in range(2)]
+
+        def poll(*sensors):
+            self.sensor_service.dispatched_triggers = []
+            for sensor in sensors:
+                sensor.poll()
+            return sorted([x['payload']['payload']['repository']
+                           for x in self.get_dispatched_triggers()])
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            for sensor in sensors:
+                sensor.setup()
+
+            # the first instance leases all repositories until the other one joins
+            self.assertEqual(poll(sensors[0]), [])
+            self.dummy_commits.insert_commit(1)
+            self.assertEqual(poll(sensors[0]), repositories)
+
+            # The repositories are handed over after the first instance releases them, then
+            # the commits which have been dispatched by it aren't dispatched again.
+            self.assertEqual(poll(sensors[1], sensors[0], sensors[1]), [])
+            shards = [set(x._shard.confirm()) for x in sensors]
+            self.assertTrue(all(shards))
+            self.assertEqual(shards[0] | shards[1], set(repositories))
+            self.assertFalse(shards[0] & shards[1])
+
+            # each commit is dispatched exactly once by the owner of the repository
+            self.dummy_commits.insert_commit(2)
+            self.assertEqual(poll(*sensors), repositories)
+
+            # the repositories of the dead instance are taken over after its heartbeat expires
+            self.dummy_commits.insert_commit(3)
+            with mock.patch.object(time, 'time', return_value=time.time() + 91):
+                self.assertEqual(poll(sensors[1]), repositories)
+
+            # The instance which comes back doesn't poll the repositories which have been
+            # taken over, and they're handed back to it after the other one releases them.
+            self.dummy_commits.insert_commit(4)
+            self.assertEqual(poll(sensors[0], sensors[1]), sorted(shards[1]))
+            self.assertEqual(poll(sensors[0], sensors[1]), sorted(shards[0]))
+
+        # the instance which stops releases its leases and its heartbeat
+        for sensor in sensors:
+            sensor.cleanup()
+        self.assertEqual(self.sensor_service.list_values(prefix='shard_'), [])
+
+    def test_expiring_heartbeat_by_own_clock(self):
+        coordinators = [ShardCoordinator(self.sensor_service, 90, 8, mock.Mock())
+                        for _ in range(2)]
+        now = time.time()
+
+        def heartbeat(coordinator, at):
+            with mock.patch.object(time, 'time', return_value=at):
+                coordinator.heartbeat()
+            return coordinator._members
+
+        # the clock of the second instance is an hour ahead of the first one
+        heartbeat(coordinators[1], now + 3600)
+        self.assertEqual(len(heartbeat(coordinators[0], now)), 2)
+
+        # the second instance stops heartbeating, which is expired by the clock of the first one
+        self.assertEqual(len(heartbeat(coordinators[0], now + 60)), 2)
+        self.assertEqual(heartbeat(coordinators[0], now + 91), [coordinators[0].member_id])
+
+        # it joins again as soon as it heartbeats
+        heartbeat(coordinators[1], now + 3700)
+        self.assertEqual(len(heartbeat(coordinators[0], now + 92)), 2)
+
+    def test_discovering_wildcard_targets(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+        self.cfg_server['sensor']['targets'] = [
+            {'repository': 'foo/ba*', 'branches': ['d*']},
+            {'repository': 'foo/bar', 'branches': ['master']},
+        ]
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            # the explicit target takes precedence over the wildcard one
+            self.assertEqual(sensor.targets, [
+                {'repository': 'foo/bar', 'branches': ['master']},
+                {'repository': 'foo/baz', 'branches': ['d*']},
+            ])
+
+            # the matched branch is checked from the tip at the first polling
+            sensor.poll()
+            self.assertEqual(sensor.last_commit['foo/baz'], {'dev': '%040x' % 0})
+
+            self.dummy_commits.insert_commit(1)
+            sensor.poll()
+
+            contexts = self.get_dispatched_triggers()
+            self.assertEqual(sorted([(x['repository'], x['branch']) for x in
+                                     [c['payload']['payload'] for c in contexts]]),
+                             [('foo/bar', 'master'), ('foo/baz', 'dev')])
+
+            # the repositories are listed only when the discovery interval is elapsed
+            self.assertEqual(len(self.list_requests), 1)
+
+            self.repositories.append('bat')
+            sensor._discovered_at -= sensor.DISCOVERY_INTERVAL
+            sensor.poll()
+
+            self.assertEqual(len(self.list_requests), 2)
+            self.assertEqual([x['repository'] for x in sensor.targets],
+                             ['foo/bar', 'foo/baz', 'foo/bat'])
+
+    def test_keeping_discovered_targets_after_connection_error(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+        self.cfg_server['sensor']['targets'] = [{'repository': 'foo/ba*', 'branches': ['dev']}]
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+            sensor.poll()
+
+            # the repositories which have been discovered are polled when the listing fails
+            self.dummy_commits.insert_commit(1)
+            sensor._discovered_at -= sensor.DISCOVERY_INTERVAL
+            with mock.patch.object(sensor._backend, 'list_repositories',
+                                   side_effect=requests.ConnectionError('refused')):
+                sensor.poll()
+
+        self.assertEqual([x['repository'] for x in sensor.targets], ['foo/bar', 'foo/baz'])
+        self.assertEqual(sorted([x['payload']['payload']['repository']
+                                 for x in self.get_dispatched_triggers()]),
+                         ['foo/bar', 'foo/baz'])
+
+    def test_dispatching_commit_by_async_engine(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+        self.cfg_server['sensor']['engine'] = 'async'
+        self.cfg_server['sensor']['bitbucket_server_url'] = 'http://bitbucket.local'
+        self.cfg_server['sensor']['batch_size'] = 4
+
+        async def request(url, params=None, headers=None):
+            self.async_requests.append(url)
+
+            start = params.get('start', 0)
+            if url.endswith('/branches'):
+                tip = self.dummy_commits.commits[0].commit_id
+                values = [{'displayId': x, 'latestCommit': tip} for x in ['master', 'dev']]
+            elif url.endswith('/changes'):
+                values = [{'type': 'ADD', 'path': {'toString': 'foo/bar'}},
+                          {'type': 'MODIFY', 'path': {'toString': 'hoge'}}]
+            else:
+                commits = self.dummy_commits.start_at(params['until'], params.get('since'))
+                values = [x.data for x in commits.commits]
+
+            # each page has two values
+            return (200, {}, {
+                'values': values[start:start + 2],
+                'isLastPage': start + 2 >= len(values),
+                'nextPageStart': start + 2,
+            })
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            self.async_requests = []
+            with mock.patch.object(sensor._engine, '_request', side_effect=request):
+                for i in range(5, 0, -1):
+                    self.dummy_commits.insert_commit(i)
+
+                # the walk is bounded by the batch size, and resumed at the next polling
+                sensor.poll()
+                sensor.poll()
+                sensor.poll()
+
+            sensor.cleanup()
+
+        # the changed files of each commit are fetched once over the branches
+        self.assertEqual(len([x for x in self.async_requests if x.endswith('/changes')]), 5)
+        self.assertTrue(all([x.startswith('http://bitbucket.local/rest/api/1.0/projects/')
+                             for x in self.async_requests]))
+
+        contexts = self.get_dispatched_triggers()
+        self.assertEqual([len(x['payload']['payload']['commits']) for x in contexts],
+                         [4, 4, 4, 1, 1, 1])
+
+        payload = self.filter_payload(contexts, 'branch', 'dev')[0]
+        self.assertEqual([x['id'] for x in payload['commits']],
+                         ['%040x' % x for x in range(7, 3, -1)])
+        self.assertEqual(payload['commits'][0]['author'], 'test@test.local')
+        self.assertEqual(sorted(payload['changed_files']['modified']), ['hoge'])
+        self.assertEqual(sensor.last_commit['hoge/fuga']['dev'], '%040x' % 7)
+
+    def test_resuming_async_walk_after_unexpected_error(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+        self.cfg_server['sensor']['engine'] = 'async'
+        self.cfg_server['sensor']['bitbucket_server_url'] = 'http://bitbucket.local'
+        failing_commits = set(['%040x' % 4])
+
+        async def request(url, params=None, headers=None):
+            start = params.get('start', 0)
+            if url.endswith('/branches'):
+                tip = self.dummy_commits.commits[0].commit_id
+                values = [{'displayId': x, 'latestCommit': tip} for x in ['master', 'dev']]
+            elif url.endswith('/changes'):
+                # the changes of the commit can't be parsed once
+                commit_id = url.split('/')[-2]
+                if commit_id in failing_commits:
+                    failing_commits.discard(commit_id)
+                    raise ValueError('unexpected JSON')
+                values = [{'type': 'ADD', 'path': {'toString': 'foo/bar'}}]
+            else:
+                commits = self.dummy_commits.start_at(params['until'], params.get('since'))
+                values = [x.data for x in commits.commits]
+
+            return (200, {}, {'values': values[start:], 'isLastPage': True})
+
+        def get_commit_ids(branch):
+            return [x['id'] for p in self.filter_payload(self.get_dispatched_triggers(),
+                                                         'branch', branch)
+                    for x in p['commits'] if p['repository'] == 'foo/bar']
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            with mock.patch.object(sensor._engine, '_request', side_effect=request):
+                for i in range(3, 0, -1):
+                    self.dummy_commits.insert_commit(i)
+
+                # the walk stops at the commit which fails, and it's resumed from there
+                sensor.poll()
+                self.assertEqual(get_commit_ids('master'), ['%040x' % 5])
+                self.assertEqual(sensor.cursors['foo/bar']['master']['offset'], 1)
+
+                sensor.poll()
+
+            sensor.cleanup()
+
+        self.assertEqual(get_commit_ids('master'), ['%040x' % x for x in range(5, 2, -1)])
+        self.assertEqual(sensor.cursors.get('foo/bar', {}), {})
 
-        # If all commits are dispatched in the first polling processing, this value will be 0
-        self.assertEqual(len(contexts_second), 1)
-        self.assertTrue(len(contexts_first[0]['payload']['payload']) <= 10)
+    def test_checking_branches_concurrently(self):
+        # set variables for Bitbucket Server test
+        self.dummy_commits = MockCommitsForServer(3, {'emailAddress': 'test@test.local'})
+        self.delay = 0
+        self.cfg_server['sensor']['concurrency'] = 3
+
+        sensor = self.get_sensor_instance(config=self.cfg_server)
+
+        # every walk waits until the walks of all 3 branches are in flight at once
+        barrier = threading.Barrier(3, timeout=10)
+        get_updated_commits = sensor._get_updated_commits
+
+        def wait_and_get_updated_commits(repository, branch):
+            barrier.wait()
+            return get_updated_commits(repository, branch)
+
+        with mock.patch.object(stashy, 'connect',
+                               mock.Mock(return_value=self.client_mock_for_server())):
+            sensor.setup()
+
+            for i in range(10, 0, -1):
+                self.dummy_commits.insert_commit(i)
+
+            with mock.patch.object(sensor, '_get_updated_commits',
+                                   side_effect=wait_and_get_updated_commits):
+                sensor.poll()
+
+        # the sequential walks would break the barrier and fail
+        self.assertFalse(barrier.broken)
+        self.assertEqual(len(self.get_dispatched_triggers()), 3)
 
-        # checking duplicated payload isn't sent in the second dispatching
-        p1 = contexts_first[0]['payload']['payload']
-        p2 = contexts_second[0]['payload']['payload']
-        for (r, b) in set([(x['repository'], x['branch']) for x in p1['commits']]):
-            self.assertEqual(
-                list(
-                    filter(lambda x: x['repository'] == r and x['branch'] == b, p2['commits'])
-                ), []
-            )
+    def test_parsing_date_of_cloud_commit(self):
+        # the timezone offset of the BitBucket Cloud API is ignored as well as the 'Z' suffix
+        for date in ['2017-09-29T03:19:36+00:00', '2017-09-29T03:19:36Z']:
+            self.assertEqual(parse_cloud_date(date), datetime(2017, 9, 29, 3, 19, 36))
 
     def test_dispatching_commit_from_cloud(self):
         sensor = self.get_sensor_instance(config=self.cfg_cloud)
 
-        # prepare mock user
-        user1 = mock.Mock(spec=User)
-        user1.username = 'user1'
+        user1 = {'raw': 'user1 <user1@test.local>', 'user': {'username': 'user1'}}
+        commits_baz_master = MockCommitsForCloud(2, user1, 'master')
+        commits_puyo_master = MockCommitsForCloud(3, user1, 'master')
+        commits_puyo_dev = MockCommitsForCloud(4, {'raw': 'user2'}, 'dev')
 
-        commits_baz_master = MockCommitsForCloud(2, user1)
-        commits_puyo_master = MockCommitsForCloud(3, user1)
-        commits_puyo_dev = MockCommitsForCloud(4, {'raw': 'user2'})
+        def get_commits(url):
+            self.commits_requests.append(url)
+            if self.commits_status != 200:
+                return mock.Mock(status_code=self.commits_status, url=url, text='',
+                                 json=mock.Mock(side_effect=ValueError))
 
-        def side_effect(username, repository_name, branch, client):
-            if repository_name == 'baz' and branch == 'master':
-                return commits_baz_master
-            elif repository_name == 'puyo' and branch == 'master':
-                return commits_puyo_master
-            elif repository_name == 'puyo' and branch == 'dev':
-                return commits_puyo_dev
+            (path, query) = url.split('?')
+            (repository, until) = path.split('/repositories/')[1].split('/commits/')
+            params = dict(parse_qsl(query))
 
-        with mock.patch.object(Commit, 'find_commits_in_repository',
-                               mock.Mock(side_effect=side_effect)):
+            commits = [x for x in {
+                'bar/baz': [commits_baz_master],
+                'fuga/puyo': [commits_puyo_master, commits_puyo_dev],
+            }[repository] if until in x][0].start_at(until, params.get('exclude'))
+
+            # the commits are split into the pages which have two commits
+            page = int(params.get('page', 1))
+            mock_response = mock.Mock(status_code=200)
+            mock_response.json.return_value = {
+                'values': [x.data for x in commits.commits[(page - 1) * 2:page * 2]],
+            }
+            if page * 2 < len(commits.commits):
+                mock_response.json.return_value['next'] = '%s?%s' % (
+                    path, urlencode(dict(params, page=page + 1)))
+            return mock_response
+
+        def get_branches(url, headers):
+            self.branches_requests.append(url)
+
+            commits = {
+                'bar/baz': {'master': commits_baz_master},
+                'fuga/puyo': {'master': commits_puyo_master, 'dev': commits_puyo_dev},
+            }[url.split('/repositories/')[1].split('/refs/')[0]]
+            tips = dict([(k, v.commits[0].commit_id) for (k, v) in commits.items()])
+            etag = json.dumps(tips, sort_keys=True)
+
+            # the conditional request is answered by '304 Not Modified'
+            if headers.get('If-None-Match') == etag:
+                return mock.Mock(status_code=304)
+
+            mock_response = mock.Mock(status_code=200, headers={'ETag': etag})
+            mock_response.json.return_value = {
+                'values': [{'name': k, 'target': {'hash': v}} for (k, v) in tips.items()],
+            }
+            return mock_response
+
+        def get_diffstat(url, headers=None):
+            if '/refs/branches' in url:
+                return get_branches(url, headers)
+            if '/commits/' in url:
+                return get_commits(url)
+            if self.changes_status != 200:
+                return mock.Mock(status_code=self.changes_status, url=url, text='',
+                                 json=mock.Mock(side_effect=ValueError))
+
+            self.changes_requests.append(url)
+
+            # the diffstat of each commit is split into two pages
+            mock_response = mock.Mock(status_code=200)
+            if url.endswith('?page=2'):
+                mock_response.json.return_value = {
+                    'values': [
+                        {'status': 'removed', 'old': {'path': 'abcd'}, 'new': None},
+                        {'status': 'modified', 'old': {'path': 'hoge'}, 'new': {'path': 'hoge'}},
+                    ],
+                }
+            else:
+                mock_response.json.return_value = {
+                    'values': [
+                        {'status': 'added', 'old': None, 'new': {'path': 'foo/bar'}},
+                        {'status': 'renamed', 'old': {'path': 'foo'}, 'new': {'path': 'foo/baz'}},
+                    ],
+                    'next': url + '?page=2',
+                }
+            return mock_response
+
+        with mock.patch('requests.Session.get', mock.Mock(side_effect=get_diffstat)):
             # setup repository_sensor to monitor BitBucket server
             sensor.setup()
 
@@ -195,7 +1344,75 @@ class RepositorySensorTestCase(BaseSensorTestCase):
             # check commits in the target repositories and dispatch them
             sensor.poll()
 
-        contexts = self.get_dispatched_triggers()
+            # the branches which aren't moved are not walked
+            self.assertEqual(len(self.commits_requests), 3 + 2)
+
+            # nothing is walked when all branches are not modified
+            sensor.poll()
+            self.assertEqual(len(self.commits_requests), 3 + 2)
+            self.assertEqual(len(self.branches_requests), 4)
+
+            contexts = self.get_dispatched_triggers()
+            diffstat_requests = len(self.changes_requests)
+            commit_date = commits_baz_master.commits[0].date
+
+            # The walk which is split into the pollings is resumed from the page of the next
+            # commit, which is listed from the commit-id which the walk is pinned to.
+            sensor.BATCH_SIZE = 1
+            for i in range(3):
+                commits_puyo_dev.insert_commit(i)
+
+            self.commits_requests = []
+            self.sensor_service.dispatched_triggers = []
+            for _ in range(3):
+                sensor.poll()
+
+            head = commits_puyo_dev.commits[0].commit_id
+            self.assertEqual([urlsplit(x).path.split('/commits/')[1]
+                              for x in self.commits_requests], ['dev', head, head, head])
+            self.assertEqual(['page=2' in x for x in self.commits_requests],
+                             [False, False, True, True])
+
+            messages = [x['msg'] for c in self.get_dispatched_triggers()
+                        for x in c['payload']['payload']['commits']]
+            self.assertEqual(messages, ['commit-6', 'commit-5', 'commit-4'])
+
+            # BitBucket is unavailable between two pushes, which doesn't reset the branch
+            sensor.BATCH_SIZE = 10
+            last_commit = sensor.last_commit['bar/baz']['master']
+            commits_baz_master.insert_commit(2)
+            self.commits_status = 503
+            self.sensor_service.dispatched_triggers = []
+            sensor.poll()
+            self.assertEqual(self.get_dispatched_triggers(), [])
+            self.assertEqual(sensor.last_commit['bar/baz']['master'], last_commit)
+
+            # the commits of both pushes are dispatched once BitBucket is available again
+            commits_baz_master.insert_commit(3)
+            self.commits_status = 200
+            sensor.poll()
+            messages = [x['msg'] for c in self.get_dispatched_triggers()
+                        for x in c['payload']['payload']['commits']]
+            self.assertEqual(messages, ['commit-4', 'commit-3'])
+
+            # The diffstat of the new commit can't be fetched, then the walk is resumed from
+            # that commit without resetting the branch. (the commit-ids of the mocked commits
+            # are shared with the other branches whose diffstats are cached)
+            sensor._changes_cache = LRUCache(10, 60)
+            last_commit = sensor.last_commit['bar/baz']['master']
+            commits_baz_master.insert_commit(4)
+            self.changes_status = 503
+            self.sensor_service.dispatched_triggers = []
+            sensor.poll()
+            self.assertEqual(self.get_dispatched_triggers(), [])
+            self.assertEqual(sensor.last_commit['bar/baz']['master'], last_commit)
+            self.assertEqual(sensor.cursors['bar/baz']['master']['offset'], 0)
+
+            self.changes_status = 200
+            sensor.poll()
+            messages = [x['msg'] for c in self.get_dispatched_triggers()
+                        for x in c['payload']['payload']['commits']]
+            self.assertEqual(messages, ['commit-5'])
 
         # Trigger is going to dispatch three times every following (repository, branch) sets.
         # - ('bar/baz', 'master')
@@ -210,15 +1427,46 @@ class RepositorySensorTestCase(BaseSensorTestCase):
         commit_keys = ['repository', 'branch', 'author', 'time', 'msg']
         commit_info = self.filter_payload(contexts, 'branch', 'master')[0]['commits'][0]
         self.assertTrue(all([x in commit_info for x in commit_keys]))
+        self.assertEqual(commit_info['time'], datetime.strptime(
+            commit_date[:19], '%Y-%m-%dT%H:%M:%S').strftime('%Y-%m-%d %H:%M:%S'))
+
+        # checks that payloads has the information about the changed files
+        changing_files = self.filter_payload(contexts, 'branch', 'master')[0]['changed_files']
+        self.assertEqual(changing_files, {
+            'added': ['foo/bar'],
+            'moved': ['foo/baz'],
+            'deleted': ['abcd'],
+            'modified': ['hoge'],
+        })
+
+        # the diffstat of each new commit is fetched once (the two pages of it)
+        self.assertEqual(diffstat_requests, 4)
+
+
+def make_commit(repository, branch, added=None, moved=None, deleted=None, modified=None):
+    return {
+        'repository': repository,
+        'branch': branch,
+        'author': 'test@test.local',
+        'time': '2017-09-29 03:19:36',
+        'msg': 'commit',
+        'files': {
+            'added': added or [],
+            'moved': moved or [],
+            'deleted': deleted or [],
+            'modified': modified or [],
+        },
+    }
 
 
 class MockCommits(Iterator):
-    def __init__(self, count, author, commit_model):
+    def __init__(self, count, author, commit_model, branch=None):
         self.delay = None
         self.commits = []
         self.index = 0
         self.author = author
         self.model = commit_model
+        self.branch = branch
 
         for x in range(0, count):
             self.commits.append(self.model(x, self.author, self.index * -1))
@@ -239,15 +1487,33 @@ class MockCommits(Iterator):
         self.index += 1
         return value
 
+    def __contains__(self, ref):
+        return ref == self.branch or any([x.commit_id == ref for x in self.commits])
+
     def insert_commit(self, delta_seconds=0):
         self.commits.insert(0, self.model(len(self.commits), self.author, delta_seconds))
 
+    def start_at(self, until, since=None):
+        """
+        This returns a copy of the commits which starts at the specified commit-id
+        (or the tip of the branch when the branch name is specified) and stops before
+        the 'since' commit-id.
+        """
+        commits = copy.copy(self)
+        if until != self.branch and any([x.commit_id == until for x in self.commits]):
+            commits.commits = list(itertools.dropwhile(lambda x: x.commit_id != until,
+                                                       self.commits))
+        commits.commits = list(itertools.takewhile(lambda x: x.commit_id != since,
+                                                   commits.commits))
+        return commits
+
 
 class MockCommitsForServer(MockCommits):
     class CommitModel(object):
         def __init__(self, index, author, delta_seconds):
+            self.commit_id = '%040x' % index
             self.data = {
-                'id': '0123456789abcdefghijklmnopqrstuvwxyzABCD',
+                'id': self.commit_id,
                 'message': 'commit-%d' % index,
                 'authorTimestamp': int(round((time.time() + delta_seconds * 100) * 1000)),
                 'author': author,
@@ -256,19 +1522,25 @@ class MockCommitsForServer(MockCommits):
         def __getitem__(self, key):
             return self.data[key]
 
-    def __init__(self, count, author):
-        super(MockCommitsForServer, self).__init__(count, author, self.CommitModel)
+    def __init__(self, count, author, branch=None):
+        super(MockCommitsForServer, self).__init__(count, author, self.CommitModel, branch)
 
 
 class MockCommitsForCloud(MockCommits):
     class CommitModel(object):
         def __init__(self, index, author, delta_seconds):
+            # the date is in the format of the BitBucket Cloud API (with the timezone offset)
             commit_time = (datetime.now() +
-                           timedelta(seconds=delta_seconds)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                           timedelta(seconds=delta_seconds)).strftime('%Y-%m-%dT%H:%M:%S+00:00')
 
-            self.message = 'commit-%d' % index
-            self.author = author
+            self.commit_id = '%040x' % index
             self.date = commit_time
+            self.data = {
+                'hash': self.commit_id,
+                'message': 'commit-%d' % index,
+                'author': author,
+                'date': commit_time,
+            }
 
-    def __init__(self, count, author):
-        super(MockCommitsForCloud, self).__init__(count, author, self.CommitModel)
+    def __init__(self, count, author, branch=None):
+        super(MockCommitsForCloud, self).__init__(count, author, self.CommitModel, branch)
@@ -0,0 +1,167 @@
+import hashlib
+import hmac
+import json
+import mock
+import requests
+import threading
+import yaml
+
+from st2tests.base import BaseSensorTestCase
+from webhook_sensor import WebhookSensor
+
+
+class WebhookSensorTestCase(BaseSensorTestCase):
+    sensor_cls = WebhookSensor
+
+    def setUp(self):
+        super(WebhookSensorTestCase, self).setUp()
+
+        self.cfg = yaml.safe_load(self.get_fixture_content('cfg_server.yaml'))
+        self.cfg['sensor']['webhook'] = {'host': '127.0.0.1', 'port': 0}
+
+        self.server_push = json.loads(self.get_fixture_content('server_push.json'))
+        self.cloud_push = json.loads(self.get_fixture_content('cloud_push.json'))
+
+        self.sensor = self.get_sensor_instance(config=self.cfg)
+        self.sensor.setup()
+
+    def tearDown(self):
+        self.sensor.cleanup()
+
+    def get_diffstat(self, url):
+        # the diffstat of each commit is split into two pages
+        diffstat = [
+            {'status': 'added', 'new': {'path': 'foo/bar'}, 'old': None},
+            {'status': 'removed', 'new': None, 'old': {'path': 'abcd'}},
+        ]
+        page = 1 if url.endswith('?page=2') else 0
+
+        mock_response = mock.Mock()
+        mock_response.json.return_value = {
+            'values': diffstat[page:page + 1],
+            'next': url + '?page=2' if page == 0 else None,
+        }
+        return mock_response
+
+    def test_dispatching_commit_from_server_push(self):
+        self.sensor._handle_push(self.server_push)
+
+        contexts = self.get_dispatched_triggers()
+        self.assertEqual(len(contexts), 1)
+
+        payload = contexts[0]['payload']['payload']
+        self.assertEqual(payload['repository'], 'foo/bar')
+        self.assertEqual(payload['branch'], 'master')
+        self.assertEqual([x['msg'] for x in payload['commits']],
+                         ['second commit', 'first commit'])
+        self.assertEqual(payload['commits'][0]['author'], 'test@test.local')
+        self.assertEqual(payload['commits'][0]['files']['deleted'], ['abcd'])
+        self.assertEqual(sorted(payload['changed_files']['added']), ['foo/bar'])
+        self.assertEqual(sorted(payload['changed_files']['modified']), ['foo/bar'])
+
+        # the redelivered webhook doesn't dispatch the same commits again
+        self.sensor._handle_push(self.server_push)
+        self.assertEqual(len(self.get_dispatched_triggers()), 1)
+
+        record = self.sensor._dispatched.get('foo/bar', 'master')
+        self.assertEqual((record['base'], record['head']), ('%040x' % 0, '%040x' % 2))
+
+    def test_filtering_server_push_by_paths(self):
+        self.cfg['sensor']['targets'][0]['paths'] = {'exclude': ['foo/*']}
+        sensor = self.get_sensor_instance(config=self.cfg)
+        sensor.setup()
+        self.addCleanup(sensor.cleanup)
+
+        # the commit which only changes the excluded files isn't dispatched
+        sensor._handle_push(self.server_push)
+
+        contexts = self.get_dispatched_triggers()
+        self.assertEqual(len(contexts), 1)
+        self.assertEqual([x['msg'] for x in contexts[0]['payload']['payload']['commits']],
+                         ['second commit'])
+
+    def test_leaving_ambiguous_server_push_to_polling(self):
+        # the push to multiple branches can't attribute the changesets to each branch
+        self.server_push['refChanges'].append(dict(self.server_push['refChanges'][0],
+                                                   refId='refs/heads/dev'))
+        self.sensor._handle_push(self.server_push)
+        self.assertEqual(len(self.get_dispatched_triggers()), 0)
+
+        # the branch which isn't monitored is ignored
+        self.server_push['refChanges'] = [dict(self.server_push['refChanges'][0],
+                                               refId='refs/heads/feature')]
+        self.sensor._handle_push(self.server_push)
+        self.assertEqual(len(self.get_dispatched_triggers()), 0)
+
+        # the truncated commits are left to the polling, then the tip isn't recorded
+        self.server_push['refChanges'] = [self.server_push['refChanges'][0]]
+        self.server_push['refChanges'][0]['refId'] = 'refs/heads/master'
+        self.server_push['changesets']['values'][0]['changes']['isLastPage'] = False
+        self.sensor._handle_push(self.server_push)
+
+        payload = self.get_last_dispatched_trigger()['payload']['payload']
+        self.assertEqual([x['msg'] for x in payload['commits']], ['first commit'])
+        self.assertEqual(self.sensor._dispatched.get('foo/bar', 'master')['head'], None)
+
+    def test_dispatching_commit_from_cloud_push(self):
+        with mock.patch.object(self.sensor.session, 'get', side_effect=self.get_diffstat) as m:
+            self.sensor._handle_push(self.cloud_push)
+
+        # the tag isn't dispatched, and the changed files are fetched following all pages
+        contexts = self.get_dispatched_triggers()
+        self.assertEqual(len(contexts), 1)
+        self.assertEqual(m.call_count, 4)
+
+        payload = contexts[0]['payload']['payload']
+        self.assertEqual(payload['repository'], 'foo/bar')
+        self.assertEqual([x['author'] for x in payload['commits']],
+                         ['test', 'test <test@test.local>'])
+        self.assertEqual(payload['commits'][0]['time'], '2017-09-29 03:19:36')
+        self.assertEqual(payload['changed_files']['added'], ['foo/bar'])
+        self.assertEqual(payload['changed_files']['deleted'], ['abcd'])
+
+    def test_receiving_webhook_over_http(self):
+        self.cfg['sensor']['webhook']['secret'] = 'secret'
+        self.sensor.cleanup()
+        self.sensor.setup()
+
+        thread = threading.Thread(target=self.sensor.run)
+        thread.start()
+
+        url = 'http://127.0.0.1:%d/bitbucket' % self.sensor._server.server_address[1]
+        body = json.dumps(self.server_push).encode('utf-8')
+        signature = 'sha256=' + hmac.new(b'secret', body, hashlib.sha256).hexdigest()
+
+        try:
+            res = requests.post(url, data=body, headers={'X-Hub-Signature': 'sha256=invalid'})
+            self.assertEqual(res.status_code, 401)
+
+            # the webhook is acknowledged before the push is processed
+            processing = threading.Event()
+            handle_push = self.sensor._handle_push
+
+            def wait_and_handle_push(body):
+                processing.wait(10)
+                handle_push(body)
+
+            with mock.patch.object(self.sensor, '_handle_push', wait_and_handle_push):
+                res = requests.post(url, data=body, headers={'X-Hub-Signature': signature},
+                                    timeout=5)
+                self.assertEqual(res.status_code, 202)
+                self.assertEqual(len(self.get_dispatched_triggers()), 0)
+                processing.set()
+        finally:
+            self.sensor.cleanup()
+            thread.join()
+
+        self.assertEqual(len(self.get_dispatched_triggers()), 1)
+
+    def test_matching_wildcard_targets(self):
+        self.sensor.targets = [
+            {'repository': 'foo/*', 'branches': ['release/*']},
+            {'repository': 'foo/bar', 'branches': ['master']},
+        ]
+
+        self.assertEqual(self.sensor._get_target('FOO/bar', 'master'), 'foo/bar')
+        self.assertEqual(self.sensor._get_target('FOO/baz', 'release/1.0'), 'foo/baz')
+        self.assertEqual(self.sensor._get_target('FOO/baz', 'master'), None)